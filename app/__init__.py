@@ -10,24 +10,66 @@ login_manager.login_view = 'auth.login'
 migrate = Migrate()
 
 
-def create_app():
+def create_app(config=None):
+    """Create the app. ``config`` overrides the defaults below (used by the benchmark harness)."""
     app = Flask(__name__, template_folder="templates", static_folder="static")
-    # ensure instance directory exists and use it for the sqlite DB
-    os.makedirs(app.instance_path, exist_ok=True)
+    # use the instance directory for the sqlite DB
     db_path = os.path.join(app.instance_path, 'ccm.db')
     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["SECRET_KEY"] = "dev"
+    # deployments set options as FLASK_<KEY> environment variables (e.g. in the systemd unit)
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+    # ensure it exists unless the DB lives elsewhere (the other instance files create their directories)
+    if app.config["SQLALCHEMY_DATABASE_URI"] == f"sqlite:///{db_path}":
+        os.makedirs(app.instance_path, exist_ok=True)
 
     db.init_app(app)
     login_manager.init_app(app)
     migrate.init_app(app, db)
 
+    # request hooks
+    from . import instrumentation, metrics, profiler, ratelimit
+    # caches and background jobs
+    from . import fragment_cache, conditional, digests, backup, popularity
+    # uploads, static files, templates and feeds
+    from . import storage, delivery, compression, assets, template_cache, images, avatars, ics_feed
+    from . import cli
+    with app.app_context():
+        # count queries / DB time per request (registered first so it wraps every other hook)
+        instrumentation.init_app(app, db.engine)
+        metrics.init_app(app, db.engine)
+    profiler.init_app(app)
+    ratelimit.init_app(app)
+    fragment_cache.init_app(app)
+    conditional.init_app(app)
+    digests.init_app(app)
+    backup.init_app(app)
+    popularity.init_app(app)
+    storage.init_app(app)
+    delivery.init_app(app)
+    compression.init_app(app)
+    assets.init_app(app)
+    template_cache.init_app(app)
+    images.init_app(app)
+    avatars.init_app(app)
+    ics_feed.init_app(app)
+    cli.register_commands(app)
+
     # register blueprints after db init to avoid context issues
     from .routes import main
     from .auth import auth as auth_bp
+    from .api import api as api_bp
     app.register_blueprint(main)
     app.register_blueprint(auth_bp, url_prefix='/auth')
+    app.register_blueprint(api_bp, url_prefix='/api')
+
+    if app.config['TEMPLATE_WARMUP']:
+        # compile all templates now rather than on the first requests of each worker
+        count, seconds = template_cache.warm_up(app)
+        app.logger.debug('Warmed up %d templates in %.0f ms', count, seconds * 1000)
 
     with app.app_context():
         # import models before creating tables
@@ -0,0 +1,98 @@
+"""Read-only JSON API for the calendar client."""
+import json
+from datetime import date, timedelta
+
+from flask import Blueprint, Response, current_app, request, stream_with_context
+from flask_login import login_required
+from sqlalchemy import func, select
+
+from . import db
+from .conditional import not_modified, page_etag, with_validators
+from .models import Participant, Proposal, Recipe, User
+
+api = Blueprint('api', __name__)
+
+MAX_RANGE_DAYS = 366
+
+
+def _error(message, status=400):
+    return {'status': 'error', 'message': message}, status
+
+
+def _proposal_rows(start, end):
+    """One flat row per (proposal, participant), ordered so that a proposal's rows are adjacent."""
+    q = (select(Proposal.id, Proposal.date, Proposal.start_time, Proposal.updated_at,
+                Proposal.proposer_id, User.username, Proposal.cook_user_id, Proposal.grocery_user_id,
+                Recipe.id, Recipe.title, Recipe.image, Participant.user_id)
+         .join(Recipe, Recipe.id == Proposal.recipe_id)
+         .join(User, User.id == Proposal.proposer_id)
+         .outerjoin(Participant, Participant.proposal_id == Proposal.id)
+         .where(Proposal.date >= start, Proposal.date <= end)
+         .order_by(Proposal.date, Proposal.start_time, Proposal.id, Participant.id)
+         .execution_options(yield_per=500))
+    return db.session.execute(q)
+
+
+def _group(rows):
+    current = None
+    for (pid, d, st, updated, proposer_id, proposer_name, cook_id, grocery_id,
+         recipe_id, title, image, participant_id) in rows:
+        if current is None or current['id'] != pid:
+            if current is not None:
+                yield current
+            current = {
+                'id': pid,
+                'date': d.isoformat(),
+                'start_time': st.strftime('%H:%M') if st else None,
+                'updated_at': updated.isoformat() if updated else None,
+                'recipe': {'id': recipe_id, 'title': title, 'image': image},
+                'proposer': {'id': proposer_id, 'username': proposer_name},
+                'cook_user_id': cook_id,
+                'grocery_user_id': grocery_id,
+                'participant_ids': [],
+            }
+        if participant_id is not None:
+            current['participant_ids'].append(participant_id)
+    if current is not None:
+        yield current
+
+
+@api.route('/proposals')
+@login_required
+def proposals():
+    """Proposals with start <= date <= end (ISO dates; default: this week and the next three).
+
+    The body is streamed: ``{"start": ..., "end": ..., "proposals": [...]}``.
+    """
+    today = date.today()
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else today - timedelta(days=today.weekday())
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else start + timedelta(days=27)
+    except ValueError:
+        return _error('start and end must be ISO dates (YYYY-MM-DD)')
+    if end < start:
+        return _error('end is before start')
+    if (end - start).days >= current_app.config.get('API_MAX_RANGE_DAYS', MAX_RANGE_DAYS):
+        return _error('date range too large')
+
+    # join/leave/messages bump proposal.updated_at (touch_proposal); recipe titles live in recipe
+    stamp = db.session.execute(select(
+        func.max(Proposal.updated_at), func.count(Proposal.id), func.max(Proposal.id),
+        select(func.max(Recipe.updated_at)).scalar_subquery(),
+    ).where(Proposal.date >= start, Proposal.date <= end)).one()
+    etag = page_etag(start, end, tuple(stamp))
+    last_modified = max((t for t in (stamp[0], stamp[3]) if t), default=None)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
+
+    def generate():
+        yield '{"start": %s, "end": %s, "proposals": [' % (json.dumps(start.isoformat()), json.dumps(end.isoformat()))
+        sep = ''
+        for p in _group(_proposal_rows(start, end)):
+            yield sep + json.dumps(p, separators=(',', ':'))
+            sep = ','
+        yield ']}'
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    return with_validators(response, etag, last_modified)
@@ -0,0 +1,144 @@
+"""Versioned CSS/JS bundles.
+
+The page CSS and JS live in app/static/css and app/static/js. ``BUNDLES`` maps
+a bundle name to its source files; ``flask assets build`` concatenates and
+minifies each bundle, names it after a hash of its content
+(``dist/calendar.3f2a9c81d0.css``), precompresses it and records the names in
+``dist/manifest.json``. Templates link bundles with the ``asset_url(name)``
+global, and since a changed bundle gets a new name, the hashed files are
+served with a one-year ``immutable`` Cache-Control.
+
+If the manifest is missing or older than a source file (a checkout without a
+build, or editing in debug mode) the bundles are built on first use; in debug
+mode the sources are checked on every page.
+"""
+import hashlib
+import json
+import os
+import re
+
+from flask import current_app, request, url_for
+
+BUNDLES = {
+    'base.css': ('css/style.css', 'css/base.css'),
+    'base.js': ('js/base.js',),
+    'calendar.css': ('css/calendar.css',),
+    'calendar.js': ('js/calendar.js',),
+    'discuss.js': ('js/discuss.js',),
+}
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def init_app(app):
+    app.config.setdefault('ASSETS_AUTO_BUILD', True)
+    app.add_template_global(asset_url)
+    app.after_request(_cache_bundles)
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    # no spaces around braces, after separators, or before ';' (a space before ':' can be a selector)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip() + '\n'
+
+
+def minify_js(text):
+    # conservative: drop indentation, blank lines and whole-line comments; keep line breaks
+    # so automatic semicolon insertion and strings containing // are unaffected
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+
+def _dist_folder(static_folder):
+    return os.path.join(static_folder, DIST)
+
+
+def _read_manifest(static_folder):
+    try:
+        with open(os.path.join(_dist_folder(static_folder), MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(static_folder=None):
+    """Build all bundles into dist/ and write the manifest; return {bundle: path below static}."""
+    from . import compression
+    static_folder = static_folder or current_app.static_folder
+    dist = _dist_folder(static_folder)
+    os.makedirs(dist, exist_ok=True)
+    previous = _read_manifest(static_folder) or {}
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(static_folder, source), encoding='utf-8') as f:
+                parts.append(f.read())
+        text = '\n'.join(parts)
+        stem, ext = os.path.splitext(name)
+        data = (minify_css(text) if ext == '.css' else minify_js(text)).encode('utf-8')
+        filename = f'{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}'
+        path = os.path.join(dist, filename)
+        if not os.path.exists(path):
+            _write(path, data)
+        manifest[name] = f'{DIST}/{filename}'
+    # keep the previous build as well: pages rendered by workers that still run it refer to it
+    keep = {os.path.basename(p) for p in list(manifest.values()) + list(previous.values())}
+    for filename in os.listdir(dist):
+        if filename.endswith('.part'):
+            # in-flight temp file of another process's build
+            continue
+        base = re.sub(r'\.(gz|br)$', '', filename)
+        if base != MANIFEST and base not in keep:
+            os.remove(os.path.join(dist, filename))
+    compression.precompress_static(dist)
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def _write(path, data):
+    tmp = f'{path}.{os.getpid()}.part'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _stale(static_folder):
+    try:
+        built = os.path.getmtime(os.path.join(_dist_folder(static_folder), MANIFEST))
+    except OSError:
+        return True
+    return any(os.path.getmtime(os.path.join(static_folder, source)) > built
+               for sources in BUNDLES.values() for source in sources)
+
+
+def manifest():
+    """The bundle manifest of this process, built if missing or stale (see the module docstring)."""
+    app = current_app
+    state = app.extensions.setdefault('ccm_assets', {})
+    if 'manifest' not in state or app.debug:
+        data = _read_manifest(app.static_folder)
+        if (data is None or _stale(app.static_folder)) and app.config['ASSETS_AUTO_BUILD']:
+            data = build(app.static_folder)
+        state['manifest'] = data or {}
+    return state['manifest']
+
+
+def asset_url(name):
+    """URL of the hashed bundle ``name`` (a key of ``BUNDLES``)."""
+    return url_for('static', filename=manifest()[name])
+
+
+def _cache_bundles(response):
+    if (request.endpoint == 'static' and response.status_code in (200, 304)
+            and (request.view_args or {}).get('filename', '').startswith(DIST + '/')
+            and not request.view_args['filename'].endswith(MANIFEST)):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
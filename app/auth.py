@@ -1,6 +1,6 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from .models import User
-from . import db
+from . import db, ratelimit
 from flask_login import login_user, logout_user, login_required, current_user
 
 auth = Blueprint('auth', __name__)
@@ -35,6 +35,7 @@ def login():
         if u and u.check_password(password):
             login_user(u)
             return redirect(url_for('main.index'))
+        ratelimit.failed_attempt()
         flash('Invalid credentials', 'warning')
         return redirect(url_for('auth.login'))
     return render_template('login.html')
@@ -0,0 +1,105 @@
+"""Square avatar renditions.
+
+Avatars are stored at up to 1600px like every upload, but shown at 40-96px.
+At upload (and by ``flask avatars backfill`` for existing users) the image is
+cropped to a square once and written as JPEG renditions of ``AVATAR_SIZES``
+next to the original (``<name>_av<size>.jpg``). Templates use the
+``avatar_url(user, size)`` and ``avatar_srcset(user, size)`` globals, which
+pick the smallest rendition covering ``size`` CSS pixels at 1x and 2x, and
+fall back to the original while a rendition is missing (on S3 the storage
+remembers a missing rendition for ``STORAGE_S3_MISSING_TTL`` seconds).
+"""
+import os
+
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+
+from . import images, metrics, storage
+
+AVATAR_SIZES = (48, 96, 192)
+DEFAULT_AVATAR = 'img/default-avatar.svg'
+
+
+def init_app(app):
+    app.add_template_global(avatar_url)
+    app.add_template_global(avatar_srcset)
+
+
+def rendition_name(avatar, size):
+    base, _ = os.path.splitext(avatar)
+    return f'{base}_av{size}.jpg'
+
+
+def make_renditions(avatar, sizes=AVATAR_SIZES, quality=82):
+    """Store the square renditions of the uploaded ``avatar``; return their names (empty on failure)."""
+    with metrics.IMAGE_SECONDS.time('avatar_renditions'):
+        return _make_renditions(avatar, sizes, quality)
+
+
+def _make_renditions(avatar, sizes, quality):
+    store = storage.get_storage()
+    try:
+        with store.local_copy(avatar) as path:
+            # decodes a JPEG at a reduced scale right away; the largest rendition is small
+            img = images.open_image(path, (max(sizes), max(sizes)), cover=True)
+            img = ImageOps.exif_transpose(img)
+    except Exception:
+        return []
+    try:
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        # crop to a centered square once, then scale down from the largest size
+        square = ImageOps.fit(img, (max(sizes), max(sizes)), Image.LANCZOS)
+        names = []
+        for size in sorted(sizes, reverse=True):
+            out = square if size == square.width else square.resize((size, size), Image.LANCZOS)
+            name = rendition_name(avatar, size)
+            with store.writer(name) as dst:
+                out.save(dst, format='JPEG', quality=quality, optimize=True, progressive=True)
+                metrics.IMAGE_BYTES.observe(os.path.getsize(dst), 'avatar_renditions')
+            names.append(name)
+        return names
+    except Exception:
+        current_app.logger.exception('Avatar renditions failed for %s', avatar)
+        return []
+
+
+def _rendition(avatar, px):
+    size = next((s for s in AVATAR_SIZES if s >= px), AVATAR_SIZES[-1])
+    name = rendition_name(avatar, size)
+    return name if storage.get_storage().exists(name) else avatar
+
+
+def avatar_url(user, size=48, scale=1):
+    """URL of the smallest avatar rendition of ``user`` covering ``size`` CSS pixels at ``scale``."""
+    avatar = getattr(user, 'avatar', None)
+    if not avatar:
+        return url_for('static', filename=DEFAULT_AVATAR)
+    return storage.upload_url(_rendition(avatar, size * scale))
+
+
+def avatar_srcset(user, size=48):
+    """``srcset`` value with the 1x and 2x (HiDPI) renditions for an image shown at ``size`` px."""
+    if not getattr(user, 'avatar', None):
+        return ''
+    return f'{avatar_url(user, size)} 1x, {avatar_url(user, size, 2)} 2x'
+
+
+def backfill(force=False):
+    """Create missing renditions for all users with an avatar; return (created, failed) counts."""
+    from .models import User
+    store = storage.get_storage()
+    created = failed = 0
+    for (avatar,) in User.query.with_entities(User.avatar).filter(User.avatar.isnot(None), User.avatar != ''):
+        if not force and all(store.exists(rendition_name(avatar, s), fresh=True) for s in AVATAR_SIZES):
+            continue
+        if make_renditions(avatar):
+            created += 1
+        else:
+            failed += 1
+    return created, failed
@@ -0,0 +1,175 @@
+"""Online backups of the SQLite database.
+
+Snapshots are taken with SQLite's online backup API in steps of
+``BACKUP_PAGES_PER_STEP`` pages, sleeping ``BACKUP_STEP_SLEEP`` seconds in
+between, so writers are only blocked for the duration of one step and the
+copy is always consistent (a copy of a live file with ``cp`` can be torn).
+Every snapshot passes ``PRAGMA integrity_check`` before it is renamed into
+``BACKUP_DIR``; a snapshot identical to the newest one is discarded.
+
+Retention: the newest ``BACKUP_KEEP`` snapshots, plus the newest snapshot of
+each of the last ``BACKUP_KEEP_WEEKLY`` ISO weeks that have one. Snapshots
+saved by a restore (``*-pre-restore.db``) are never rotated.
+"""
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+
+from flask import current_app
+
+from . import db
+
+PREFIX = 'ccm-'
+SUFFIX = '.db'
+
+
+class BackupError(RuntimeError):
+    pass
+
+
+def init_app(app):
+    app.config.setdefault('BACKUP_DIR', os.path.join(app.instance_path, 'backups'))
+    app.config.setdefault('BACKUP_KEEP', 7)
+    app.config.setdefault('BACKUP_KEEP_WEEKLY', 4)
+    app.config.setdefault('BACKUP_PAGES_PER_STEP', 256)
+    app.config.setdefault('BACKUP_STEP_SLEEP', 0.005)
+
+
+def database_path():
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        raise BackupError('backups are only supported for file-based SQLite databases')
+    return url.database
+
+
+def copy_database(src_path, dst_path, pages=None, sleep=None):
+    """Copy ``src_path`` to ``dst_path`` with the online backup API; return the integrity check result."""
+    cfg = current_app.config
+    pages = cfg['BACKUP_PAGES_PER_STEP'] if pages is None else pages
+    sleep = cfg['BACKUP_STEP_SLEEP'] if sleep is None else sleep
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep)
+        return _integrity(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _integrity(con):
+    return [row[0] for row in con.execute('PRAGMA integrity_check')]
+
+
+def verify_backup(path):
+    """Return (ok, messages) of ``PRAGMA integrity_check`` on a snapshot."""
+    if not os.path.isfile(path):
+        raise BackupError(f'{path} does not exist')
+    con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = _integrity(con)
+    except sqlite3.DatabaseError as e:
+        result = [str(e)]
+    finally:
+        con.close()
+    return result == ['ok'], result
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def list_backups():
+    """Snapshots in BACKUP_DIR, newest first, as dicts with name, path, size and created."""
+    directory = current_app.config['BACKUP_DIR']
+    if not os.path.isdir(directory):
+        return []
+    backups = []
+    for name in os.listdir(directory):
+        if not (name.startswith(PREFIX) and name.endswith(SUFFIX)):
+            continue
+        try:
+            created = datetime.strptime(name[len(PREFIX):-len(SUFFIX)], '%Y%m%d-%H%M%S')
+        except ValueError:
+            continue
+        path = os.path.join(directory, name)
+        backups.append({'name': name, 'path': path, 'size': os.path.getsize(path), 'created': created})
+    backups.sort(key=lambda b: b['created'], reverse=True)
+    return backups
+
+
+def create_backup(output=None):
+    """Snapshot the live database; return the snapshot path, or None if nothing changed.
+
+    With ``output`` the snapshot is written there and neither deduplicated nor rotated.
+    """
+    directory = current_app.config['BACKUP_DIR']
+    target = output or os.path.join(directory, f"{PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}{SUFFIX}")
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    tmp = target + '.part'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        result = copy_database(database_path(), tmp)
+        if result != ['ok']:
+            raise BackupError('integrity check of the new snapshot failed: ' + '; '.join(result))
+        if output is None:
+            previous = list_backups()
+            if previous and _digest(previous[0]['path']) == _digest(tmp):
+                os.remove(tmp)
+                return None
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if output is None:
+        prune_backups()
+    return target
+
+
+def prune_backups():
+    """Apply the retention policy; return the names of deleted snapshots."""
+    cfg = current_app.config
+    backups = list_backups()
+    keep = {b['name'] for b in backups[:cfg['BACKUP_KEEP']]}
+    weeks = []
+    for b in backups:
+        week = b['created'].isocalendar()[:2]
+        if week not in weeks:
+            weeks.append(week)
+            if len(weeks) > cfg['BACKUP_KEEP_WEEKLY']:
+                break
+            keep.add(b['name'])
+    deleted = []
+    for b in backups:
+        if b['name'] not in keep:
+            os.remove(b['path'])
+            deleted.append(b['name'])
+    return deleted
+
+
+def restore_backup(path):
+    """Replace the live database's contents with snapshot ``path``.
+
+    The snapshot is verified first and the current database is snapshotted
+    (``*-pre-restore.db``) so a restore can be undone. The copy goes through
+    the backup API into the live file, so running workers see the restored
+    data on their next transaction.
+    """
+    ok, result = verify_backup(path)
+    if not ok:
+        raise BackupError(f'{path} failed the integrity check: ' + '; '.join(result))
+    live = database_path()
+    safety = os.path.join(current_app.config['BACKUP_DIR'],
+                          f"{PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}-pre-restore{SUFFIX}")
+    create_backup(output=safety)
+    db.session.remove()
+    db.engine.dispose()
+    # a single step: readers never see a half-restored database
+    copy_database(path, live, pages=-1, sleep=0)
+    return safety
@@ -0,0 +1,191 @@
+"""``flask`` sub-commands for maintenance jobs (run them from cron or systemd timers)."""
+import sys
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+from . import assets, avatars, backup, commitments, compression, popularity, storage, template_cache
+from .export import FORMATS, TABLES, gzip_chunks, iter_export
+
+digests_cli = AppGroup('digests', help='Notification digest emails.')
+backup_cli = AppGroup('backup', help='Online backups of the SQLite database.')
+popularity_cli = AppGroup('popularity', help='Recipe popularity counters.')
+commitments_cli = AppGroup('commitments', help='Per-user commitment index.')
+avatars_cli = AppGroup('avatars', help='Avatar renditions.')
+storage_cli = AppGroup('storage', help='Storage of uploaded files.')
+assets_cli = AppGroup('assets', help='Static files.')
+templates_cli = AppGroup('templates', help='Jinja templates.')
+
+
+@digests_cli.command('send')
+@click.option('--all', 'send_all', is_flag=True, help='Send every pending digest, due or not.')
+def digests_send(send_all):
+    """Send the hourly / daily notification digests that are due."""
+    from .digests import send_due_digests
+    sent = send_due_digests(force=send_all)
+    click.echo(f'sent {sent} digest(s)')
+
+
+@click.command('export')
+@click.argument('table', type=click.Choice(sorted(TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output.')
+@click.option('--output', '-o', default='-', help='Output file (default: stdout).')
+@with_appcontext
+def export_command(table, fmt, compress, output):
+    """Stream a table of the meal history as CSV or JSON."""
+    chunks = iter_export(table, fmt)
+    chunks = gzip_chunks(chunks) if compress else (c.encode('utf-8') for c in chunks)
+    out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+@backup_cli.command('create')
+@click.option('--output', '-o', default=None, help='Write the snapshot here instead of BACKUP_DIR (no rotation).')
+def backup_create(output):
+    """Take a consistent snapshot of the live database and apply retention."""
+    try:
+        path = backup.create_backup(output)
+    except backup.BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(path if path else 'database unchanged since the last snapshot; nothing written')
+
+
+@backup_cli.command('list')
+def backup_list():
+    """List the snapshots in BACKUP_DIR, newest first."""
+    for b in backup.list_backups():
+        click.echo(f"{b['created']:%Y-%m-%d %H:%M:%S}  {b['size']:>12}  {b['path']}")
+
+
+@backup_cli.command('verify')
+@click.argument('paths', nargs=-1)
+def backup_verify(paths):
+    """Run an integrity check on snapshots (default: all of them)."""
+    paths = paths or [b['path'] for b in backup.list_backups()]
+    failed = 0
+    for path in paths:
+        try:
+            ok, result = backup.verify_backup(path)
+        except backup.BackupError as e:
+            ok, result = False, [str(e)]
+        failed += not ok
+        click.echo(f"{'ok' if ok else 'FAILED'}  {path}" + ('' if ok else '  ' + '; '.join(result[:5])))
+    if failed:
+        raise click.ClickException(f'{failed} snapshot(s) failed verification')
+
+
+@backup_cli.command('prune')
+def backup_prune():
+    """Delete snapshots outside the retention policy."""
+    for name in backup.prune_backups():
+        click.echo(f'deleted {name}')
+
+
+@backup_cli.command('restore')
+@click.argument('path')
+@click.confirmation_option(prompt='Replace the contents of the live database?')
+def backup_restore(path):
+    """Verify snapshot PATH and copy it over the live database."""
+    try:
+        safety = backup.restore_backup(path)
+    except backup.BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'restored {path}; previous contents saved to {safety}')
+
+
+@popularity_cli.command('sweep')
+def popularity_sweep():
+    """Count the proposals whose date has passed (also done on the first request of a day)."""
+    click.echo(f'counted {popularity.sweep()} proposal(s)')
+
+
+@popularity_cli.command('reconcile')
+def popularity_reconcile():
+    """Recompute the popularity counters of all recipes from the proposals."""
+    proposals, recipes = popularity.reconcile()
+    click.echo(f'fixed {proposals} proposal flag(s) and {recipes} recipe(s)')
+
+
+@commitments_cli.command('rebuild')
+def commitments_rebuild():
+    """Recreate the commitment index from participants and cook/grocery claims."""
+    click.echo(f'{commitments.rebuild()} commitment(s)')
+
+
+@avatars_cli.command('backfill')
+@click.option('--force', is_flag=True, help='Recreate renditions that already exist.')
+def avatars_backfill(force):
+    """Create the small square renditions for existing avatars."""
+    created, failed = avatars.backfill(force)
+    click.echo(f'created renditions for {created} avatar(s), {failed} failed')
+
+
+
+@storage_cli.command('migrate')
+@click.argument('source', type=click.Choice(storage.BACKENDS))
+@click.argument('dest', type=click.Choice(storage.BACKENDS))
+@click.option('--workers', default=8, show_default=True, help='Files copied in parallel.')
+@click.option('--overwrite', is_flag=True, help='Copy files that already exist in DEST again.')
+def storage_migrate(source, dest, workers, overwrite):
+    """Copy all uploads from the SOURCE backend to DEST (SOURCE is left as it is).
+
+    Both backends are configured by the usual settings (UPLOAD_FOLDER, STORAGE_S3_*);
+    switch STORAGE_BACKEND to DEST afterwards.
+    """
+    if source == dest:
+        raise click.BadParameter('SOURCE and DEST are the same backend')
+    try:
+        src, dst = storage.make_storage(source), storage.make_storage(dest)
+    except storage.StorageError as e:
+        raise click.ClickException(str(e))
+    copied, skipped, failed = storage.migrate(src, dst, workers, overwrite)
+    click.echo(f'copied {len(copied)} file(s), skipped {len(skipped)} already present')
+    if failed:
+        raise click.ClickException(f"{len(failed)} file(s) failed: {', '.join(sorted(failed)[:10])}")
+
+
+@assets_cli.command('build')
+def assets_build():
+    """Minify and content-hash the CSS/JS bundles into static/dist and write the manifest."""
+    for name, path in sorted(assets.build().items()):
+        click.echo(f'{name:<14} {path}')
+
+
+@assets_cli.command('compress')
+def assets_compress():
+    """Write .gz (and with brotli installed .br) variants of the static CSS/JS/SVG/JSON files."""
+    written, skipped = compression.precompress_static()
+    click.echo(f"wrote {written} compressed file(s) ({', '.join(compression.encodings())}), "
+               f"skipped {skipped} too small to gain")
+
+
+@templates_cli.command('compile')
+@click.option('--clear', is_flag=True, help='Drop the bytecode cache first, e.g. after a Jinja upgrade.')
+def templates_compile(clear):
+    """Compile all templates into TEMPLATE_CACHE_DIR, ahead of starting the workers."""
+    app = current_app._get_current_object()
+    if app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('the template bytecode cache is disabled (TEMPLATE_BYTECODE_CACHE)')
+    # create_app() has warmed up already: load again, through the bytecode cache
+    template_cache.clear(app, bytecode=clear)
+    count, seconds = template_cache.warm_up(app)
+    click.echo(f"compiled {count} template(s) in {seconds * 1000:.0f} ms into {app.config['TEMPLATE_CACHE_DIR']}")
+
+
+def register_commands(app):
+    app.cli.add_command(digests_cli)
+    app.cli.add_command(backup_cli)
+    app.cli.add_command(popularity_cli)
+    app.cli.add_command(commitments_cli)
+    app.cli.add_command(avatars_cli)
+    app.cli.add_command(storage_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(templates_cli)
+    app.cli.add_command(export_command)
@@ -0,0 +1,55 @@
+"""Per-user index of upcoming commitments (joined, cooking, grocery shopping).
+
+"Your commitments" used to be an OR over participant, cook and grocery user
+with a DISTINCT over the whole history. The ``commitment`` table keeps one
+row per (user, proposal, role) with a copy of the proposal date, so the list
+is a range scan over ``ix_commitment_user_date``. The proposal handlers call
+``add``/``remove`` next to the change they make; rows of deleted proposals go
+with the proposal (ORM cascade). ``rebuild`` recreates the table from the
+proposals (``flask commitments rebuild``).
+"""
+from sqlalchemy import delete, insert, literal, select, union
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from . import db
+from .models import Commitment, Participant, Proposal
+
+ROLES = ('participant', 'cook', 'grocery')
+
+
+def add(user_id, p, role):
+    # the unique index turns a repeated add into a no-op
+    db.session.execute(sqlite_insert(Commitment).values(user_id=user_id, proposal_id=p.id, role=role, date=p.date)
+                       .on_conflict_do_nothing())
+
+
+def remove(user_id, proposal_id, role):
+    db.session.execute(delete(Commitment).where(Commitment.user_id == user_id, Commitment.proposal_id == proposal_id,
+                                                Commitment.role == role))
+
+
+def remove_user(user_id):
+    db.session.execute(delete(Commitment).where(Commitment.user_id == user_id))
+
+
+def upcoming_proposals(user_id, today, options=()):
+    """Proposals from ``today`` on in which ``user_id`` has any role, by date and start time."""
+    ids = select(Commitment.proposal_id).where(Commitment.user_id == user_id, Commitment.date >= today)
+    return (Proposal.query.options(*options).filter(Proposal.id.in_(ids))
+            .order_by(Proposal.date.asc(), Proposal.start_time.asc(), Proposal.id).all())
+
+
+def rebuild():
+    """Recreate all commitment rows from participants and cook/grocery claims; return the row count."""
+    rows = union(
+        select(Participant.user_id, Participant.proposal_id, literal('participant'), Proposal.date)
+        .join(Proposal, Proposal.id == Participant.proposal_id),
+        select(Proposal.cook_user_id, Proposal.id, literal('cook'), Proposal.date)
+        .where(Proposal.cook_user_id.isnot(None)),
+        select(Proposal.grocery_user_id, Proposal.id, literal('grocery'), Proposal.date)
+        .where(Proposal.grocery_user_id.isnot(None)),
+    )
+    db.session.execute(delete(Commitment))
+    db.session.execute(insert(Commitment).from_select(['user_id', 'proposal_id', 'role', 'date'], rows))
+    db.session.commit()
+    return db.session.query(Commitment).count()
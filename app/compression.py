@@ -0,0 +1,176 @@
+"""gzip / brotli compression of responses and precompressed static files.
+
+Dynamic responses (HTML, JSON, ...) whose type is in ``COMPRESS_MIMETYPES``
+and whose body is at least ``COMPRESS_MIN_SIZE`` bytes are compressed in an
+``after_request`` hook with the best encoding the client accepts: brotli if
+the optional ``brotli`` package is installed, otherwise gzip. Streamed
+responses (the JSON API) are compressed chunk by chunk. A compressed body is
+a different representation, so its ETag becomes weak and ``Vary:
+Accept-Encoding`` is set; ``not_modified()`` compares weakly.
+
+Static files are not compressed per request: ``flask assets compress``
+writes ``.gz`` (and ``.br``) files next to the CSS, JS, SVG and manifest
+files, and the static route sends them to clients that accept them. With
+``FILE_DELIVERY = 'x-accel'`` nginx does this itself (``gzip_static``).
+"""
+import gzip
+import mimetypes
+import os
+import zlib
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+STATIC_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.webmanifest', '.txt')
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_MIMETYPES', {
+        'text/html', 'text/css', 'text/plain', 'text/csv', 'text/calendar', 'text/javascript',
+        'application/javascript', 'application/json', 'application/manifest+json', 'image/svg+xml',
+    })
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BR_QUALITY', 5)
+    if app.config['COMPRESS_ENABLED']:
+        app.after_request(_compress)
+        if app.config.get('FILE_DELIVERY') != 'x-accel':
+            app.view_functions['static'] = _static
+
+
+def encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate():
+    """The encoding to use for this request, or None for identity."""
+    return request.accept_encodings.best_match(encodings())
+
+
+def compress(data, encoding):
+    cfg = current_app.config
+    if encoding == 'br':
+        return brotli.compress(data, quality=cfg['COMPRESS_BR_QUALITY'])
+    return gzip.compress(data, compresslevel=cfg['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+
+def _compressor(encoding):
+    # (write, finish) of an incremental compressor; created while the app context is still there
+    cfg = current_app.config
+    if encoding == 'br':
+        comp = brotli.Compressor(quality=cfg['COMPRESS_BR_QUALITY'])
+        return comp.process, comp.finish
+    # wbits 31: gzip container
+    comp = zlib.compressobj(cfg['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+    return comp.compress, comp.flush
+
+
+def _compressed_chunks(chunks, write, finish):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            out = write(chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        # lets stream_with_context() pop its request context
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _compressible(response):
+    cfg = current_app.config
+    return (response.status_code in (200, 201)
+            and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers
+            and response.mimetype in cfg['COMPRESS_MIMETYPES'])
+
+
+def _compress(response):
+    if request.method == 'HEAD' or not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compressed_chunks(response.response, *_compressor(encoding))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _static(filename):
+    app = current_app
+    if filename.endswith(STATIC_EXTENSIONS):
+        encoding = negotiate()
+        path = os.path.join(app.static_folder, filename)
+        if encoding and os.path.isfile(path):
+            variant = path + SUFFIXES[encoding]
+            # a stale variant (the source changed after `flask assets compress`) is ignored
+            if os.path.isfile(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+                response = send_from_directory(app.static_folder, filename + SUFFIXES[encoding],
+                                               mimetype=mimetypes.guess_type(filename)[0],
+                                               max_age=app.get_send_file_max_age(filename))
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+    response = app.send_static_file(filename)
+    if filename.endswith(STATIC_EXTENSIONS):
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def precompress_static(folder=None, min_size=None):
+    """Write .gz/.br variants of the static text files; return (written, skipped) counts.
+
+    Variants that would not be smaller than the file are removed instead.
+    """
+    folder = folder or current_app.static_folder
+    min_size = current_app.config['COMPRESS_MIN_SIZE'] if min_size is None else min_size
+    uploads = os.path.abspath(current_app.config['UPLOAD_FOLDER'])
+    written = skipped = 0
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) != uploads]
+        for name in filenames:
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding in encodings():
+                variant = path + SUFFIXES[encoding]
+                if len(data) < min_size:
+                    out = None
+                elif encoding == 'br':
+                    out = brotli.compress(data, quality=11)
+                else:
+                    out = gzip.compress(data, compresslevel=9, mtime=0)
+                if out is None or len(out) >= len(data):
+                    if os.path.exists(variant):
+                        os.remove(variant)
+                    skipped += 1
+                    continue
+                # per process: several workers may build and precompress the bundles at once
+                tmp = f'{variant}.{os.getpid()}.part'
+                with open(tmp, 'wb') as f:
+                    f.write(out)
+                os.replace(tmp, variant)
+                written += 1
+    return written, skipped
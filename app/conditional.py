@@ -0,0 +1,76 @@
+"""Conditional GET support (ETag / Last-Modified) for rendered pages.
+
+Views compute a cheap version stamp from the rows a page shows (ids, counts,
+``updated_at`` values), call ``not_modified()`` before rendering and return its
+304 response when the client's copy is current; otherwise they render and pass
+the response through ``with_validators()``.
+"""
+import hashlib
+import os
+from datetime import timezone
+
+from flask import current_app, g, request, session
+from flask_login import current_user
+
+
+def init_app(app):
+    # changes to templates or code must change every ETag; derive the salt from file mtimes
+    app.config.setdefault('ETAG_SALT', _source_fingerprint(app))
+
+
+def _source_fingerprint(app):
+    paths = [os.path.join(app.root_path, n) for n in os.listdir(app.root_path) if n.endswith('.py')]
+    # pages link the CSS/JS bundles by content hash, so their sources count too
+    for folder in (app.template_folder, os.path.join(app.static_folder, 'css'), os.path.join(app.static_folder, 'js')):
+        for dirpath, _, filenames in os.walk(os.path.join(app.root_path, folder)):
+            paths.extend(os.path.join(dirpath, n) for n in filenames)
+    return str(max(os.path.getmtime(p) for p in paths))
+
+
+def page_etag(*parts):
+    """ETag for a page built from ``parts`` plus everything base.html renders per user."""
+    user = (current_user.id, current_user.is_admin) if current_user.is_authenticated else None
+    mail = None
+    if user and current_user.is_admin:
+        cfg = g.get('mail_cfg')
+        mail = (g.get('mail_ok'), cfg.updated_at, cfg.mail_notifications_enabled) if cfg else False
+    raw = repr((current_app.config['ETAG_SALT'], request.endpoint, user, mail) + parts)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _http_date(dt):
+    # HTTP dates have second resolution and our timestamps are naive UTC
+    return dt.replace(microsecond=0, tzinfo=timezone.utc) if dt else None
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response if the client's cached copy is current, else None."""
+    # pending flash messages are rendered into the page: neither answer 304 nor
+    # hand out a validator for a page that will show them
+    g.skip_validators = bool(session.get('_flashes'))
+    if g.skip_validators:
+        return None
+    last_modified = _http_date(last_modified)
+    if request.if_none_match:
+        # weak comparison: compression turns the ETag of a page into a weak one
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    response = current_app.response_class(status=304)
+    return with_validators(response, etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    """Attach ETag / Last-Modified and require revalidation on every use."""
+    if g.get('skip_validators'):
+        return response
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = _http_date(last_modified)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
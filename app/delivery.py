@@ -0,0 +1,83 @@
+"""Hand the delivery of static files and uploads to the front proxy.
+
+With ``FILE_DELIVERY = 'app'`` (default) a worker reads and streams every
+file itself. The other modes answer with a header and an empty body, and the
+proxy sends the file with sendfile():
+
+* ``'x-sendfile'``: ``X-Sendfile: <absolute path>`` (Apache mod_xsendfile,
+  lighttpd); this is Flask's ``USE_X_SENDFILE``.
+* ``'x-accel'``: ``X-Accel-Redirect: <internal URI>`` (nginx). Paths under the
+  static folder are mapped to ``X_ACCEL_STATIC_LOCATION``, uploads to
+  ``X_ACCEL_UPLOADS_LOCATION``; both must be ``internal`` locations of the
+  proxy (see the sample in install_daemon.sh). Files outside both (e.g.
+  profiler downloads) are still sent by the worker.
+
+Conditional requests are answered by the app before the hand-over, so a 304
+never involves the proxy. Access checks keep working because the app decides
+first: with ``UPLOADS_PRIVATE`` uploads are only served through the
+login-protected ``/media/<name>`` route, and ``/static/uploads`` is refused.
+"""
+import os
+from urllib.parse import quote
+
+from flask import abort, current_app, request
+from werkzeug.wsgi import wrap_file
+
+MODES = ('app', 'x-sendfile', 'x-accel')
+
+
+def init_app(app):
+    app.config.setdefault('FILE_DELIVERY', 'app')
+    app.config.setdefault('X_ACCEL_STATIC_LOCATION', '/_ccm/static/')
+    app.config.setdefault('X_ACCEL_UPLOADS_LOCATION', '/_ccm/uploads/')
+    mode = app.config['FILE_DELIVERY']
+    if mode not in MODES:
+        raise ValueError(f'FILE_DELIVERY must be one of {", ".join(MODES)}, not {mode!r}')
+    if mode != 'app':
+        # send_file() then sets X-Sendfile instead of opening the file
+        app.config['USE_X_SENDFILE'] = True
+        app.after_request(_hand_over)
+    app.before_request(_private_static_uploads)
+
+
+def _private_static_uploads():
+    if (current_app.config.get('UPLOADS_PRIVATE') and request.endpoint == 'static'
+            and (request.view_args or {}).get('filename', '').startswith('uploads/')):
+        abort(404)
+
+
+def _locations():
+    cfg = current_app.config
+    # most specific first: the default upload folder lies inside the static folder
+    return ((os.path.abspath(cfg['UPLOAD_FOLDER']), cfg['X_ACCEL_UPLOADS_LOCATION']),
+            (os.path.abspath(current_app.static_folder), cfg['X_ACCEL_STATIC_LOCATION']))
+
+
+def internal_uri(path):
+    """The X-Accel-Redirect URI of the local file ``path``, or None if no proxy location covers it."""
+    path = os.path.abspath(path)
+    for root, location in _locations():
+        if path.startswith(root + os.sep):
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            return location.rstrip('/') + '/' + quote(rel)
+    return None
+
+
+def _hand_over(response):
+    path = response.headers.get('X-Sendfile')
+    if path is None:
+        return response
+    if response.status_code == 304:
+        # nothing to send; the proxy must not turn this into a 200
+        del response.headers['X-Sendfile']
+        return response
+    if current_app.config['FILE_DELIVERY'] == 'x-sendfile':
+        return response
+    del response.headers['X-Sendfile']
+    uri = internal_uri(path)
+    if uri is not None:
+        response.headers['X-Accel-Redirect'] = uri
+    else:
+        # not below a location the proxy knows: send it from here after all
+        response.response = wrap_file(request.environ, open(path, 'rb'))
+    return response
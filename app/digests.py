@@ -0,0 +1,170 @@
+"""Hourly / daily digest delivery of proposal notifications.
+
+Users whose ``notify_digest`` is ``'hourly'`` or ``'daily'`` do not get one
+email per proposal event. ``queue_event()`` stores the event as a
+``PendingNotification`` row instead, and ``send_due_digests()`` later renders
+all pending events of a user, grouped by proposal, into a single email.
+
+A user's digest is due once they have an event older than the last boundary
+of their mode: the last full hour, or the last ``DIGEST_DAILY_HOUR`` o'clock
+(server local time) for daily digests. Events of users who switched back to
+immediate delivery are flushed on the next run.
+
+Digests are sent by ``flask digests send`` (cron) or by the scheduler thread
+that run.py starts. Several workers may run at once: a worker first claims
+exactly the rows it rendered (``claimed_at``), sends the digest and deletes
+them only once the mail went out, so every event is mailed once. If sending
+fails, the claim is released and the events go out with the next run; the
+claims of a worker that died while sending expire after
+``DIGEST_CLAIM_SECONDS``. While mail is switched off, due events are dropped,
+as immediate notifications are.
+"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import insert, update
+
+from . import db
+from .mailer import NAME, UNSUBSCRIBE, mail_enabled, render_mail, send_personalized, site_host
+from .models import PendingNotification, User
+
+DIGEST_MODES = ('immediate', 'hourly', 'daily')
+
+
+def init_app(app):
+    app.config.setdefault('DIGEST_DAILY_HOUR', 7)
+    app.config.setdefault('DIGEST_POLL_SECONDS', 300)
+    app.config.setdefault('DIGEST_SCHEDULER_ENABLED', True)
+    # far longer than sending one mail takes
+    app.config.setdefault('DIGEST_CLAIM_SECONDS', 900)
+
+
+def digest_mode(user):
+    return user.notify_digest if user.notify_digest in DIGEST_MODES else 'immediate'
+
+
+def queue_event(proposal, action, actor, users, extra_text=None):
+    """Queue a proposal event for the next digest of each of ``users``."""
+    event = {'proposal_id': proposal.id, 'proposal_title': proposal.recipe.title, 'proposal_date': proposal.date,
+             'actor': actor, 'action': action, 'extra_text': extra_text}
+    # one executemany instead of one INSERT per ORM object
+    db.session.execute(insert(PendingNotification), [dict(event, user_id=u.id) for u in users])
+    db.session.commit()
+
+
+def _boundary(mode, now):
+    """Events created before the returned (naive UTC) time make a digest due."""
+    if mode == 'hourly':
+        return now.replace(minute=0, second=0, microsecond=0)
+    if mode == 'daily':
+        local = now.replace(tzinfo=timezone.utc).astimezone()
+        b = local.replace(hour=current_app.config['DIGEST_DAILY_HOUR'], minute=0, second=0, microsecond=0)
+        if b > local:
+            b -= timedelta(days=1)
+        return b.astimezone(timezone.utc).replace(tzinfo=None)
+    return now + timedelta(seconds=1)
+
+
+def send_due_digests(now=None, force=False):
+    """Send every due digest (all pending ones with ``force``); return the number sent."""
+    now = now or datetime.utcnow()
+    sent = 0
+    for mode in DIGEST_MODES:
+        q = db.session.query(PendingNotification.user_id).join(User, User.id == PendingNotification.user_id)
+        if mode == 'immediate':
+            q = q.filter(db.or_(User.notify_digest == None, User.notify_digest.notin_(DIGEST_MODES[1:])))
+        else:
+            q = q.filter(User.notify_digest == mode)
+        if not force:
+            q = q.filter(PendingNotification.created_at < _boundary(mode, now))
+        q = q.filter(_unclaimed(now))
+        for (user_id,) in q.distinct().all():
+            if send_user_digest(user_id, now):
+                sent += 1
+    return sent
+
+
+def _unclaimed(now):
+    expired = now - timedelta(seconds=current_app.config['DIGEST_CLAIM_SECONDS'])
+    return db.or_(PendingNotification.claimed_at == None, PendingNotification.claimed_at < expired)
+
+
+def send_user_digest(user_id, now=None):
+    """Render and send all pending events of one user; False if nothing was sent."""
+    now = now or datetime.utcnow()
+    rows = (PendingNotification.query.filter(PendingNotification.user_id == user_id, _unclaimed(now))
+            .order_by(PendingNotification.created_at, PendingNotification.id).all())
+    if not rows:
+        return False
+    ids = PendingNotification.id.in_([r.id for r in rows])
+    user = db.session.get(User, user_id)
+    if not user or not user.email or not mail_enabled():
+        PendingNotification.query.filter(ids).delete(synchronize_session=False)
+        db.session.commit()
+        return False
+    body = _render(rows)
+    # claim the rows: a worker that got to some of them first sends the digest
+    claimed = db.session.execute(update(PendingNotification).where(ids, _unclaimed(now)).values(claimed_at=now)
+                                 .execution_options(synchronize_session=False)).rowcount
+    if claimed != len(rows):
+        db.session.rollback()
+        return False
+    db.session.commit()
+    sent = send_personalized(body, [user]) == 1
+    mine = PendingNotification.query.filter(ids, PendingNotification.claimed_at == now)
+    if sent:
+        mine.delete(synchronize_session=False)
+    else:
+        # retried by the next run
+        mine.update({'claimed_at': None}, synchronize_session=False)
+    db.session.commit()
+    return sent
+
+
+def _render(rows):
+    host = site_host()
+    groups = []
+    by_key = {}
+    for r in rows:
+        key = (r.proposal_id, r.proposal_title, r.proposal_date)
+        if key not in by_key:
+            by_key[key] = {'title': r.proposal_title, 'short_date': r.proposal_date.strftime('%d.%m'),
+                           'url': f'{host}/proposal/{r.proposal_id}/discuss' if r.proposal_id else None,
+                           'events': []}
+            groups.append(by_key[key])
+        by_key[key]['events'].append(r)
+
+    subject = f"CCM digest: {len(rows)} update{'s' if len(rows) != 1 else ''} on {len(groups)} meal{'s' if len(groups) != 1 else ''}"
+    text_lines = [f'Hello {NAME},', '']
+    for grp in groups:
+        text_lines.append(f"{grp['title']} | {grp['short_date']}")
+        for e in grp['events']:
+            text_lines.append(f"  {e.created_at.strftime('%H:%M')} {e.actor} {e.action}" + (f': {e.extra_text}' if e.extra_text else ''))
+        if grp['url']:
+            text_lines.append(f"  {grp['url']}")
+        text_lines.append('')
+    text_lines.extend(['Best regards,', 'Cleverly Connected Meals (CCM)', '', f'Unsubscribe: {UNSUBSCRIBE}'])
+    return render_mail('email/digest_email.html', subject, '\n'.join(text_lines), 'meals', groups=groups, host=host)
+
+
+def start_scheduler(app):
+    """Start a daemon thread that sends due digests every ``DIGEST_POLL_SECONDS``."""
+    if not app.config['DIGEST_SCHEDULER_ENABLED']:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(app.config['DIGEST_POLL_SECONDS'])
+            with app.app_context():
+                try:
+                    send_due_digests()
+                except Exception:
+                    app.logger.exception('Sending notification digests failed')
+                finally:
+                    db.session.remove()
+
+    t = threading.Thread(target=loop, name='ccm-digests', daemon=True)
+    t.start()
+    return t
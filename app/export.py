@@ -0,0 +1,76 @@
+"""Streaming export of the meal history (proposals, participants, recipes, messages).
+
+Rows are read with ``yield_per`` (a streaming cursor) and turned into CSV or
+JSON text in batches, optionally gzip-compressed on the fly, so memory use
+does not depend on the size of the history. Used by the admin export
+endpoint and ``flask export``.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, time
+
+from sqlalchemy import select
+
+from . import db
+from .models import Message, Participant, Proposal, Recipe
+
+TABLES = {
+    'proposals': Proposal,
+    'participants': Participant,
+    'recipes': Recipe,
+    'messages': Message,
+}
+FORMATS = ('csv', 'json')
+BATCH_ROWS = 1000
+
+
+def _value(v):
+    if isinstance(v, (date, datetime, time)):
+        return v.isoformat()
+    return v
+
+
+def _batches(table):
+    model = TABLES[table]
+    columns = list(model.__table__.columns)
+    result = db.session.execute(select(*columns).order_by(model.id).execution_options(yield_per=BATCH_ROWS))
+    for rows in result.partitions():
+        yield [[_value(v) for v in row] for row in rows]
+
+
+def iter_export(table, fmt):
+    """Yield the export of ``table`` as text chunks in format ``fmt``."""
+    names = [c.name for c in TABLES[table].__table__.columns]
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(names)
+        yield buf.getvalue()
+        for rows in _batches(table):
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows(rows)
+            yield buf.getvalue()
+    else:
+        yield '['
+        sep = '\n'
+        for rows in _batches(table):
+            yield sep + ',\n'.join(json.dumps(dict(zip(names, row)), ensure_ascii=False) for row in rows)
+            sep = ',\n'
+        yield '\n]\n'
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of text chunks, yielding compressed bytes."""
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = z.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield z.flush()
+
+
+def export_filename(table, fmt, compress):
+    return f"ccm-{table}-{date.today().isoformat()}.{fmt}" + ('.gz' if compress else '')
@@ -0,0 +1,101 @@
+"""In-process LRU cache for rendered calendar day cells.
+
+Each calendar day column is cached as a list of cells holding the
+pre-rendered, user-independent HTML of a proposal card (recipe, proposer,
+start time) plus the ids needed to render the per-user controls (proposer
+and participant ids). Keys are ``(iso_year, iso_week, iso_weekday,
+version)``, where the version of a day is read from the database by
+``day_versions()``: the number and highest id of its proposals and
+participants, and the newest ``updated_at`` of its proposals and their
+recipes. Every change of a cell changes one of these (joins, claims and
+start times bump the proposal's ``updated_at``, recipe edits the recipe's),
+so every worker process finds the current cells under the current key
+without being told about the change; stale entries simply age out of the
+LRU.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from . import db
+from .models import Participant, Proposal, Recipe
+
+
+class LRUCache:
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[0] is not None and item[0] < time.monotonic()):
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CalendarFragments:
+    def __init__(self, maxsize):
+        self.cache = LRUCache(maxsize)
+
+    def key(self, d, version):
+        iso = d.isocalendar()
+        return (iso[0], iso[1], iso[2], version)
+
+    def lookup(self, d, version):
+        """Return (key, cells); cells is None on a miss. Store a freshly loaded day under the returned key."""
+        key = self.key(d, version)
+        return key, self.cache.get(key)
+
+    def store(self, key, cells):
+        self.cache.set(key, cells)
+
+
+def init_app(app):
+    app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 512)
+    app.extensions['ccm_calendar_fragments'] = CalendarFragments(app.config['FRAGMENT_CACHE_SIZE'])
+
+
+def calendar_fragments():
+    """The app's CalendarFragments, or None when the cache is disabled."""
+    if not current_app.config['FRAGMENT_CACHE_ENABLED']:
+        return None
+    return current_app.extensions['ccm_calendar_fragments']
+
+
+def day_versions(days):
+    """{day: version} of the calendar ``days``, in one query; days without proposals are missing."""
+    rows = db.session.execute(
+        select(Proposal.date, func.count(func.distinct(Proposal.id)), func.max(Proposal.id),
+               func.max(Proposal.updated_at), func.max(Recipe.updated_at),
+               func.count(Participant.id), func.max(Participant.id))
+        .join(Recipe, Recipe.id == Proposal.recipe_id)
+        .outerjoin(Participant, Participant.proposal_id == Proposal.id)
+        .where(Proposal.date.in_(list(days)))
+        .group_by(Proposal.date))
+    return {row[0]: tuple(row[1:]) for row in rows}
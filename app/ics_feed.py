@@ -0,0 +1,162 @@
+"""Per-user iCalendar subscription feed of the meals a user joined, cooks or shops for.
+
+Every user can create a secret feed URL on their profile
+(``/calendar/feed/<token>.ics``); the token is the only credential, so
+calendar apps can poll it without logging in, and creating a new one revokes
+the old URL. The feed lists the proposals of the commitment index (see
+app/commitments.py) from ``CALENDAR_FEED_PAST_DAYS`` days ago on.
+
+Calendar apps poll such feeds every few minutes, so a poll is kept to two
+indexed queries: the token lookup and ``version()``, an aggregate over the
+user's commitment rows and the ``updated_at`` of their proposals and
+recipes. The feed is cached per (user, version) and its ETag is a hash of
+the body, so an unchanged feed is answered with 304 without rendering.
+When the version changes, only the events of changed proposals are
+rendered again; the others come from the event cache. Every worker
+derives the version from the database, so there is nothing to invalidate
+across processes. A change that does not alter the feed (a message, another
+user joining) gets it rendered again but keeps its ETag, so clients still get
+304.
+"""
+import hashlib
+import secrets
+from datetime import date, datetime, timedelta
+
+from flask import current_app, request, url_for
+from sqlalchemy import func, select
+
+from . import db
+from .fragment_cache import LRUCache
+from .models import Commitment, Proposal, Recipe, User
+
+# SUMMARY prefix per role; participating is implied by the duties
+ROLE_LABELS = {'cook': 'Cooking', 'grocery': 'Groceries'}
+PRODID = '-//Cleverly Connected Meals//Calendar feed//EN'
+
+
+def init_app(app):
+    app.config.setdefault('CALENDAR_FEED_PAST_DAYS', 30)
+    # suggested polling interval for calendar apps
+    app.config.setdefault('CALENDAR_FEED_REFRESH_MINUTES', 60)
+    # length of events with a start time (the others are all-day events)
+    app.config.setdefault('CALENDAR_FEED_EVENT_MINUTES', 60)
+    app.config.setdefault('CALENDAR_FEED_CACHE_SIZE', 1024)
+    size = app.config['CALENDAR_FEED_CACHE_SIZE']
+    app.extensions['ccm_calendar_feed'] = {'feeds': LRUCache(size), 'events': LRUCache(size * 8)}
+
+
+def new_token(user):
+    """Give ``user`` a new feed token, revoking the previous URL. The caller commits."""
+    user.calendar_token = secrets.token_urlsafe(24)
+    return user.calendar_token
+
+
+def user_for_token(token):
+    return User.query.filter_by(calendar_token=token).first() if token else None
+
+
+def window_start(today=None):
+    return (today or date.today()) - timedelta(days=current_app.config['CALENDAR_FEED_PAST_DAYS'])
+
+
+def version(user_id, start):
+    """Stamp of everything the feed of ``user_id`` from ``start`` on shows.
+
+    Joining, leaving and claiming add or remove commitment rows (count, max
+    id); any change of a listed proposal or recipe bumps its ``updated_at``.
+    """
+    row = db.session.execute(
+        select(func.count(Commitment.id), func.max(Commitment.id), func.sum(Commitment.proposal_id),
+               func.max(Proposal.updated_at), func.max(Recipe.updated_at))
+        .join(Proposal, Proposal.id == Commitment.proposal_id)
+        .join(Recipe, Recipe.id == Proposal.recipe_id)
+        .where(Commitment.user_id == user_id, Commitment.date >= start)).one()
+    return tuple(row)
+
+
+def feed(user):
+    """Return (etag, body) of the feed of ``user``."""
+    state = current_app.extensions['ccm_calendar_feed']
+    start = window_start()
+    key = (user.id, user.username, request.host, start) + version(user.id, start)
+    cached = state['feeds'].get(key)
+    if cached is None:
+        body = render(user, start, state['events'])
+        cached = (hashlib.sha1(body).hexdigest(), body)
+        state['feeds'].set(key, cached)
+    return cached
+
+
+def render(user, start, events=None):
+    """The feed of ``user`` as bytes; ``events`` caches the text of unchanged events."""
+    cfg = current_app.config
+    rows = db.session.execute(
+        select(Proposal.id, Proposal.date, Proposal.start_time, Proposal.created_at, Proposal.updated_at,
+               Recipe.title, Recipe.updated_at, Commitment.role)
+        .join(Proposal, Proposal.id == Commitment.proposal_id)
+        .join(Recipe, Recipe.id == Proposal.recipe_id)
+        .where(Commitment.user_id == user.id, Commitment.date >= start)
+        .order_by(Proposal.date, Proposal.start_time, Proposal.id)).all()
+    # one event per proposal, whatever the number of roles
+    proposals = {}
+    for pid, d, start_time, created, updated, title, recipe_updated, role in rows:
+        entry = proposals.setdefault(pid, [d, start_time, created, updated, title, recipe_updated, set()])
+        entry[6].add(role)
+
+    refresh = f"PT{cfg['CALENDAR_FEED_REFRESH_MINUTES']}M"
+    parts = [_lines('BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+                    f'X-WR-CALNAME:{_escape("Meals of " + user.username)}',
+                    f'REFRESH-INTERVAL;VALUE=DURATION:{refresh}', f'X-PUBLISHED-TTL:{refresh}')]
+    for pid, (d, start_time, created, updated, title, recipe_updated, roles) in proposals.items():
+        roles = tuple(sorted(roles))
+        key = (pid, roles, updated, recipe_updated, request.host)
+        text = events.get(key) if events is not None else None
+        if text is None:
+            text = _event(pid, d, start_time, created, title, roles)
+            if events is not None:
+                events.set(key, text)
+        parts.append(text)
+    parts.append(_lines('END:VCALENDAR'))
+    return ''.join(parts).encode('utf-8')
+
+
+def _event(pid, d, start_time, created, title, roles):
+    labels = [ROLE_LABELS[r] for r in roles if r in ROLE_LABELS]
+    summary = f"{' + '.join(labels) or 'Lunch'}: {title}"
+    if start_time is not None:
+        begin = datetime.combine(d, start_time)
+        end = begin + timedelta(minutes=current_app.config['CALENDAR_FEED_EVENT_MINUTES'])
+        # floating local time, as the site shows start times
+        when = (f'DTSTART:{begin:%Y%m%dT%H%M%S}', f'DTEND:{end:%Y%m%dT%H%M%S}')
+    else:
+        when = (f'DTSTART;VALUE=DATE:{d:%Y%m%d}', f'DTEND;VALUE=DATE:{d + timedelta(days=1):%Y%m%d}')
+    url = url_for('main.proposal_discuss', proposal_id=pid, _external=True)
+    # not updated_at: messages and other people joining do not change the event, and must not change
+    # the feed's ETag either (created_at is naive UTC)
+    stamp = f'{created or datetime.utcnow():%Y%m%dT%H%M%SZ}'
+    return _lines('BEGIN:VEVENT', f'UID:proposal-{pid}@{request.host}', f'DTSTAMP:{stamp}',
+                  *when, f'SUMMARY:{_escape(summary)}',
+                  f'DESCRIPTION:{_escape(f"{summary}. Discussion: {url}")}', f'URL:{url}', 'END:VEVENT')
+
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    # content lines are at most 75 octets; continuation lines start with a space
+    out, chunk, size = [], '', 0
+    for ch in line:
+        n = len(ch.encode('utf-8'))
+        if size + n > 75:
+            out.append(chunk)
+            chunk, size = ' ', 1
+        chunk += ch
+        size += n
+    out.append(chunk)
+    return '\r\n'.join(out)
+
+
+def _lines(*lines):
+    return ''.join(_fold(line) + '\r\n' for line in lines)
@@ -0,0 +1,64 @@
+"""Memory-bounded decoding of uploaded images.
+
+Uploads are limited to ``MAX_CONTENT_LENGTH`` bytes (Flask answers 413) and
+``IMAGE_MAX_PIXELS`` pixels; the pixel count is read from the image header,
+so an oversized image or a decompression bomb is refused before anything is
+decoded. JPEGs are decoded with Pillow's draft mode at the smallest DCT
+scale (1/2, 1/4 or 1/8) that still covers the target size, so a 50 MP photo
+never exists as a full-resolution bitmap. Werkzeug already spools uploads
+larger than 500 KB to a temporary file, and the compressed result goes to
+disk through the upload storage (``app/storage.py``), not through memory.
+"""
+from flask import current_app, flash, redirect, request, url_for
+from PIL import Image
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def init_app(app):
+    app.config.setdefault('MAX_CONTENT_LENGTH', 16 * 1024 * 1024)
+    app.config.setdefault('IMAGE_MAX_PIXELS', 64_000_000)
+    app.register_error_handler(413, _too_large)
+
+
+def _too_large(e):
+    limit = request.max_content_length or 0
+    message = f'Upload too large (at most {limit // (1024 * 1024)} MB)'
+    if request.blueprint == 'api' or request.is_json:
+        return {'status': 'error', 'message': message}, 413
+    flash(message, 'warning')
+    return redirect(request.referrer or url_for('main.index'))
+
+
+def fitted_size(size, max_size, cover=False):
+    """Size of an image of ``size`` scaled down (never up) to fit into ``max_size``,
+    or with ``cover`` to cover it (for cropping)."""
+    pick = max if cover else min
+    scale = min(pick(max_size[0] / size[0], max_size[1] / size[1]), 1)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def open_image(src, max_size, max_pixels=None, cover=False):
+    """Open ``src`` (a path or file object) for scaling down into ``max_size``.
+
+    Raises ``ImageTooLarge`` when the image has more than ``max_pixels``
+    (default: ``IMAGE_MAX_PIXELS``) pixels and lets Pillow's errors through
+    for anything that is not an image. JPEGs come back in draft mode, so
+    loading them decodes only about ``max_size`` pixels (``cover``: enough to
+    cover ``max_size`` when cropping).
+    """
+    if max_pixels is None:
+        max_pixels = current_app.config['IMAGE_MAX_PIXELS']
+    try:
+        img = Image.open(src)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    if img.width * img.height > max_pixels:
+        img.close()
+        raise ImageTooLarge(f'{img.width}x{img.height} pixels exceed the limit of {max_pixels}')
+    # no-op for formats without reduced decoding
+    img.draft(None, fitted_size(img.size, max_size, cover))
+    return img
+
@@ -0,0 +1,115 @@
+"""Per-request SQL instrumentation.
+
+Counts the statements and database time of each request by listening to
+SQLAlchemy engine events, logs slow statements together with the route that
+issued them and reports the totals in a ``Server-Timing`` response header.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, current_app
+from sqlalchemy import event
+
+# counters opened with count_queries() on the current thread
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised (in strict mode) when a route issues more statements than its budget."""
+
+
+def init_app(app, engine):
+    app.config.setdefault('SQL_SLOW_QUERY_MS', 100)
+    # default budget for every endpoint (None = unlimited) and per-endpoint overrides
+    app.config.setdefault('SQL_QUERY_BUDGET', None)
+    app.config.setdefault('SQL_QUERY_BUDGETS', {})
+    # raise QueryBudgetExceeded instead of only logging; meant for tests and benchmarks
+    app.config.setdefault('SQL_QUERY_BUDGET_STRICT', False)
+    app.config.setdefault('SERVER_TIMING_HEADER', True)
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def request_stats():
+    """Return the {'count', 'time'} stats of the current request (time in seconds)."""
+    stats = g.get('sql_stats')
+    if stats is None:
+        stats = g.sql_stats = {'count': 0, 'time': 0.0}
+    return stats
+
+
+@contextmanager
+def count_queries():
+    """Count statements executed on this thread inside the block.
+
+    Usage::
+
+        with count_queries() as stats:
+            ...
+        assert stats['count'] <= 3
+    """
+    stats = {'count': 0, 'time': 0.0, 'statements': []}
+    stack = getattr(_local, 'counters', None)
+    if stack is None:
+        stack = _local.counters = []
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    for stats in getattr(_local, 'counters', ()):
+        stats['count'] += 1
+        stats['time'] += elapsed
+        stats['statements'].append(statement)
+    if not has_request_context():
+        return
+    stats = request_stats()
+    stats['count'] += 1
+    stats['time'] += elapsed
+    elapsed_ms = elapsed * 1000.0
+    if elapsed_ms >= current_app.config['SQL_SLOW_QUERY_MS']:
+        current_app.logger.warning('Slow query (%.1f ms) in %s: %s', elapsed_ms, request.endpoint, statement)
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute does not fire for failed statements; drop their start time
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start_time'):
+        conn.info['query_start_time'].pop()
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    request_stats()
+
+
+def _finish_request(response):
+    stats = request_stats()
+    cfg = current_app.config
+    if cfg['SERVER_TIMING_HEADER']:
+        total_ms = (time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000.0
+        response.headers.add('Server-Timing', f'db;dur={stats["time"] * 1000.0:.2f};desc="{stats["count"]} queries"')
+        response.headers.add('Server-Timing', f'app;dur={total_ms:.2f}')
+
+    budget = cfg['SQL_QUERY_BUDGETS'].get(request.endpoint, cfg['SQL_QUERY_BUDGET'])
+    # the error response produced by a strict failure passes through here again
+    if budget is not None and stats['count'] > budget and not g.get('sql_budget_reported'):
+        g.sql_budget_reported = True
+        msg = f'{request.endpoint} issued {stats["count"]} queries (budget {budget})'
+        if cfg['SQL_QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(msg)
+        current_app.logger.warning('Query budget exceeded: %s', msg)
+    return response
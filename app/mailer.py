@@ -0,0 +1,267 @@
+"""Email rendering and delivery.
+
+Notification mails are rendered once per event into a ``MailBody`` whose
+recipient-specific parts (name, unsubscribe link) are placeholders;
+``send_personalized()`` fills them in by plain string substitution and sends
+one message per recipient over a single SMTP connection. Compiled email
+templates are cached for the lifetime of the process (restart the app after
+editing templates/email/*).
+
+``send_mail()`` sends a single message to a list of addresses (test mails,
+account notices).
+"""
+import base64
+import smtplib
+import time
+import uuid
+from email.header import Header
+from email.message import EmailMessage
+from email.utils import formataddr, formatdate, make_msgid
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from markupsafe import escape
+
+from . import metrics
+from .models import MailConfig
+
+DEFAULT_HOST = 'https://ccm-m.aiwald.de'
+SENDER_NAME = 'Cleverly Connected Meals (CCM)'
+
+# placeholders substituted per recipient; chosen so that no template output contains them
+NAME = '@@ccm-recipient-name@@'
+UNSUBSCRIBE = '@@ccm-unsubscribe-url@@'
+
+# what an unsubscribe link switches off
+UNSUBSCRIBE_KINDS = {
+    'new_proposal': ('notify_new_proposal',),
+    'discussion': ('notify_discussion',),
+    'broadcast': ('notify_broadcast',),
+    'meals': ('notify_new_proposal', 'notify_discussion'),
+}
+
+
+class MailBody:
+    """A rendered mail shared by all recipients of one event."""
+
+    def __init__(self, subject, text, html, kind):
+        self.subject = subject
+        self.text = text
+        self.html = html
+        self.kind = kind
+
+    def personalize(self, name, unsubscribe_url):
+        """Return (text, html) for one recipient."""
+        text = self.text.replace(NAME, name).replace(UNSUBSCRIBE, unsubscribe_url)
+        html = self.html.replace(NAME, str(escape(name))).replace(UNSUBSCRIBE, str(escape(unsubscribe_url)))
+        return text, html
+
+
+def site_host(cfg=None):
+    cfg = cfg or MailConfig.query.first()
+    host = cfg.site_host.strip() if cfg and cfg.site_host else DEFAULT_HOST
+    return host.rstrip('/')
+
+
+def email_template(name):
+    """Compiled template from templates/email/, cached per app."""
+    cache = current_app.extensions.setdefault('ccm_mail_templates', {})
+    tpl = cache.get(name)
+    if tpl is None:
+        tpl = cache[name] = current_app.jinja_env.get_template(name)
+    return tpl
+
+
+def render_mail(template, subject, text, kind, **context):
+    """Render ``template`` once into a MailBody; ``text`` may contain the NAME / UNSUBSCRIBE placeholders."""
+    html = email_template(template).render(subject=subject, recipient_name=NAME, unsubscribe_url=UNSUBSCRIBE,
+                                           **context)
+    return MailBody(subject, text, html, kind)
+
+
+def proposal_mail(proposal, action, actor, extra_text=None, kind='discussion', host=None):
+    """MailBody for an event on ``proposal``."""
+    host = host or site_host()
+    short_date = proposal.date.strftime('%d.%m')
+    title = proposal.recipe.title
+    subject = f"{actor} {action} | {title} | {short_date}"
+    discussion_url = f"{host}/proposal/{proposal.id}/discuss"
+
+    text_lines = [f"Hello {NAME},", "", f"{actor} {action} for the meal \"{title}\" on {short_date}."]
+    if extra_text:
+        text_lines.extend(["", extra_text])
+    text_lines.extend(["", f"View the discussion and details here: {discussion_url}", "", "Best regards,",
+                       SENDER_NAME, "", f"Unsubscribe: {UNSUBSCRIBE}"])
+    return render_mail('email/proposal_email.html', subject, "\n".join(text_lines), kind, actor=actor,
+                       action=action, proposal_title=title, short_date=short_date, extra_text=extra_text,
+                       discussion_url=discussion_url, host=host)
+
+
+def plain_mail(subject, text, kind):
+    """MailBody for a free-text message (broadcasts)."""
+    paragraphs = ''.join(f"<p>{escape(line)}</p>" for line in text.split('\n') if line.strip())
+    return render_mail('email/plain_email.html', subject, f"{text}\n\nUnsubscribe: {UNSUBSCRIBE}", kind,
+                       paragraphs=paragraphs, host=site_host())
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='ccm-unsubscribe')
+
+
+def unsubscribe_token(user_id, kind):
+    # no expiry: links in old mails must keep working
+    return _serializer().dumps([user_id, kind])
+
+
+def read_unsubscribe_token(token):
+    """Return (user_id, kind) for a valid token, else None."""
+    try:
+        user_id, kind = _serializer().loads(token)
+    except (BadSignature, ValueError, TypeError):
+        return None
+    return (user_id, kind) if kind in UNSUBSCRIBE_KINDS else None
+
+
+def unsubscribe_url(user_id, kind, host=None):
+    # built by hand: also used outside requests (CLI, digest scheduler)
+    return f'{host or site_host()}/unsubscribe/{unsubscribe_token(user_id, kind)}'
+
+
+def mail_enabled():
+    return _enabled_config() is not None
+
+
+def _enabled_config():
+    cfg = MailConfig.query.first()
+    # global admin switch: treat missing or False as disabled (default: off)
+    if not cfg or not getattr(cfg, 'mail_notifications_enabled', False):
+        return None
+    if not cfg.smtp_server or not cfg.username or not cfg.password or not cfg.from_address:
+        return None
+    return cfg
+
+
+def _connect(cfg):
+    s = smtplib.SMTP(cfg.smtp_server, cfg.smtp_port, timeout=10)
+    if cfg.use_tls:
+        s.starttls()
+    s.login(cfg.username, cfg.password)
+    return s
+
+
+def send_mail(subject, text_body, recipients, html_body=None):
+    # send mail using MailConfig if configured, otherwise return False
+    cfg = _enabled_config()
+    if cfg is None:
+        metrics.MAIL_SENT.inc('disabled')
+        return False
+    started = time.perf_counter()
+    try:
+        msg = EmailMessage()
+        msg['Subject'] = subject
+        msg['From'] = formataddr((SENDER_NAME, cfg.from_address))
+        msg['To'] = ', '.join(recipients)
+        # plain text part
+        msg.set_content(text_body)
+        # build HTML part if not provided
+        footer = f'<hr><p style="font-size:small;color:gray">Manage email notifications in your profile settings: <a href="{site_host(cfg)}/profile">Profile settings</a></p>'
+        if html_body is None:
+            # simple paragraph conversion
+            paragraphs = [f"<p>{line}</p>" for line in text_body.split('\n') if line.strip()]
+            html_body = '<html><body>' + ''.join(paragraphs) + footer + '</body></html>'
+        else:
+            # append footer
+            html_body = html_body + footer
+        msg.add_alternative(html_body, subtype='html')
+
+        s = _connect(cfg)
+        s.send_message(msg)
+        s.quit()
+        metrics.MAIL_SENT.inc('sent')
+        metrics.MAIL_SECONDS.observe(time.perf_counter() - started, 'sent')
+        return True
+    except Exception as e:
+        current_app.logger.exception('Mail send failed: %s', e)
+        metrics.MAIL_SENT.inc('failed')
+        metrics.MAIL_SECONDS.observe(time.perf_counter() - started, 'failed')
+        return False
+
+
+# CR, LF and the other control characters: user text (recipe titles, usernames) must not start a new header
+_CONTROL = dict.fromkeys(list(range(32)) + [127], ' ')
+
+
+def _header(value):
+    # one line, RFC 2047-encoded if not ASCII (subjects with recipe titles, names)
+    value = value.translate(_CONTROL)
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode(linesep='\r\n')
+
+
+def _b64(value):
+    return base64.encodebytes(value.encode('utf-8')).replace(b'\n', b'\r\n')
+
+
+def build_messages(body, recipients, from_address, host):
+    """Yield (address, raw message bytes) per recipient (objects with id, email and username).
+
+    The MIME skeleton is built once; per recipient only the two personalized
+    parts are base64-encoded, which is far cheaper than an EmailMessage.
+    """
+    boundary = '===============' + uuid.uuid4().hex
+    domain = from_address.rpartition('@')[2] or None
+    head = ('From: ' + _header(formataddr((SENDER_NAME, from_address))) + '\r\n'
+            'Subject: ' + _header(body.subject) + '\r\n'
+            'Date: ' + formatdate(localtime=True) + '\r\n'
+            'MIME-Version: 1.0\r\n'
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+            'List-Unsubscribe-Post: List-Unsubscribe=One-Click\r\n')
+    text_head = (f'\r\n--{boundary}\r\nContent-Type: text/plain; charset="utf-8"\r\n'
+                 'Content-Transfer-Encoding: base64\r\n\r\n').encode('ascii')
+    html_head = (f'--{boundary}\r\nContent-Type: text/html; charset="utf-8"\r\n'
+                 'Content-Transfer-Encoding: base64\r\n\r\n').encode('ascii')
+    tail = f'--{boundary}--\r\n'.encode('ascii')
+    serializer = _serializer()
+    for r in recipients:
+        unsub = f'{host}/unsubscribe/{serializer.dumps([r.id, body.kind])}'
+        text, html = body.personalize(r.username, unsub)
+        headers = (head + 'To: ' + _header(r.email) + '\r\n'
+                   f'Message-ID: {make_msgid(domain=domain)}\r\n'
+                   f'List-Unsubscribe: <{_header(unsub)}>\r\n')
+        yield r.email, b''.join((headers.encode('ascii'), text_head, _b64(text), html_head, _b64(html), tail))
+
+
+def send_personalized(body, recipients):
+    """Send ``body`` to each recipient over one SMTP connection; return the number delivered."""
+    recipients = [r for r in recipients if r.email]
+    if not recipients:
+        return 0
+    cfg = _enabled_config()
+    if cfg is None:
+        metrics.MAIL_SENT.inc('disabled', amount=len(recipients))
+        return 0
+    started = time.perf_counter()
+    sent = 0
+    try:
+        s = _connect(cfg)
+        try:
+            for address, raw in build_messages(body, recipients, cfg.from_address, site_host(cfg)):
+                try:
+                    s.sendmail(cfg.from_address, [address], raw)
+                    sent += 1
+                except smtplib.SMTPRecipientsRefused:
+                    current_app.logger.warning('Mail to %s refused', address)
+        finally:
+            s.quit()
+    except Exception as e:
+        current_app.logger.exception('Mail send failed: %s', e)
+    failed = len(recipients) - sent
+    if sent:
+        metrics.MAIL_SENT.inc('sent', amount=sent)
+    if failed:
+        metrics.MAIL_SENT.inc('failed', amount=failed)
+    metrics.MAIL_SECONDS.observe(time.perf_counter() - started, 'sent' if not failed else 'failed')
+    return sent
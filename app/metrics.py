@@ -0,0 +1,302 @@
+"""In-process metrics with a Prometheus text exposition.
+
+Every worker process keeps its counters and histograms in plain dicts guarded
+by a lock (an increment is a dict update, no I/O). At most every
+``METRICS_FLUSH_SECONDS`` a worker writes a JSON snapshot of its values to
+``METRICS_DIR``; ``/metrics`` merges the snapshots of all workers so the
+exposed numbers add up across processes.
+
+Snapshots are named after the process id and start time, so a new process
+that gets the pid of a dead worker does not overwrite its values. The
+counters and histograms of dead workers are folded into ``aggregate.json``
+and their snapshots removed, which keeps the totals from going backwards
+when workers are replaced; their gauges are dropped.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request, current_app
+from flask_login import current_user
+
+_registry = {}
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(k): (list(v) if isinstance(v, list) else v) for k, v in self._values.items()}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge whose value is summed over the live worker processes."""
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            # per label set: one count per bucket (non-cumulative), +Inf count, sum
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            else:
+                row[len(self.buckets)] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+REQUEST_SECONDS = Histogram('ccm_request_duration_seconds', 'Request latency by endpoint.', ('endpoint', 'method'))
+REQUESTS = Counter('ccm_requests_total', 'Requests by endpoint and status code.', ('endpoint', 'method', 'status'))
+DB_QUERIES = Counter('ccm_db_queries_total', 'SQL statements issued by endpoint.', ('endpoint',))
+DB_SECONDS = Counter('ccm_db_seconds_total', 'Time spent in SQL statements by endpoint.', ('endpoint',))
+DB_POOL_CHECKED_OUT = Gauge('ccm_db_pool_checked_out', 'Database connections currently checked out.')
+DB_POOL_SIZE = Gauge('ccm_db_pool_size', 'Configured database connection pool size.')
+MAIL_SENT = Counter('ccm_mail_sent_total', 'send_mail calls by result (sent, failed, disabled).', ('result',))
+MAIL_SECONDS = Histogram('ccm_mail_send_duration_seconds', 'Duration of SMTP deliveries.', ('result',))
+IMAGE_SECONDS = Histogram('ccm_image_processing_seconds', 'Duration of image processing.', ('operation',))
+IMAGE_BYTES = Histogram('ccm_image_output_bytes', 'Size of images written by image processing.', ('operation',), buckets=SIZE_BUCKETS)
+UPLOAD_BYTES = Counter('ccm_upload_bytes_total', 'Bytes received in multipart uploads by endpoint.', ('endpoint',))
+UPLOADS = Counter('ccm_uploads_total', 'Multipart uploads by endpoint.', ('endpoint',))
+
+AGGREGATE = 'aggregate.json'
+
+_flush_state = {'last': 0.0, 'pid': None, 'started': None}
+
+
+def init_app(app, engine):
+    app.config.setdefault('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+    app.config.setdefault('METRICS_FLUSH_SECONDS', 5)
+    # allow unauthenticated scrapes from the same host (direct, not through a proxy)
+    app.config.setdefault('METRICS_ALLOW_LOCALHOST', True)
+    app.extensions['ccm_metrics_engine'] = engine
+    app.after_request(_record_request)
+
+
+def _record_request(response):
+    endpoint = request.endpoint or 'none'
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, request.method)
+    REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    stats = g.get('sql_stats')
+    if stats:
+        DB_QUERIES.inc(endpoint, amount=stats['count'])
+        DB_SECONDS.inc(endpoint, amount=stats['time'])
+    if request.method == 'POST' and request.mimetype == 'multipart/form-data':
+        UPLOADS.inc(endpoint)
+        UPLOAD_BYTES.inc(endpoint, amount=request.content_length or 0)
+    if time.monotonic() - _flush_state['last'] >= current_app.config['METRICS_FLUSH_SECONDS']:
+        flush()
+    return response
+
+
+def _sample_pool():
+    pool = current_app.extensions['ccm_metrics_engine'].pool
+    # not every pool class (e.g. StaticPool, NullPool) tracks sizes
+    if hasattr(pool, 'checkedout'):
+        DB_POOL_CHECKED_OUT.set(pool.checkedout())
+    if hasattr(pool, 'size'):
+        DB_POOL_SIZE.set(pool.size())
+
+
+def flush():
+    """Write this process' values to METRICS_DIR/<pid>-<start>.json (atomically)."""
+    _flush_state['last'] = time.monotonic()
+    pid = os.getpid()
+    if _flush_state['pid'] != pid:
+        # first flush of this process (a forked worker inherits the parent's state)
+        _flush_state['pid'], _flush_state['started'] = pid, time.time_ns()
+    try:
+        _sample_pool()
+        directory = current_app.config['METRICS_DIR']
+        os.makedirs(directory, exist_ok=True)
+        data = {'pid': pid, 'started': _flush_state['started'],
+                'metrics': {name: m.snapshot() for name, m in _registry.items()}}
+        path = os.path.join(directory, f"{pid}-{_flush_state['started']}.json")
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except Exception:
+        current_app.logger.exception('Failed to write metrics snapshot')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _add(merged, metrics, gauges=True):
+    for name, samples in metrics.items():
+        metric = _registry.get(name)
+        if metric is None or (metric.kind == 'gauge' and not gauges):
+            continue
+        target = merged.setdefault(name, {})
+        for key, value in samples.items():
+            if isinstance(value, list):
+                row = target.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    row[i] += v
+            else:
+                target[key] = target.get(key, 0) + value
+
+
+def _fold(directory, dead):
+    """Add the snapshot files named in ``dead`` to the aggregate and remove them; return the aggregate."""
+    with open(os.path.join(directory, 'aggregate.lock'), 'w') as lock:
+        # one process at a time, or concurrent scrapes would add a snapshot twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        aggregate = _load(os.path.join(directory, AGGREGATE)) or {'metrics': {}, 'folded': []}
+        # names stay listed until their file is gone, in case removing it failed
+        folded = [n for n in aggregate['folded'] if os.path.exists(os.path.join(directory, n))]
+        for fname in dead:
+            # read again under the lock: a concurrent scrape may have folded and removed it since
+            data = _load(os.path.join(directory, fname))
+            if data is not None and fname not in folded:
+                _add(aggregate['metrics'], data.get('metrics', {}), gauges=False)
+                folded.append(fname)
+        aggregate['folded'] = folded
+        path = os.path.join(directory, AGGREGATE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(aggregate, f)
+        os.replace(path + '.tmp', path)
+        for fname in dead:
+            try:
+                os.remove(os.path.join(directory, fname))
+            except FileNotFoundError:
+                pass
+    return aggregate
+
+
+def _collect():
+    """Merge the snapshots of all worker processes, folding those of dead ones into the aggregate."""
+    merged = {name: {} for name in _registry}
+    directory = current_app.config['METRICS_DIR']
+    if not os.path.isdir(directory):
+        return merged
+    snapshots = {}
+    for fname in os.listdir(directory):
+        if fname.endswith('.json') and fname != AGGREGATE:
+            data = _load(os.path.join(directory, fname))
+            if data is not None:
+                snapshots[fname] = data
+    # a pid with a newer snapshot has been reused: the older ones are of dead processes
+    newest = {}
+    for data in snapshots.values():
+        newest[data.get('pid', 0)] = max(newest.get(data.get('pid', 0), 0), data.get('started', 0))
+    dead = {fname: data for fname, data in snapshots.items()
+            if data.get('started', 0) < newest[data.get('pid', 0)] or not _pid_alive(data.get('pid', 0))}
+    # read after the snapshots: a snapshot folded in the meantime is listed in it
+    aggregate = _fold(directory, dead) if dead else _load(os.path.join(directory, AGGREGATE))
+    aggregate = aggregate or {'metrics': {}, 'folded': []}
+    _add(merged, aggregate['metrics'], gauges=False)
+    for fname, data in snapshots.items():
+        if fname not in dead and fname not in aggregate['folded']:
+            _add(merged, data.get('metrics', {}))
+    return merged
+
+
+def totals(metric):
+    """Values of ``metric`` summed over all worker processes, by label tuple."""
+    flush()
+    return {tuple(json.loads(key)): value for key, value in _collect()[metric.name].items()}
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    inner = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return '{' + inner + '}'
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    flush()
+    merged = _collect()
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(merged[name].items()):
+            labels = json.loads(key)
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{_labels(metric.labelnames, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(metric.labelnames, labels, [("le", bound)])} {cumulative}')
+            cumulative += value[len(metric.buckets)]
+            lines.append(f'{name}_bucket{_labels(metric.labelnames, labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(metric.labelnames, labels)} {value[-1]}')
+            lines.append(f'{name}_count{_labels(metric.labelnames, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def scrape_allowed():
+    """Admins may always scrape; local clients only when not forwarded by a proxy."""
+    if current_user.is_authenticated and getattr(current_user, 'is_admin', False):
+        return True
+    if not current_app.config['METRICS_ALLOW_LOCALHOST'] or 'X-Forwarded-For' in request.headers:
+        return False
+    return request.remote_addr in ('127.0.0.1', '::1')
@@ -14,6 +14,10 @@ class User(UserMixin, db.Model):
     notify_new_proposal = db.Column(db.Boolean, default=True)
     notify_discussion = db.Column(db.Boolean, default=True)
     notify_broadcast = db.Column(db.Boolean, default=True)
+    # how proposal notifications are delivered: 'immediate', 'hourly' or 'daily' (digest)
+    notify_digest = db.Column(db.String(10), default='immediate')
+    # secret of the user's .ics feed URL (see app/ics_feed.py); None until the user creates one
+    calendar_token = db.Column(db.String(64), nullable=True, unique=True, index=True)
     recipes = db.relationship('Recipe', backref='author', lazy=True)
     # proposals created by this user. Explicit foreign_keys avoids ambiguity
     proposals = db.relationship('Proposal', backref='proposer', lazy=True, foreign_keys='Proposal.proposer_id')
@@ -35,13 +39,18 @@ class Recipe(db.Model):
     instructions = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
-    times_cooked = db.Column(db.Integer, default=0)
+    # popularity, maintained by app/popularity.py from the proposals that count as cooked
+    times_cooked = db.Column(db.Integer, default=0, index=True)
+    last_cooked_on = db.Column(db.Date, nullable=True, index=True)
+    participants_total = db.Column(db.Integer, default=0)
     image = db.Column(db.String(255), nullable=True)
     # new timing and difficulty fields (minutes)
     prep_time = db.Column(db.Integer, nullable=True, default=0)      # preparation time in minutes
     total_time = db.Column(db.Integer, nullable=True, default=0)     # total time in minutes
     active_time = db.Column(db.Integer, nullable=True, default=0)    # active cooking time in minutes
     level = db.Column(db.String(20), nullable=True)                  # difficulty: e.g. 'simple','medium','advanced'
+    # bumped on every change; used for ETag / Last-Modified version stamps
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class Proposal(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -54,6 +63,19 @@ class Proposal(db.Model):
     grocery_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     # new: cook user (who will prepare/cook the meal)
     cook_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # bumped on every change of the proposal, its participants or its messages (see touch_proposal)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # client-supplied key of the request that created the proposal (see app/proposals.py)
+    idempotency_key = db.Column(db.String(64), nullable=True)
+    # included in the recipe's popularity counters (date passed or cook claimed, see app/popularity.py)
+    counted = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+
+    __table_args__ = (
+        db.Index('uq_proposal_date_recipe_proposer', 'date', 'recipe_id', 'proposer_id', unique=True),
+        db.Index('uq_proposal_proposer_idempotency_key', 'proposer_id', 'idempotency_key', unique=True),
+        db.Index('ix_proposal_counted_date', 'counted', 'date'),
+        db.Index('ix_proposal_recipe_counted', 'recipe_id', 'counted'),
+    )
 
     recipe = db.relationship('Recipe', backref=db.backref('proposals', lazy=True))
     participants = db.relationship('Participant', backref='proposal', cascade='all, delete-orphan', lazy=True)
@@ -68,8 +90,30 @@ class Participant(db.Model):
     proposal_id = db.Column(db.Integer, db.ForeignKey('proposal.id'), nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # joins are INSERTs guarded by this index (see app/proposals.py)
+    __table_args__ = (
+        db.Index('uq_participant_proposal_user', 'proposal_id', 'user_id', unique=True),
+    )
+
     user = db.relationship('User', backref=db.backref('participations', lazy=True))
 
+class Commitment(db.Model):
+    """Denormalized (user, proposal, role) rows behind "Your commitments" (see app/commitments.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    proposal_id = db.Column(db.Integer, db.ForeignKey('proposal.id'), nullable=False, index=True)
+    # 'participant', 'cook' or 'grocery'
+    role = db.Column(db.String(12), nullable=False)
+    # copy of proposal.date so the list is one range scan over (user_id, date)
+    date = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_commitment_user_date', 'user_id', 'date'),
+        db.Index('uq_commitment_user_proposal_role', 'user_id', 'proposal_id', 'role', unique=True),
+    )
+
+    proposal = db.relationship('Proposal', backref=db.backref('commitments', lazy=True, cascade='all, delete-orphan'))
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     proposal_id = db.Column(db.Integer, db.ForeignKey('proposal.id'), nullable=False)
@@ -94,3 +138,21 @@ class MailConfig(db.Model):
     # Global on/off switch for all outgoing mail (admin-controlled). Default: off
     mail_notifications_enabled = db.Column(db.Boolean, default=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class PendingNotification(db.Model):
+    """A proposal event queued for a user's next hourly/daily digest email."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # no FK: the event must survive the deletion of its proposal ("removed the proposal")
+    proposal_id = db.Column(db.Integer, nullable=True)
+    proposal_title = db.Column(db.String(150), nullable=False)
+    proposal_date = db.Column(db.Date, nullable=False)
+    actor = db.Column(db.String(80), nullable=False)
+    action = db.Column(db.String(80), nullable=False)
+    extra_text = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # set while a worker sends the digest with this event; the row is deleted once the mail went out
+    claimed_at = db.Column(db.DateTime, nullable=True)
+
+    user = db.relationship('User', backref=db.backref('pending_notifications', lazy=True, cascade='all, delete-orphan'))
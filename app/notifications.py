@@ -0,0 +1,17 @@
+"""Fan-out of proposal events to immediate mail or the digest queue."""
+from .digests import digest_mode, queue_event
+from .mailer import proposal_mail, send_personalized
+
+
+def notify_users(users, proposal, action, actor, extra_text=None, kind='discussion'):
+    """Mail a proposal event to ``users`` now, or queue it for those who chose a digest.
+
+    ``users`` need id, email, username and notify_digest; ``kind`` is the
+    setting the mail's unsubscribe link switches off.
+    """
+    queued = [u for u in users if digest_mode(u) != 'immediate']
+    if queued:
+        queue_event(proposal, action, actor, queued, extra_text)
+    immediate = [u for u in users if digest_mode(u) == 'immediate']
+    if immediate:
+        send_personalized(proposal_mail(proposal, action, actor, extra_text=extra_text, kind=kind), immediate)
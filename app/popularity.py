@@ -0,0 +1,182 @@
+"""Materialized recipe popularity: times cooked, last cooked date, participants.
+
+A proposal counts as cooked once its date has passed or as soon as somebody
+claims the cook duty (``Proposal.counted``). The counters on ``Recipe`` are
+kept up to date incrementally:
+
+* ``sync(p)`` after a cook claim/unclaim, ``participants_changed(p, delta)``
+  after a join/leave and ``discard(p)`` before a proposal is deleted;
+* ``sweep()`` counts the proposals whose date has passed; it runs on the
+  first request of each day and is a single UPDATE when there is nothing to do;
+* ``reconcile()`` recomputes everything from the proposals and repairs drift
+  (``flask popularity reconcile``, nightly from cron).
+
+``RECIPE_ORDERS`` are the sort orders offered in the recipe list and the
+propose dialog; they read only the indexed counter columns.
+"""
+from datetime import date
+
+from flask import current_app
+from sqlalchemy import case, func, or_, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import db
+from .models import Participant, Proposal, Recipe
+
+RECIPE_ORDERS = {
+    'new': ('Newest', (Recipe.created_at.desc(),)),
+    'popular': ('Most popular', (Recipe.times_cooked.desc(), Recipe.participants_total.desc(), Recipe.title)),
+    'stale': ('Not cooked lately', (Recipe.last_cooked_on.asc().nulls_first(), Recipe.title)),
+}
+
+
+def init_app(app):
+    app.config.setdefault('POPULARITY_DAILY_SWEEP', True)
+    if app.config['POPULARITY_DAILY_SWEEP']:
+        app.before_request(_daily_sweep)
+
+
+def recipe_order(name):
+    return RECIPE_ORDERS.get(name, RECIPE_ORDERS['new'])[1]
+
+
+def should_count(p, today=None):
+    return p.date < (today or date.today()) or p.cook_user_id is not None
+
+
+def _counted_rule(today):
+    return or_(Proposal.date < today, Proposal.cook_user_id.isnot(None))
+
+
+def _bump(recipe_id, cooked=0, participants=0, cooked_on=None, recompute_last=False):
+    values = {
+        'times_cooked': func.coalesce(Recipe.times_cooked, 0) + cooked,
+        'participants_total': func.coalesce(Recipe.participants_total, 0) + participants,
+    }
+    if cooked_on is not None:
+        values['last_cooked_on'] = case(
+            (or_(Recipe.last_cooked_on.is_(None), Recipe.last_cooked_on < cooked_on), cooked_on),
+            else_=Recipe.last_cooked_on)
+    elif recompute_last:
+        values['last_cooked_on'] = (select(func.max(Proposal.date))
+                                    .where(Proposal.recipe_id == recipe_id, Proposal.counted.is_(True))
+                                    .scalar_subquery())
+    db.session.execute(update(Recipe).where(Recipe.id == recipe_id).values(**values)
+                       .execution_options(synchronize_session=False))
+
+
+def _participants(proposal_id):
+    return db.session.scalar(select(func.count(Participant.id)).where(Participant.proposal_id == proposal_id))
+
+
+def _set_counted(p, counted):
+    """Flip ``p.counted`` with a conditional UPDATE; True when this call changed it."""
+    changed = db.session.execute(
+        update(Proposal).where(Proposal.id == p.id, Proposal.counted.isnot(counted))
+        .values(counted=counted, updated_at=Proposal.updated_at)
+        .execution_options(synchronize_session=False)).rowcount
+    set_committed_value(p, 'counted', counted)
+    return changed == 1
+
+
+def sync(p, today=None):
+    """Count or uncount ``p`` after a change of its cook; the caller commits."""
+    wanted = should_count(p, today)
+    if not _set_counted(p, wanted):
+        return
+    n = _participants(p.id)
+    if wanted:
+        _bump(p.recipe_id, 1, n, cooked_on=p.date)
+    else:
+        _bump(p.recipe_id, -1, -n, recompute_last=True)
+
+
+def participants_changed(p, delta):
+    # the counted flag is read in the same statement, so a concurrent claim cannot slip in between
+    counted = select(Proposal.counted).where(Proposal.id == p.id).scalar_subquery()
+    db.session.execute(update(Recipe).where(Recipe.id == p.recipe_id, counted.is_(True))
+                       .values(participants_total=func.coalesce(Recipe.participants_total, 0) + delta)
+                       .execution_options(synchronize_session=False))
+
+
+def discard(p):
+    """Remove a proposal that is about to be deleted from its recipe's counters."""
+    if _set_counted(p, False):
+        _bump(p.recipe_id, -1, -_participants(p.id), recompute_last=True)
+
+
+def sweep(today=None):
+    """Count the proposals whose date has passed; return how many were counted."""
+    today = today or date.today()
+    # the UPDATE takes the write lock first, so a concurrent claim cannot count a proposal twice
+    rows = db.session.execute(
+        update(Proposal).where(Proposal.counted.is_(False), Proposal.date < today)
+        .values(counted=True, updated_at=Proposal.updated_at)
+        .returning(Proposal.id, Proposal.recipe_id, Proposal.date)
+        .execution_options(synchronize_session=False)).all()
+    if not rows:
+        db.session.commit()
+        return 0
+    per_recipe = {}
+    owner = {}
+    for pid, recipe_id, d in rows:
+        owner[pid] = recipe_id
+        cooked, participants, last = per_recipe.get(recipe_id, (0, 0, d))
+        per_recipe[recipe_id] = [cooked + 1, participants, max(last, d)]
+    ids = list(owner)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        for pid, n in db.session.execute(select(Participant.proposal_id, func.count(Participant.id))
+                                         .where(Participant.proposal_id.in_(chunk))
+                                         .group_by(Participant.proposal_id)):
+            per_recipe[owner[pid]][1] += n
+    for recipe_id, (cooked, participants, last) in per_recipe.items():
+        _bump(recipe_id, cooked, participants, cooked_on=last)
+    db.session.commit()
+    return len(rows)
+
+
+def _daily_sweep():
+    state = current_app.extensions.setdefault('ccm_popularity', {})
+    today = date.today()
+    if state.get('swept') == today:
+        return
+    state['swept'] = today
+    try:
+        sweep(today)
+    except OperationalError:
+        # schema not migrated yet, or the database is locked: the next day (or cron) catches up
+        db.session.rollback()
+        current_app.logger.warning('popularity sweep skipped', exc_info=True)
+
+
+def reconcile(today=None):
+    """Recompute all counters from the proposals; return (proposals fixed, recipes fixed)."""
+    today = today or date.today()
+    rule = _counted_rule(today)
+    fixed_proposals = db.session.execute(
+        update(Proposal).where(Proposal.counted != case((rule, True), else_=False))
+        .values(counted=case((rule, True), else_=False), updated_at=Proposal.updated_at)
+        .execution_options(synchronize_session=False)).rowcount
+
+    expected = {rid: [n, 0, last] for rid, n, last in db.session.execute(
+        select(Proposal.recipe_id, func.count(Proposal.id), func.max(Proposal.date))
+        .where(Proposal.counted.is_(True)).group_by(Proposal.recipe_id))}
+    for rid, n in db.session.execute(
+            select(Proposal.recipe_id, func.count(Participant.id))
+            .join(Participant, Participant.proposal_id == Proposal.id)
+            .where(Proposal.counted.is_(True)).group_by(Proposal.recipe_id)):
+        expected[rid][1] = n
+
+    fixed_recipes = 0
+    for rid, cooked, participants, last in db.session.execute(
+            select(Recipe.id, Recipe.times_cooked, Recipe.participants_total, Recipe.last_cooked_on)).all():
+        want = tuple(expected.get(rid, (0, 0, None)))
+        if (cooked or 0, participants or 0, last) != want:
+            db.session.execute(update(Recipe).where(Recipe.id == rid)
+                               .values(times_cooked=want[0], participants_total=want[1], last_cooked_on=want[2])
+                               .execution_options(synchronize_session=False))
+            fixed_recipes += 1
+    db.session.commit()
+    return fixed_proposals, fixed_recipes
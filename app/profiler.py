@@ -0,0 +1,165 @@
+"""On-demand request profiler for admins.
+
+Profiling is off unless ``PROFILER_ENABLED`` is set. A request is then
+profiled when the admin enabled profiling for their own session on the admin
+dashboard, or when its URL carries ``?_profile=<token>`` with a token signed
+by an admin. A token profiles one request: its nonce is recorded in
+``PROFILER_DIR`` when it is used, and it expires after
+``PROFILER_TOKEN_MAX_AGE`` seconds. A background thread samples the request
+thread's stack every ``PROFILER_INTERVAL_MS`` and the result is written in
+the folded-stack format understood by flamegraph.pl, speedscope and inferno.
+Only the newest ``PROFILER_MAX_FILES`` profiles are kept.
+
+While profiling is off no hooks are installed at all; otherwise an
+unprofiled request costs one dict lookup in the query args and one in the
+session.
+"""
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request, session, current_app
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+SESSION_KEY = 'profile_requests'
+QUERY_ARG = '_profile'
+# nonces of used tokens, below PROFILER_DIR
+USED_TOKENS = 'used-tokens'
+
+
+def init_app(app):
+    app.config.setdefault('PROFILER_ENABLED', False)
+    app.config.setdefault('PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+    app.config.setdefault('PROFILER_MAX_FILES', 50)
+    app.config.setdefault('PROFILER_INTERVAL_MS', 2)
+    app.config.setdefault('PROFILER_TOKEN_MAX_AGE', 3600)
+    if not app.config['PROFILER_ENABLED']:
+        return
+    app.before_request(_start)
+    app.teardown_request(_stop)
+
+
+class _Sampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval into folded stacks."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='ccm-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.started = time.perf_counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return time.perf_counter() - self.started
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='ccm-profiler')
+
+
+def make_token(admin_username):
+    """Signed single-use token that enables profiling through ``?_profile=<token>``."""
+    _prune_used_tokens()
+    return _serializer().dumps({'by': admin_username, 'nonce': secrets.token_hex(16)})
+
+
+def _redeem(token):
+    """True the first time a valid token is used, in any worker of the host."""
+    try:
+        data = _serializer().loads(token, max_age=current_app.config['PROFILER_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+    nonce = data.get('nonce') if isinstance(data, dict) else None
+    if not isinstance(nonce, str) or not re.fullmatch(r'[0-9a-f]{32}', nonce):
+        return False
+    directory = os.path.join(current_app.config['PROFILER_DIR'], USED_TOKENS)
+    os.makedirs(directory, exist_ok=True)
+    try:
+        # creating the marker is atomic: of concurrent requests with the token only one gets here
+        os.close(os.open(os.path.join(directory, nonce), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+
+def _prune_used_tokens():
+    # expired tokens are refused anyway; their markers can go
+    directory = os.path.join(current_app.config['PROFILER_DIR'], USED_TOKENS)
+    if not os.path.isdir(directory):
+        return
+    expired = time.time() - current_app.config['PROFILER_TOKEN_MAX_AGE']
+    for entry in os.scandir(directory):
+        try:
+            if entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _start():
+    token = request.args.get(QUERY_ARG)
+    if not session.get(SESSION_KEY) and not (token and _redeem(token)):
+        return
+    g.profiler = _Sampler(threading.get_ident(), current_app.config['PROFILER_INTERVAL_MS'] / 1000.0)
+    g.profiler.start()
+
+
+def _stop(exc=None):
+    sampler = g.pop('profiler', None)
+    if sampler is None:
+        return
+    elapsed = sampler.stop()
+    try:
+        _save(sampler.stacks, elapsed)
+    except Exception:
+        current_app.logger.exception('Failed to store request profile')
+
+
+def _save(stacks, elapsed):
+    directory = current_app.config['PROFILER_DIR']
+    os.makedirs(directory, exist_ok=True)
+    endpoint = re.sub(r'[^A-Za-z0-9_.-]', '_', request.endpoint or 'none')
+    stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+    name = f'{stamp}_{endpoint}_{elapsed * 1000.0:.0f}ms.folded'
+    with open(os.path.join(directory, name), 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+    # retention: keep only the newest PROFILER_MAX_FILES profiles
+    for old in list_profiles()[current_app.config['PROFILER_MAX_FILES']:]:
+        try:
+            os.remove(os.path.join(directory, old['name']))
+        except OSError:
+            pass
+
+
+def list_profiles():
+    """Stored profiles, newest first, as dicts with name, size and modification time."""
+    directory = current_app.config['PROFILER_DIR']
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in os.listdir(directory):
+        if name.endswith('.folded'):
+            st = os.stat(os.path.join(directory, name))
+            profiles.append({'name': name, 'size': st.st_size, 'modified': datetime.utcfromtimestamp(st.st_mtime)})
+    profiles.sort(key=lambda p: p['name'], reverse=True)
+    return profiles
@@ -0,0 +1,151 @@
+"""Proposal creation shared by all propose endpoints.
+
+A proposal is unique per (date, recipe, proposer): the unique index
+``uq_proposal_date_recipe_proposer`` turns a double submit into a cheap
+IntegrityError instead of a second proposal with a second round of mails.
+Clients may also send an idempotency key (form field ``idempotency_key`` or
+``Idempotency-Key`` header); replaying a key returns the proposal created
+with it.
+
+Joining, leaving and claiming cook/grocery duty are single conditional
+statements whose rowcount says whether they took effect: an INSERT guarded
+by the unique (proposal, user) participant index and an ``UPDATE ... WHERE
+cook_user_id IS NULL OR cook_user_id = :user`` that claims or releases.
+Concurrent clicks therefore have exactly one winner and never
+read-modify-write the proposal.
+"""
+from datetime import date, time
+
+from flask import request
+from sqlalchemy import case, delete, or_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import commitments, db, popularity
+from .models import Participant, Proposal, Recipe
+from .notifications import notify_users
+from .recipients import subscriber_recipients
+
+
+class ProposalError(ValueError):
+    """The request cannot create a proposal; the message is shown to the user."""
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value or '')
+    except ValueError:
+        raise ProposalError('Invalid date')
+
+
+def parse_start_time(value):
+    # malformed times fall back to no start time, as the forms always did
+    if not value:
+        return None
+    try:
+        hh, mm = value.split(':')[:2]
+        return time(int(hh), int(mm))
+    except (ValueError, TypeError):
+        return None
+
+
+def request_idempotency_key(data=None):
+    key = (data or request.form).get('idempotency_key') or request.headers.get('Idempotency-Key')
+    return key.strip()[:64] if key else None
+
+
+def _existing(proposer_id, d, recipe_id, key):
+    if key:
+        p = Proposal.query.filter_by(proposer_id=proposer_id, idempotency_key=key).first()
+        if p is not None:
+            if (p.date, p.recipe_id) != (d, recipe_id):
+                raise ProposalError('Idempotency key was already used for another proposal')
+            return p
+    return Proposal.query.filter_by(proposer_id=proposer_id, date=d, recipe_id=recipe_id).first()
+
+
+def submit_proposal(proposer, recipe_id, d, start_time=None, idempotency_key=None):
+    """Create a proposal and notify subscribers; return (proposal, created).
+
+    A replayed idempotency key or an existing proposal of the same recipe by
+    the same proposer on the same day returns that proposal with
+    ``created=False`` and sends nothing.
+    """
+    try:
+        recipe_id = int(recipe_id)
+    except (TypeError, ValueError):
+        raise ProposalError('Recipe and date required')
+    if idempotency_key:
+        p = _existing(proposer.id, d, recipe_id, idempotency_key)
+        if p is not None:
+            return p, False
+    if db.session.get(Recipe, recipe_id) is None:
+        raise ProposalError('Unknown recipe')
+
+    p = Proposal(date=d, recipe_id=recipe_id, proposer_id=proposer.id, start_time=start_time,
+                 idempotency_key=idempotency_key)
+    db.session.add(p)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # lost the race against a concurrent submit (or a plain duplicate)
+        db.session.rollback()
+        p = _existing(proposer.id, d, recipe_id, idempotency_key)
+        if p is None:
+            raise
+        return p, False
+
+    # one recipient query, one digest insert and one SMTP connection per proposal
+    notify_users(subscriber_recipients('new_proposal', exclude_user_id=proposer.id), p, 'created a proposal',
+                 proposer.username, kind='new_proposal')
+    return p, True
+
+
+CLAIM_COLUMNS = {'cook': Proposal.cook_user_id, 'grocery': Proposal.grocery_user_id}
+
+
+def add_participant(p, user_id):
+    """Join ``user_id`` to ``p``; False if already joined. The caller commits."""
+    added = db.session.execute(sqlite_insert(Participant).values(user_id=user_id, proposal_id=p.id)
+                               .on_conflict_do_nothing()).rowcount
+    if added:
+        commitments.add(user_id, p, 'participant')
+        popularity.participants_changed(p, 1)
+    return added == 1
+
+
+def remove_participant(p, user_id):
+    """Remove ``user_id`` from ``p``; False if not joined. The caller commits."""
+    removed = db.session.execute(delete(Participant).where(Participant.proposal_id == p.id,
+                                                           Participant.user_id == user_id)
+                                 .execution_options(synchronize_session=False)).rowcount
+    if removed:
+        commitments.remove(user_id, p.id, 'participant')
+        popularity.participants_changed(p, -removed)
+    return removed > 0
+
+
+def toggle_claim(p, role, user_id):
+    """Claim or release cook/grocery duty (``role``) of ``p`` for ``user_id``.
+
+    Returns 'released' if the user held the duty, 'claimed' if it was free and
+    'taken' if somebody else holds it. The caller commits.
+    """
+    column = CLAIM_COLUMNS[role]
+    # a single statement: release if held by the user, claim if free, no row if taken
+    row = db.session.execute(
+        update(Proposal).where(Proposal.id == p.id, or_(column.is_(None), column == user_id))
+        .values({column: case((column == user_id, None), else_=user_id)})
+        .returning(column).execution_options(synchronize_session=False)).first()
+    if row is None:
+        return 'taken'
+    new = row[0]
+    set_committed_value(p, column.key, new)
+    if new is None:
+        commitments.remove(user_id, p.id, role)
+    else:
+        commitments.add(user_id, p, role)
+    if role == 'cook':
+        popularity.sync(p)
+    return 'released' if new is None else 'claimed'
@@ -0,0 +1,268 @@
+"""Token-bucket rate limits for expensive endpoints.
+
+``RATELIMIT_LIMITS`` maps an endpoint to its rules ``(scope, burst,
+seconds)``: a bucket holds ``burst`` tokens and refills at ``burst``
+tokens per ``seconds``, and every request takes a token from the bucket of
+each rule. The scope picks the bucket key: ``'ip'`` is the client address
+and ``'user'`` the logged-in user (the client address for anonymous
+requests). ``'username'`` buckets count failed logins per submitted username
+and client address: only ``failed_attempt()``, which the login view calls
+for a wrong password, takes their tokens, so a successful login costs
+nothing and guessing from elsewhere cannot lock the owner out of their
+account. Only the methods in ``RATELIMIT_METHODS`` (POST) count, so showing
+a form is never limited.
+
+A request that finds a bucket empty is answered with 429 and a
+``Retry-After`` header, before its view runs, and takes no token from its
+other buckets. Buckets live in this process (``RATELIMIT_STORAGE =
+'memory'``, per worker) or in a small SQLite file shared by the workers of
+a host (``'sqlite'``, ``RATELIMIT_SQLITE_PATH``). Behind a reverse proxy set
+``RATELIMIT_PROXY_COUNT`` to the number of proxies, so the client address is
+read from ``X-Forwarded-For``. Allowed and limited requests are counted per
+endpoint in the metrics (``ccm_ratelimit_total``) and shown on the admin
+dashboard.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, render_template, request
+from flask_login import current_user
+
+from . import metrics
+
+DECISIONS = metrics.Counter('ccm_ratelimit_total', 'Rate-limited endpoint requests by result (allowed, limited).',
+                            ('endpoint', 'result'))
+
+
+def init_app(app):
+    app.config.setdefault('RATELIMIT_ENABLED', True)
+    app.config.setdefault('RATELIMIT_STORAGE', 'memory')
+    app.config.setdefault('RATELIMIT_SQLITE_PATH', os.path.join(app.instance_path, 'ratelimit.db'))
+    app.config.setdefault('RATELIMIT_PROXY_COUNT', 0)
+    app.config.setdefault('RATELIMIT_METHODS', ('POST',))
+    upload = (('user', 20, 600), ('ip', 60, 600))
+    app.config.setdefault('RATELIMIT_LIMITS', {
+        # password hashing
+        'auth.login': (('ip', 10, 60), ('username', 5, 300)),
+        'auth.register': (('ip', 5, 3600),),
+        # image re-encoding
+        'main.add_recipe': upload,
+        'main.edit_recipe': upload,
+        'main.upload_recipe_image': upload,
+        'main.upload_avatar': upload,
+        # mail fan-out
+        'main.admin_broadcast': (('user', 3, 3600),),
+        'main.proposal_discuss': (('user', 20, 300),),
+    })
+    if app.config['RATELIMIT_STORAGE'] not in ('memory', 'sqlite'):
+        raise ValueError(f"RATELIMIT_STORAGE must be 'memory' or 'sqlite', not {app.config['RATELIMIT_STORAGE']!r}")
+    if not app.config['RATELIMIT_ENABLED']:
+        return
+    # a bucket unused for its longest window is full again and can go
+    max_age = max((seconds for rules in app.config['RATELIMIT_LIMITS'].values() for _, _, seconds in rules),
+                  default=3600)
+    app.extensions['ccm_ratelimit'] = (SQLiteBuckets(app.config['RATELIMIT_SQLITE_PATH'], max_age)
+                                       if app.config['RATELIMIT_STORAGE'] == 'sqlite' else MemoryBuckets(max_age))
+    app.before_request(_check)
+
+
+def take(states, rules, now, charge=True):
+    """Apply ``rules`` [(key, burst, seconds)] to the bucket ``states`` {key: (tokens, updated)}.
+
+    Returns (new states, seconds to wait). A token is taken from every
+    bucket only if all of them have one (and ``charge`` is set); otherwise
+    the buckets are just refilled and the wait is the time until the
+    emptiest one has a token.
+    """
+    refilled = {}
+    wait = 0.0
+    for key, burst, seconds in rules:
+        rate = burst / seconds
+        tokens, updated = states.get(key) or (burst, now)
+        tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+        refilled[key] = tokens
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+    if charge and not wait:
+        refilled = {key: tokens - 1 for key, tokens in refilled.items()}
+    return {key: (tokens, now) for key, tokens in refilled.items()}, wait
+
+
+class MemoryBuckets:
+    """Buckets of this process."""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._states = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def acquire(self, rules, now=None, charge=True):
+        now = time.time() if now is None else now
+        with self._lock:
+            states, wait = take({key: self._states.get(key) for key, _, _ in rules}, rules, now, charge)
+            if not charge:
+                return wait
+            self._states.update(states)
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                self._states = {k: v for k, v in self._states.items() if v[1] >= now - self.max_age}
+        return wait
+
+    def throttled(self):
+        """Keys whose bucket was empty at its last use, as [(key, updated)] newest first."""
+        with self._lock:
+            rows = [(key, updated) for key, (tokens, updated) in self._states.items() if tokens < 1]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+
+class SQLiteBuckets:
+    """Buckets in a SQLite file, shared by all worker processes of the host.
+
+    Every request is one short ``BEGIN IMMEDIATE`` transaction on its own
+    small database, so it does not compete with the application's writes.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+        self._calls = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                     'updated REAL NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # autocommit; transactions are explicit
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def acquire(self, rules, now=None, charge=True):
+        now = time.time() if now is None else now
+        conn = self._connection()
+        keys = [key for key, _, _ in rules]
+        select = f"SELECT key, tokens, updated FROM bucket WHERE key IN ({','.join('?' * len(keys))})"
+        if not charge:
+            # a plain read; nothing to write
+            return take({key: (tokens, updated) for key, tokens, updated in conn.execute(select, keys)},
+                        rules, now, charge=False)[1]
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(select, keys).fetchall()
+            states, wait = take({key: (tokens, updated) for key, tokens, updated in rows}, rules, now)
+            conn.executemany('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                             [(key, tokens, updated) for key, (tokens, updated) in states.items()])
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM bucket WHERE updated < ?', (now - self.max_age,))
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return wait
+
+    def throttled(self):
+        return self._connection().execute('SELECT key, updated FROM bucket WHERE tokens < 1 '
+                                          'ORDER BY updated DESC LIMIT 100').fetchall()
+
+
+def client_ip():
+    hops = current_app.config['RATELIMIT_PROXY_COUNT']
+    if hops:
+        forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+        # the rightmost entries were added by our proxies; anything further left is client-supplied
+        if len(forwarded) >= hops:
+            return forwarded[-hops]
+    return request.remote_addr or 'unknown'
+
+
+def _key(scope):
+    if scope == 'user' and current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    if scope == 'username':
+        username = (request.form.get('username') or '').strip().lower()
+        return f'username:{username}|ip:{client_ip()}' if username else None
+    return f'ip:{client_ip()}'
+
+
+def _rules(failures):
+    """The rules of the current request: its ``'username'`` ones with ``failures``, the others without."""
+    endpoint = request.endpoint
+    limits = current_app.config['RATELIMIT_LIMITS'].get(endpoint)
+    if not limits or request.method not in current_app.config['RATELIMIT_METHODS']:
+        return []
+    rules = []
+    for scope, burst, seconds in limits:
+        key = _key(scope) if (scope == 'username') == failures else None
+        if key is not None:
+            # one bucket per endpoint and key
+            rules.append((f'{endpoint}|{key}', burst, seconds))
+    return rules
+
+
+def failed_attempt():
+    """Take a token from the ``'username'`` buckets of the current request (call on a wrong password)."""
+    buckets = current_app.extensions.get('ccm_ratelimit')
+    rules = _rules(failures=True) if buckets is not None else []
+    if rules:
+        buckets.acquire(rules)
+
+
+def _check():
+    endpoint = request.endpoint
+    buckets = current_app.extensions['ccm_ratelimit']
+    failures, rules = _rules(failures=True), _rules(failures=False)
+    if not failures and not rules:
+        return None
+    # too many failed attempts refuse the request; only failed_attempt() takes their tokens
+    wait = buckets.acquire(failures, charge=False) if failures else 0
+    if not wait and rules:
+        wait = buckets.acquire(rules)
+    if not wait:
+        DECISIONS.inc(endpoint, 'allowed')
+        return None
+    DECISIONS.inc(endpoint, 'limited')
+    retry_after = max(1, int(wait + 0.999))
+    current_app.logger.info('Rate limited %s for %s (retry after %d s)', endpoint, client_ip(), retry_after)
+    message = f'Too many requests, please try again in {retry_after} seconds'
+    if request.blueprint == 'api' or request.is_json:
+        response = current_app.make_response(({'status': 'error', 'message': message}, 429))
+    else:
+        response = current_app.make_response((render_template('rate_limited.html', message=message), 429))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def dashboard():
+    """Rules, merged counters and throttled keys for the admin dashboard."""
+    cfg = current_app.config
+    totals = metrics.totals(DECISIONS)
+    rows = []
+    for endpoint, rules in sorted(cfg['RATELIMIT_LIMITS'].items()):
+        rows.append({'endpoint': endpoint,
+                     'rules': ', '.join(f'{burst} per {_duration(seconds)} by {scope}' for scope, burst, seconds in rules),
+                     'allowed': totals.get((endpoint, 'allowed'), 0),
+                     'limited': totals.get((endpoint, 'limited'), 0)})
+    buckets = current_app.extensions.get('ccm_ratelimit')
+    throttled = buckets.throttled()[:20] if buckets is not None else []
+    return {'enabled': cfg['RATELIMIT_ENABLED'], 'storage': cfg['RATELIMIT_STORAGE'], 'endpoints': rows,
+            'throttled': [(key, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(updated))) for key, updated in throttled]}
+
+
+def _duration(seconds):
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600} h'
+    if seconds % 60 == 0:
+        return f'{seconds // 60} min'
+    return f'{seconds} s'
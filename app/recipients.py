@@ -0,0 +1,47 @@
+"""Who gets a notification mail, resolved in one projection query.
+
+Each function returns ``Recipient`` tuples (id, email, username,
+notify_digest) — everything ``notify_users`` and the mailer need — with the
+email, opt-in and exclude-the-actor filters applied in SQL, so no ``User``
+objects or participant relationships are loaded.
+"""
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from . import db
+from .models import Participant, User
+
+Recipient = namedtuple('Recipient', 'id email username notify_digest')
+
+# the User flag each opt-in name refers to
+OPT_INS = {
+    'new_proposal': User.notify_new_proposal,
+    'discussion': User.notify_discussion,
+    'broadcast': User.notify_broadcast,
+}
+
+
+def _query(opt_in=None, exclude_user_id=None):
+    q = select(User.id, User.email, User.username, User.notify_digest).where(User.email != None, User.email != '')
+    if opt_in:
+        q = q.where(OPT_INS[opt_in] == True)
+    if exclude_user_id is not None:
+        q = q.where(User.id != exclude_user_id)
+    return q
+
+
+def _run(q):
+    return [Recipient(*row) for row in db.session.execute(q.order_by(User.id))]
+
+
+def subscriber_recipients(opt_in, exclude_user_id=None):
+    """All users with an email address who opted into ``opt_in``."""
+    return _run(_query(opt_in, exclude_user_id))
+
+
+def participant_recipients(proposal_id, opt_in='discussion', exclude_user_id=None):
+    """Participants of a proposal with an email address (and ``opt_in``, unless None)."""
+    q = (_query(opt_in, exclude_user_id).join(Participant, Participant.user_id == User.id)
+         .where(Participant.proposal_id == proposal_id))
+    return _run(q)
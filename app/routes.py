@@ -1,28 +1,32 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, g
-from . import db
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, g, abort, Response, session, send_from_directory, get_template_attribute, make_response, stream_with_context
+from . import (avatars, commitments as commitment_index, db, export, ics_feed, images, metrics, popularity, profiler,
+               ratelimit, storage)
+from .conditional import page_etag, not_modified, with_validators
+from .fragment_cache import calendar_fragments, day_versions
+from .digests import DIGEST_MODES
+from .recipients import participant_recipients, subscriber_recipients
+from .mailer import UNSUBSCRIBE_KINDS, plain_mail, read_unsubscribe_token, send_mail, send_personalized
+from .notifications import notify_users
+from .proposals import (ProposalError, add_participant, parse_date, parse_start_time, remove_participant,
+                        request_idempotency_key, submit_proposal, toggle_claim)
 from .models import Recipe, Proposal, Participant, User, Message, MailConfig
 from flask_login import current_user, login_required
-from datetime import date, timedelta, time
+from datetime import date, timedelta
 from calendar import monthrange
 import os
 from werkzeug.utils import secure_filename
 from functools import wraps
-import smtplib
-from email.message import EmailMessage
-from email.utils import formataddr
-from sqlalchemy import or_
+from sqlalchemy import select, func, update
+from sqlalchemy.orm import joinedload, selectinload
 
 from PIL import Image
-import io
 import uuid
 from datetime import datetime
 
 main = Blueprint("main", __name__)
 
-UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
 ALLOWED_EXT = {'png', 'jpg', 'jpeg', 'gif'}
 
-
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXT
 
@@ -50,17 +54,27 @@ def make_upload_filename(original_filename, username):
     return f"{datepart}_{uname}_{unique}.{ext}"
 
 
-def compress_image(file_stream, ext, max_size=(1600, 1600), quality=85):
-    """Open an image from file_stream (werkzeug FileStorage .stream or bytes), resize if larger than max_size
-    and return bytes for the compressed image.
+def compress_image(file_stream, ext, dst, max_size=(1600, 1600), quality=85):
+    """Open an image from file_stream (werkzeug FileStorage .stream or a path), resize it if larger than
+    max_size and write the compressed image to the local path dst. Returns False if file_stream is not an image;
+    raises images.ImageTooLarge if it has too many pixels.
     """
+    with metrics.IMAGE_SECONDS.time('compress_image'):
+        ok = _compress_image(file_stream, ext, dst, max_size, quality)
+    if ok:
+        metrics.IMAGE_BYTES.observe(os.path.getsize(dst), 'compress_image')
+    return ok
+
+
+def _compress_image(file_stream, ext, dst, max_size, quality):
     try:
-        img = Image.open(file_stream)
+        img = images.open_image(file_stream, max_size)
+    except images.ImageTooLarge:
+        raise
     except Exception:
         # not an image
-        return None
+        return False
     # convert PNG with alpha to RGB+white background for JPEG output if needed
-    original_mode = img.mode
     if img.mode in ("RGBA", "LA"):
         background = Image.new("RGBA", img.size, (255, 255, 255, 255))
         background.paste(img, mask=img.split()[-1])
@@ -71,101 +85,46 @@ def compress_image(file_stream, ext, max_size=(1600, 1600), quality=85):
     # resize if bigger than max_size
     img.thumbnail(max_size, Image.LANCZOS)
 
-    out = io.BytesIO()
     # use JPEG for jpg/jpeg, otherwise PNG
     if ext in ('jpg', 'jpeg'):
-        img.save(out, format='JPEG', quality=quality, optimize=True)
+        img.save(dst, format='JPEG', quality=quality, optimize=True)
     else:
         # for png keep optimize but reduce if possible
-        img.save(out, format='PNG', optimize=True)
-    out.seek(0)
-    return out
+        img.save(dst, format='PNG', optimize=True)
+    return True
+
+
+def save_upload(file, name, ext, **kwargs):
+    """Store an uploaded image as name, compressed; False (nothing stored) if the image is too large."""
+    try:
+        with storage.get_storage().writer(name) as dst:
+            if not compress_image(file.stream, ext, dst, **kwargs):
+                # not an image Pillow can read: keep the upload as it is
+                file.stream.seek(0)
+                file.save(dst)
+    except images.ImageTooLarge as e:
+        current_app.logger.info('Rejected upload %s: %s', file.filename, e)
+        return False
+    return True
+
+
+def image_too_large_message():
+    return f"Image too large (at most {current_app.config['IMAGE_MAX_PIXELS'] // 1_000_000} megapixels)"
 
 
 @main.before_app_request
 def load_mail_config():
     # make mail config available in templates via g.mail_ok and g.mail_cfg
     g.mail_ok = False
+    if request.endpoint == 'main.calendar_feed':
+        # polled by calendar apps, renders no page
+        return
     cfg = MailConfig.query.first()
     g.mail_cfg = cfg
     if cfg and cfg.smtp_server and cfg.username and cfg.password and cfg.from_address:
         g.mail_ok = True
 
 
-def send_mail(subject, text_body, recipients, html_body=None):
-    # send mail using MailConfig if configured, otherwise return False
-    cfg = MailConfig.query.first()
-    # Global admin switch: treat missing or False as disabled (default: off)
-    if not cfg or not getattr(cfg, 'mail_notifications_enabled', False):
-        return False
-    if not cfg.smtp_server or not cfg.username or not cfg.password or not cfg.from_address:
-        return False
-    try:
-        msg = EmailMessage()
-        msg['Subject'] = subject
-        msg['From'] = formataddr(("Cleverly Connected Meals (CCM)", cfg.from_address))
-        msg['To'] = ', '.join(recipients)
-        # plain text part
-        msg.set_content(text_body)
-        # build HTML part if not provided
-        host = cfg.site_host.strip() if cfg and cfg.site_host else 'https://ccm-m.aiwald.de'
-        footer = f'<hr><p style="font-size:small;color:gray">Manage email notifications in your profile settings: <a href="{host.rstrip("/")}/profile">Profile settings</a></p>'
-        if html_body is None:
-            # simple paragraph conversion
-            paragraphs = [f"<p>{line}</p>" for line in text_body.split('\n') if line.strip()]
-            html_body = '<html><body>' + ''.join(paragraphs) + footer + '</body></html>'
-        else:
-            # append footer
-            html_body = html_body + footer
-        msg.add_alternative(html_body, subtype='html')
-
-        if cfg.use_tls:
-            s = smtplib.SMTP(cfg.smtp_server, cfg.smtp_port, timeout=10)
-            s.starttls()
-        else:
-            s = smtplib.SMTP(cfg.smtp_server, cfg.smtp_port, timeout=10)
-        s.login(cfg.username , cfg.password)
-        s.send_message(msg)
-        s.quit()
-        return True
-    except Exception as e:
-        current_app.logger.exception('Mail send failed: %s', e)
-        return False
-
-
-# helper to create nicer subjects and bodies for proposal-related mails
-def make_proposal_mail(proposal, action, actor, extra_text=None):
-    """Return (subject, text_body, html_body).
-    HTML is rendered from a template with full context.
-    """
-    short_date = proposal.date.strftime('%d.%m')
-    subject = f"{actor} {action} | {proposal.recipe.title} | {short_date}"
-
-    try:
-        discussion_path = url_for('main.proposal_discuss', proposal_id=proposal.id)
-    except Exception:
-        discussion_path = f"/proposal/{proposal.id}/discuss"
-    cfg = MailConfig.query.first()
-    host = cfg.site_host.strip() if cfg and cfg.site_host else 'https://ccm-m.aiwald.de'
-    discussion_url = f"{host.rstrip('/')}" + discussion_path
-
-    text_lines = [f"Hello,", "", f"{actor} {action} for the meal \"{proposal.recipe.title}\" on {short_date}."]
-    if extra_text:
-        text_lines.extend(["", extra_text])
-    text_lines.extend(["", f"View the discussion and details here: {discussion_url}", "", "Best regards,", "Cleverly Connected Meals (CCM)"])
-    text_body = "\n".join(text_lines)
-
-    # render HTML template for nicer emails
-    try:
-        html_body = render_template('email/proposal_email.html', subject=subject, actor=actor, action=action, proposal_title=proposal.recipe.title, short_date=short_date, extra_text=extra_text, discussion_url=discussion_url, host=host)
-    except Exception:
-        # fallback to simple HTML
-        html_p = ''.join(f"<p>{line}</p>" for line in text_lines if line)
-        html_body = f"<html><body>{html_p}</body></html>"
-
-    return subject, text_body, html_body
-
-
 @main.route("/")
 @login_required
 def index():
@@ -211,18 +170,11 @@ def add_recipe():
             original = secure_filename(file.filename)
             ext = original.rsplit('.', 1)[1].lower() if '.' in original else 'jpg'
             newname = make_upload_filename(original, current_user.username)
-            dst = os.path.join(UPLOAD_FOLDER, newname)
-            # ensure upload folder exists
-            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-            # compress/resize large images; if compress_image returns None, fall back to saving raw
-            compressed = compress_image(file.stream, ext)
-            if compressed:
-                with open(dst, 'wb') as f:
-                    f.write(compressed.read())
+            # compress/resize large images; anything Pillow cannot read is saved raw
+            if save_upload(file, newname, ext):
+                r.image = newname
             else:
-                file.stream.seek(0)
-                file.save(dst)
-            r.image = newname
+                flash(image_too_large_message(), 'warning')
 
         db.session.add(r)
         db.session.commit()
@@ -232,6 +184,61 @@ def add_recipe():
     return render_template("add_recipe.html")
 
 
+def table_stamp(model):
+    """Scalar subqueries (max updated_at, row count, max id) that change whenever a row
+    of ``model`` is inserted, updated or deleted."""
+    return (select(func.max(model.updated_at)).scalar_subquery(),
+            select(func.count(model.id)).scalar_subquery(),
+            select(func.max(model.id)).scalar_subquery())
+
+
+def touch_proposal(p):
+    # participants and messages live in other tables; bump the proposal's version stamp
+    p.updated_at = datetime.utcnow()
+
+
+def touch_joined_proposals(user_id):
+    # the same for every proposal ``user_id`` takes part in, in one statement: for bulk changes of their
+    # participant rows and for changes of how participants are shown (the avatar on the discussion page)
+    db.session.execute(update(Proposal)
+                       .where(Proposal.id.in_(select(Participant.proposal_id).where(Participant.user_id == user_id)))
+                       .values(updated_at=datetime.utcnow())
+                       .execution_options(synchronize_session=False))
+
+
+def calendar_day_cells(days_list):
+    """Return {date: [cell, ...]} for the calendar days, from the fragment cache where possible.
+
+    A cell holds the proposal id, proposer id, participant ids and the rendered
+    user-independent card summary; days missing from the cache are loaded with
+    one eager-loading query.
+    """
+    fragments = calendar_fragments()
+    versions = day_versions(days_list) if fragments else {}
+    cells, missing = {}, {}
+    for d in days_list:
+        key, cached = fragments.lookup(d, versions.get(d)) if fragments else (None, None)
+        if cached is None:
+            missing[d] = key
+        else:
+            cells[d] = cached
+    if missing:
+        summary = get_template_attribute('_calendar_cells.html', 'proposal_summary')
+        loaded = {d: [] for d in missing}
+        proposals = Proposal.query.options(
+            joinedload(Proposal.recipe), joinedload(Proposal.proposer), selectinload(Proposal.participants)
+        ).filter(Proposal.date.in_(list(missing))).order_by(Proposal.id).all()
+        for p in proposals:
+            loaded[p.date].append({'id': p.id, 'proposer_id': p.proposer_id,
+                                   'participant_ids': frozenset(pa.user_id for pa in p.participants),
+                                   'summary': summary(p)})
+        for d, key in missing.items():
+            cells[d] = loaded[d]
+            if key is not None:
+                fragments.store(key, loaded[d])
+    return cells
+
+
 @main.route('/calendar')
 @login_required
 def calendar_view():
@@ -251,12 +258,19 @@ def calendar_view():
         year, week = today.isocalendar()[0], today.isocalendar()[1]
         start = date.fromisocalendar(year, week, 1)
 
+    # the page shows the week grid, the user's commitments (any future proposal) and
+    # the propose modal (all recipes): stamp both tables as a whole
+    stamp = db.session.execute(select(*table_stamp(Proposal), *table_stamp(Recipe))).one()
+    etag = page_etag(today, year, week, tuple(stamp))
+    last_modified = max((t for t in (stamp[0], stamp[3]) if t), default=None)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
+
     # show only Monday..Friday
     days_list = [start + timedelta(days=i) for i in range(5)]
-    days = []
-    for d in days_list:
-        proposals = Proposal.query.filter_by(date=d).all()
-        days.append({'date': d, 'proposals': proposals})
+    cells = calendar_day_cells(days_list)
+    days = [{'date': d, 'proposals': cells[d]} for d in days_list]
 
     # prev/next week params
     prev_start = start - timedelta(weeks=1)
@@ -270,29 +284,32 @@ def calendar_view():
     commitments = []
     if current_user.is_authenticated:
         # show only commitments from today onwards
-        commitments = Proposal.query.outerjoin(Participant).filter(
-            or_(Participant.user_id == current_user.id,
-                Proposal.cook_user_id == current_user.id,
-                Proposal.grocery_user_id == current_user.id),
-            Proposal.date >= today
-        ).distinct().order_by(Proposal.date.asc(), Proposal.start_time.asc()).all()
-
-    return render_template('calendar.html', days=days, recipes=recipes,
+        commitments = commitment_index.upcoming_proposals(current_user.id, today, options=(
+            joinedload(Proposal.recipe), joinedload(Proposal.proposer), selectinload(Proposal.participants)))
+
+    html = render_template('calendar.html', days=days, recipes=recipes,
                            week=week, year=year,
                            prev_year=prev_year, prev_week=prev_week,
                            next_year=next_year, next_week=next_week,
                            today=today, commitments=commitments)
+    return with_validators(make_response(html), etag, last_modified)
 
 
-def make_thumbnail(saved_path, thumb_size=(400, 300), bg_color=(255,255,255)):
-    """Create a thumbnail JPG for the given saved image path.
-    Returns the thumbnail filename (basename) or None on failure.
-    Thumbnail filename convention: <origname>_thumb.jpg
+def make_thumbnail(name, thumb_size=(400, 300), bg_color=(255,255,255)):
+    """Create a thumbnail JPG for the stored upload name.
+    Returns the thumbnail name or None on failure.
+    Thumbnail name convention: <origname>_thumb.jpg
     """
+    with metrics.IMAGE_SECONDS.time('make_thumbnail'):
+        return _make_thumbnail(name, thumb_size, bg_color)
+
+
+def _make_thumbnail(name, thumb_size, bg_color):
+    store = storage.get_storage()
     try:
-        if not os.path.exists(saved_path):
-            return None
-        img = Image.open(saved_path)
+        with store.local_copy(name) as src:
+            img = images.open_image(src, thumb_size)
+            img.load()
     except Exception:
         return None
     try:
@@ -305,96 +322,82 @@ def make_thumbnail(saved_path, thumb_size=(400, 300), bg_color=(255,255,255)):
             img = img.convert('RGB')
 
         img.thumbnail(thumb_size, Image.LANCZOS)
-        base, _ = os.path.splitext(os.path.basename(saved_path))
+        base, _ = os.path.splitext(name)
         thumb_name = f"{base}_thumb.jpg"
-        thumb_path = os.path.join(UPLOAD_FOLDER, thumb_name)
-        # Ensure folder exists
-        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
-        img.save(thumb_path, format='JPEG', quality=80, optimize=True)
+        with store.writer(thumb_name) as dst:
+            img.save(dst, format='JPEG', quality=80, optimize=True)
+            metrics.IMAGE_BYTES.observe(os.path.getsize(dst), 'make_thumbnail')
         return thumb_name
     except Exception:
-        current_app.logger.exception('Thumbnail creation failed for %s', saved_path)
+        current_app.logger.exception('Thumbnail creation failed for %s', name)
         return None
 
 
 @main.route('/recipes')
 @login_required
 def recipes_list():
+    sort = request.args.get('sort', 'new')
+    if sort not in popularity.RECIPE_ORDERS:
+        sort = 'new'
+    # popularity counters live on the recipe rows, so the recipe stamp covers them
+    stamp = db.session.execute(select(*table_stamp(Recipe))).one()
+    etag = page_etag(sort, tuple(stamp))
+    cached = not_modified(etag, stamp[0])
+    if cached:
+        return cached
+
     # show all recipes (not only user's) so users can browse and propose any recipe
-    recipes = Recipe.query.order_by(Recipe.created_at.desc()).all()
+    recipes = Recipe.query.order_by(*popularity.recipe_order(sort)).all()
 
     # attach thumbnail URL if thumbnail file exists
+    store = storage.get_storage()
     for r in recipes:
         r.thumb_url = None
         if getattr(r, 'image', None):
             base, ext = os.path.splitext(r.image)
             thumb_name = f"{base}_thumb.jpg"
-            thumb_path = os.path.join(UPLOAD_FOLDER, thumb_name)
-            if os.path.exists(thumb_path):
-                try:
-                    r.thumb_url = url_for('static', filename='uploads/' + thumb_name)
-                except Exception:
-                    r.thumb_url = None
+            if store.exists(thumb_name):
+                r.thumb_url = store.url(thumb_name)
             else:
                 # if thumbnail missing but original exists, attempt to create it
-                orig_path = os.path.join(UPLOAD_FOLDER, r.image)
-                created = make_thumbnail(orig_path)
+                created = make_thumbnail(r.image)
                 if created:
-                    try:
-                        r.thumb_url = url_for('static', filename='uploads/' + created)
-                    except Exception:
-                        r.thumb_url = None
+                    r.thumb_url = store.url(created)
 
-    return render_template('recipes_list.html', recipes=recipes)
+    html = render_template('recipes_list.html', recipes=recipes, sort=sort, sorts=popularity.RECIPE_ORDERS)
+    return with_validators(make_response(html), etag, stamp[0])
+
+
+def propose_from_request(recipe_id, date_str, start_time_str):
+    """Create a proposal through the proposal service and flash the outcome; None on error."""
+    try:
+        p, created = submit_proposal(current_user, recipe_id, parse_date(date_str), parse_start_time(start_time_str),
+                                     request_idempotency_key())
+    except ProposalError as e:
+        flash(str(e), 'warning')
+        return None
+    if created:
+        flash('Proposal created', 'success')
+    else:
+        flash('You already proposed this recipe for that day', 'info')
+    return p
 
 
 @main.route('/proposal/propose/<int:recipe_id>/<date_str>', methods=['POST'])
 @login_required
 def propose_recipe(recipe_id, date_str):
-    d = date.fromisoformat(date_str)
-    start_time_str = request.form.get('start_time') or request.args.get('start_time')
-    st = None
-    if start_time_str:
-        try:
-            hh, mm = start_time_str.split(':')
-            st = time(int(hh), int(mm))
-        except Exception:
-            st = None
-    p = Proposal(date=d, recipe_id=recipe_id, proposer_id=current_user.id)
-    p.start_time = st
-    db.session.add(p)
-    db.session.commit()
-    flash('Proposal created', 'success')
-    # notify users who opted into new-proposal emails (exclude proposer)
-    recipients = [u.email for u in User.query.filter(User.id != current_user.id, User.email != None, User.email != '', User.notify_new_proposal == True).all()]
-    if recipients:
-        subj, text_body, html_body = make_proposal_mail(p, 'created a proposal', current_user.username)
-        send_mail(subj, text_body, recipients, html_body)
-    return redirect(url_for('main.calendar_view', year=d.year, month=d.month))
+    p = propose_from_request(recipe_id, date_str, request.form.get('start_time') or request.args.get('start_time'))
+    if p is None:
+        return redirect(url_for('main.recipes_list'))
+    return redirect(url_for('main.calendar_view', year=p.date.year, month=p.date.month))
 
 
 @main.route('/proposal/create/<int:recipe_id>/<date_str>', methods=['POST'])
 @login_required
 def create_proposal(recipe_id, date_str):
-    d = date.fromisoformat(date_str)
-    start_time_str = request.form.get('start_time')
-    st = None
-    if start_time_str:
-        try:
-            hh, mm = start_time_str.split(':')
-            st = time(int(hh), int(mm))
-        except Exception:
-            st = None
-    p = Proposal(date=d, recipe_id=recipe_id, proposer_id=current_user.id)
-    p.start_time = st
-    db.session.add(p)
-    db.session.commit()
-    flash('Proposal created', 'success')
-    # notify users who opted into new-proposal emails (exclude proposer)
-    recipients = [u.email for u in User.query.filter(User.id != current_user.id, User.email != None, User.email != '', User.notify_new_proposal == True).all()]
-    if recipients:
-        subj, text_body, html_body = make_proposal_mail(p, 'created a proposal', current_user.username)
-        send_mail(subj, text_body, recipients, html_body)
+    p = propose_from_request(recipe_id, date_str, request.form.get('start_time'))
+    if p is None:
+        return redirect(url_for('main.recipes_list'))
     return redirect(url_for('main.calendar_view'))
 
 
@@ -402,18 +405,16 @@ def create_proposal(recipe_id, date_str):
 @login_required
 def join_proposal(proposal_id):
     p = Proposal.query.get_or_404(proposal_id)
-    if any(part.user_id == current_user.id for part in p.participants):
+    if not add_participant(p, current_user.id):
+        db.session.rollback()
         flash('Already joined', 'info')
     else:
-        part = Participant(user_id=current_user.id, proposal_id=p.id)
-        db.session.add(part)
+        touch_proposal(p)
         db.session.commit()
         flash('Joined', 'success')
         # notify other participants who opted into discussion notifications
-        recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-        if recipients:
-            subj, text_body, html_body = make_proposal_mail(p, 'joined the meal', current_user.username)
-            send_mail(subj, text_body, recipients, html_body)
+        recipients = participant_recipients(p.id, exclude_user_id=current_user.id)
+        notify_users(recipients, p, 'joined the meal', current_user.username)
     # decide where to redirect based on optional 'next' parameter
     next_param = (request.form.get('next') or request.args.get('next') or '').lower()
     if next_param == 'discuss':
@@ -426,16 +427,12 @@ def join_proposal(proposal_id):
 @login_required
 def unjoin_proposal(proposal_id):
     p = Proposal.query.get_or_404(proposal_id)
-    part = Participant.query.filter_by(proposal_id=p.id, user_id=current_user.id).first()
-    if part:
-        # prepare recipients before removal
-        recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-        db.session.delete(part)
+    if remove_participant(p, current_user.id):
+        recipients = participant_recipients(p.id, exclude_user_id=current_user.id)
+        touch_proposal(p)
         db.session.commit()
         flash('Left', 'success')
-        if recipients:
-            subj, text_body, html_body = make_proposal_mail(p, 'left the meal', current_user.username)
-            send_mail(subj, text_body, recipients, html_body)
+        notify_users(recipients, p, 'left the meal', current_user.username)
     # redirect to either the discussion page or the calendar week depending on 'next'
     next_param = (request.form.get('next') or request.args.get('next') or '').lower()
     if next_param == 'discuss':
@@ -466,46 +463,69 @@ def profile_update_notifications(user_id):
     u.notify_new_proposal = bool(request.form.get('notify_new_proposal'))
     u.notify_discussion = bool(request.form.get('notify_discussion'))
     u.notify_broadcast = bool(request.form.get('notify_broadcast'))
+    if request.form.get('notify_digest') in DIGEST_MODES:
+        u.notify_digest = request.form['notify_digest']
     db.session.commit()
     flash('Notification settings updated', 'success')
     return redirect(url_for('main.profile', user_id=user_id))
 
 
+@main.route('/unsubscribe/<token>', methods=['GET', 'POST'])
+def unsubscribe(token):
+    """Unsubscribe link from notification mails; works without logging in.
+
+    GET only asks for confirmation so that link scanners cannot unsubscribe
+    anyone; POST (the button, or a mail client's one-click request) applies it.
+    """
+    data = read_unsubscribe_token(token)
+    user = db.session.get(User, data[0]) if data else None
+    if user is None:
+        abort(404)
+    kind = data[1]
+    if request.method == 'POST':
+        for field in UNSUBSCRIBE_KINDS[kind]:
+            setattr(user, field, False)
+        db.session.commit()
+    return render_template('unsubscribe.html', user=user, kind=kind, token=token, done=request.method == 'POST')
+
+
+@main.route('/calendar/feed/<token>.ics')
+def calendar_feed(token):
+    """The user's meals as an iCalendar feed; the token in the URL is the only credential."""
+    user = ics_feed.user_for_token(token)
+    if user is None:
+        abort(404)
+    etag, body = ics_feed.feed(user)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    return with_validators(current_app.response_class(body, mimetype='text/calendar'), etag)
+
+
+@main.route('/profile/calendar-feed', methods=['POST'])
+@login_required
+def profile_calendar_feed():
+    # creates the feed URL, or replaces it so that the old one stops working
+    renew = current_user.calendar_token is not None
+    ics_feed.new_token(current_user)
+    db.session.commit()
+    flash('New calendar link created; the old one no longer works' if renew else 'Calendar link created', 'success')
+    return redirect(url_for('main.profile', user_id=current_user.id))
+
+
 @main.route('/proposal/propose', methods=['POST'])
 @login_required
 def propose_recipe_form():
     # Accept form with 'recipe_id' and 'date' (ISO yyyy-mm-dd)
     recipe_id = request.form.get('recipe_id')
     date_str = request.form.get('date')
-    start_time_str = request.form.get('start_time')
-    st = None
-    if start_time_str:
-        try:
-            hh, mm = start_time_str.split(':')
-            st = time(int(hh), int(mm))
-        except Exception:
-            st = None
-
     if not recipe_id or not date_str:
         flash('Recipe and date required', 'warning')
         return redirect(url_for('main.recipes_list'))
-    try:
-        d = date.fromisoformat(date_str)
-    except ValueError:
-        flash('Invalid date', 'warning')
+    p = propose_from_request(recipe_id, date_str, request.form.get('start_time'))
+    if p is None:
         return redirect(url_for('main.recipes_list'))
-
-    p = Proposal(date=d, recipe_id=int(recipe_id), proposer_id=current_user.id)
-    p.start_time = st
-    db.session.add(p)
-    db.session.commit()
-    flash('Proposal created', 'success')
-    # notify users who opted into new-proposal emails (exclude proposer)
-    recipients = [u.email for u in User.query.filter(User.id != current_user.id, User.email != None, User.email != '', User.notify_new_proposal == True).all()]
-    if recipients:
-        subj, text_body, html_body = make_proposal_mail(p, 'created a proposal', current_user.username)
-        send_mail(subj, text_body, recipients, html_body)
-    return redirect(url_for('main.calendar_view', year=d.year, month=d.month))
+    return redirect(url_for('main.calendar_view', year=p.date.year, month=p.date.month))
 
 
 @main.route('/recipe/upload', methods=['POST'])
@@ -519,15 +539,9 @@ def upload_recipe_image():
     original = secure_filename(file.filename)
     ext = original.rsplit('.', 1)[1].lower() if '.' in original else 'jpg'
     newname = make_upload_filename(original, current_user.username)
-    dst = os.path.join(UPLOAD_FOLDER, newname)
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    compressed = compress_image(file.stream, ext)
-    if compressed:
-        with open(dst, 'wb') as f:
-            f.write(compressed.read())
-    else:
-        file.stream.seek(0)
-        file.save(dst)
+    if not save_upload(file, newname, ext):
+        flash(image_too_large_message(), 'warning')
+        return redirect(url_for('main.recipes_list'))
     if recipe_id:
         r = Recipe.query.get(int(recipe_id))
         if r and r.user_id == current_user.id:
@@ -547,40 +561,44 @@ def upload_avatar():
     original = secure_filename(file.filename)
     ext = original.rsplit('.', 1)[1].lower() if '.' in original else 'jpg'
     newname = make_upload_filename(original, current_user.username)
-    dst = os.path.join(UPLOAD_FOLDER, newname)
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    compressed = compress_image(file.stream, ext)
-    if compressed:
-        with open(dst, 'wb') as f:
-            f.write(compressed.read())
-    else:
-        file.stream.seek(0)
-        file.save(dst)
+    if not save_upload(file, newname, ext):
+        flash(image_too_large_message(), 'warning')
+        return redirect(url_for('main.profile', user_id=current_user.id))
+    # small square versions for the 40-96px places the avatar is shown
+    avatars.make_renditions(newname)
     current_user.avatar = newname
+    touch_joined_proposals(current_user.id)
     db.session.commit()
     flash('Avatar updated', 'success')
     return redirect(url_for('main.profile', user_id=current_user.id))
 
 
+@main.route('/media/<name>')
+def media(name):
+    # uploads that are not under /static: another upload folder, private uploads, or S3 in proxy mode
+    private = current_app.config['UPLOADS_PRIVATE']
+    if private and not current_user.is_authenticated:
+        abort(403)
+    try:
+        response = storage.get_storage().send(name)
+    except storage.StorageError:
+        abort(404)
+    if private:
+        response.cache_control.public = False
+        response.cache_control.private = True
+    return response
+
+
 @main.route('/proposal/propose_js', methods=['POST'])
 @login_required
 def propose_recipe_js():
-    data = request.get_json() or {}
-    recipe_id = data.get('recipe_id')
-    date_str = data.get('date')
-    start_time_str = data.get('start_time')
-    st = None
-    if start_time_str:
-        try:
-            hh, mm = start_time_str.split(':')
-            st = time(int(hh), int(mm))
-        except Exception:
-            st = None
-    p = Proposal(date=d, recipe_id=int(recipe_id), proposer_id=current_user.id)
-    p.start_time = st
-    db.session.add(p)
-    db.session.commit()
-    return {'status': 'ok'}
+    data = request.get_json(silent=True) or {}
+    try:
+        p, created = submit_proposal(current_user, data.get('recipe_id'), parse_date(data.get('date')),
+                                     parse_start_time(data.get('start_time')), request_idempotency_key(data))
+    except ProposalError as e:
+        return {'status': 'error', 'message': str(e)}, 400
+    return {'status': 'ok', 'id': p.id, 'created': created}
 
 
 @main.route('/proposal/delete/<int:proposal_id>', methods=['POST'])
@@ -594,13 +612,12 @@ def delete_proposal(proposal_id):
     # prepare info before deletion
     title = p.recipe.title
     pdate = p.date
-    recipients = [pa.user.email for pa in p.participants if pa.user.email]
+    recipients = participant_recipients(p.id, opt_in=None)
+    popularity.discard(p)
     db.session.delete(p)
     db.session.commit()
     flash('Proposal removed', 'success')
-    if recipients:
-        subj, text_body, html_body = make_proposal_mail(p, 'removed the proposal', current_user.username, extra_text=f'The proposal was removed by {current_user.username}.')
-        send_mail(subj, text_body, recipients, html_body)
+    notify_users(recipients, p, 'removed the proposal', current_user.username, extra_text=f'The proposal was removed by {current_user.username}.')
     return redirect(url_for('main.calendar_view', year=pdate.year, month=pdate.month))
 
 
@@ -608,27 +625,20 @@ def delete_proposal(proposal_id):
 @login_required
 def claim_grocery(proposal_id):
     p = Proposal.query.get_or_404(proposal_id)
-    # if already claimed by someone else, prevent
-    if p.grocery_user_id and p.grocery_user_id != current_user.id:
+    # one conditional UPDATE decides: release if the user holds it, claim if free
+    outcome = toggle_claim(p, 'grocery', current_user.id)
+    if outcome == 'taken':
+        db.session.rollback()
         flash('Already claimed by someone else', 'warning')
         return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
-    # toggle: if current user already claimed, unclaim
-    if p.grocery_user_id == current_user.id:
-        p.grocery_user_id = None
-        db.session.commit()
+    db.session.commit()
+    recipients = participant_recipients(p.id, exclude_user_id=current_user.id)
+    if outcome == 'released':
         flash('You unclaimed grocery duty', 'success')
-        recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-        if recipients:
-            subj, text_body, html_body = make_proposal_mail(p, 'unclaimed grocery duty', current_user.username)
-            send_mail(subj, text_body, recipients, html_body)
+        notify_users(recipients, p, 'unclaimed grocery duty', current_user.username)
     else:
-        p.grocery_user_id = current_user.id
-        db.session.commit()
         flash('You will do the groceries', 'success')
-        recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-        if recipients:
-            subj, text_body, html_body = make_proposal_mail(p, 'claimed grocery duty', current_user.username)
-            send_mail(subj, text_body, recipients, html_body)
+        notify_users(recipients, p, 'claimed grocery duty', current_user.username)
     return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
 
 
@@ -636,29 +646,21 @@ def claim_grocery(proposal_id):
 @login_required
 def claim_cook(proposal_id):
     p = Proposal.query.get_or_404(proposal_id)
-    # if already claimed by someone else, prevent
-    if p.cook_user_id and p.cook_user_id != current_user.id:
+    # one conditional UPDATE decides: release if the user holds it, claim if free
+    outcome = toggle_claim(p, 'cook', current_user.id)
+    if outcome == 'taken':
+        db.session.rollback()
         flash('Already claimed by someone else', 'warning')
         return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
-    # toggle: if current user already claimed, unclaim
-    if p.cook_user_id == current_user.id:
-        p.cook_user_id = None
-        db.session.commit()
+    db.session.commit()
+    # notify participants
+    recipients = participant_recipients(p.id, exclude_user_id=current_user.id)
+    if outcome == 'released':
         flash('You unclaimed cooking duty', 'success')
-        # notify participants
-        recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-        if recipients:
-            subj, text_body, html_body = make_proposal_mail(p, 'unclaimed cooking duty', current_user.username)
-            send_mail(subj, text_body, recipients, html_body)
+        notify_users(recipients, p, 'unclaimed cooking duty', current_user.username)
     else:
-        p.cook_user_id = current_user.id
-        db.session.commit()
         flash('You will cook the meal', 'success')
-        # notify participants
-        recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-        if recipients:
-            subj, text_body, html_body = make_proposal_mail(p, 'claimed cooking duty', current_user.username)
-            send_mail(subj, text_body, recipients, html_body)
+        notify_users(recipients, p, 'claimed cooking duty', current_user.username)
     return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
 
 
@@ -671,17 +673,27 @@ def proposal_discuss(proposal_id):
         if content:
             m = Message(proposal_id=p.id, user_id=current_user.id, content=content)
             db.session.add(m)
+            touch_proposal(p)
             db.session.commit()
             # notify participants (exclude the sender)
-            recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id and getattr(pa.user, 'notify_discussion', False)]
-            if recipients:
-                subj, text_body, html_body = make_proposal_mail(p, 'left a message', current_user.username, extra_text=f'"{content}"')
-                send_mail(subj, text_body, recipients, html_body)
+            recipients = participant_recipients(p.id, exclude_user_id=current_user.id)
+            notify_users(recipients, p, 'left a message', current_user.username, extra_text=f'"{content}"')
             return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
+    # messages can also disappear when their author is deleted, so stamp them directly
+    msg_count, msg_max, recipe_updated = db.session.execute(select(
+        select(func.count(Message.id)).where(Message.proposal_id == p.id).scalar_subquery(),
+        select(func.max(Message.id)).where(Message.proposal_id == p.id).scalar_subquery(),
+        select(Recipe.updated_at).where(Recipe.id == p.recipe_id).scalar_subquery())).one()
+    etag = page_etag(p.id, p.updated_at, msg_count, msg_max, recipe_updated)
+    last_modified = max((t for t in (p.updated_at, recipe_updated) if t), default=None)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
     messages = Message.query.filter_by(proposal_id=p.id).order_by(Message.created_at.asc()).all()
     # pass explicit boolean whether current user has joined the proposal
     joined = any(part.user_id == current_user.id for part in p.participants) if current_user.is_authenticated else False
-    return render_template('proposal_discuss.html', proposal=p, messages=messages, joined=joined)
+    html = render_template('proposal_discuss.html', proposal=p, messages=messages, joined=joined)
+    return with_validators(make_response(html), etag, last_modified)
 
 
 # Admin mail config endpoints
@@ -738,7 +750,62 @@ def admin_toggle_global_notifications():
 def admin_dashboard():
     users = User.query.order_by(User.username).all()
     cfg = MailConfig.query.first()
-    return render_template('admin_dashboard.html', users=users, cfg=cfg)
+    return render_template('admin_dashboard.html', users=users, cfg=cfg,
+                           profiling=session.get(profiler.SESSION_KEY, False),
+                           profiles=profiler.list_profiles(),
+                           profile_token=request.args.get('profile_token'),
+                           ratelimit=ratelimit.dashboard())
+
+
+@main.route('/admin/profiler', methods=['POST'])
+@login_required
+@admin_required
+def admin_profiler():
+    action = request.form.get('action')
+    if action == 'enable':
+        session[profiler.SESSION_KEY] = True
+        flash('Profiling enabled for your requests', 'success')
+    elif action == 'disable':
+        session.pop(profiler.SESSION_KEY, None)
+        flash('Profiling disabled', 'success')
+    elif action == 'token':
+        # shown once on the dashboard; append ?_profile=<token> to any URL to profile that request
+        return redirect(url_for('main.admin_dashboard', profile_token=profiler.make_token(current_user.username)))
+    return redirect(url_for('main.admin_dashboard'))
+
+
+@main.route('/admin/profiler/<name>')
+@login_required
+@admin_required
+def admin_profile_download(name):
+    return send_from_directory(current_app.config['PROFILER_DIR'], secure_filename(name), as_attachment=True)
+
+
+@main.route('/metrics')
+def metrics_endpoint():
+    # Prometheus scrape target: admins, or local scrapers when METRICS_ALLOW_LOCALHOST is set
+    if not metrics.scrape_allowed():
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/admin/export/<table>')
+@login_required
+@admin_required
+def admin_export(table):
+    """Stream a table of the meal history as CSV or JSON (?format=csv|json, ?gzip=1)."""
+    fmt = request.args.get('format', 'csv')
+    if table not in export.TABLES or fmt not in export.FORMATS:
+        abort(404)
+    compress = request.args.get('gzip') == '1'
+    chunks = export.iter_export(table, fmt)
+    if compress:
+        chunks, mimetype = export.gzip_chunks(chunks), 'application/gzip'
+    else:
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/json'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={export.export_filename(table, fmt, compress)}'
+    return response
 
 
 @main.route('/admin/send_test_mail', methods=['POST'])
@@ -773,14 +840,14 @@ def admin_broadcast():
         return redirect(url_for('main.admin_dashboard'))
 
     # collect recipient emails
-    recipients = [u.email for u in User.query.filter(User.email != None, User.email != '', User.notify_broadcast == True).all()]
+    recipients = subscriber_recipients('broadcast')
     if not recipients:
         flash('No users with email addresses found', 'warning')
         return redirect(url_for('main.admin_dashboard'))
 
-    ok = send_mail(subject, message, recipients)
-    if ok:
-        flash(f'Broadcast sent to {len(recipients)} recipients', 'success')
+    sent = send_personalized(plain_mail(subject, message, 'broadcast'), recipients)
+    if sent:
+        flash(f'Broadcast sent to {sent} of {len(recipients)} recipients', 'success')
     else:
         flash('Failed to send broadcast — check mail settings and logs', 'danger')
     return redirect(url_for('main.admin_dashboard'))
@@ -885,8 +952,10 @@ def admin_delete_user(user_id):
         flash('Cannot delete yourself', 'warning')
         return redirect(url_for('main.admin_dashboard'))
     u = User.query.get_or_404(user_id)
-    # delete Participant entries where user participates
+    # delete Participant entries where user participates (after changing the proposals' ETags)
+    touch_joined_proposals(u.id)
     Participant.query.filter_by(user_id=u.id).delete()
+    commitment_index.remove_user(u.id)
     # delete messages by user
     Message.query.filter_by(user_id=u.id).delete()
     # delete proposals created by user (and their participants and messages)
@@ -907,6 +976,8 @@ def admin_delete_user(user_id):
         db.session.delete(r)
     db.session.delete(u)
     db.session.commit()
+    # participations and proposals of other users' recipes went with the user
+    popularity.reconcile()
     flash('User and related data deleted', 'success')
     return redirect(url_for('main.admin_dashboard'))
 
@@ -970,23 +1041,17 @@ def edit_recipe(recipe_id):
             original = secure_filename(file.filename)
             ext = original.rsplit('.', 1)[1].lower() if '.' in original else 'jpg'
             newname = make_upload_filename(original, current_user.username)
-            dst = os.path.join(UPLOAD_FOLDER, newname)
-            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
             # compress/resize; prefer to keep edited images somewhat smaller
-            compressed = compress_image(file.stream, ext, max_size=(1200, 1200), quality=85)
-            if compressed:
-                with open(dst, 'wb') as out:
-                    out.write(compressed.read())
+            if save_upload(file, newname, ext, max_size=(1200, 1200), quality=85):
+                # set primary image filename on the recipe
+                r.image = newname
+                # create a thumbnail for listing pages
+                try:
+                    make_thumbnail(newname)
+                except Exception:
+                    current_app.logger.exception('Failed to create thumbnail for %s', newname)
             else:
-                file.stream.seek(0)
-                file.save(dst)
-            # set primary image filename on the recipe
-            r.image = newname
-            # create a thumbnail for listing pages
-            try:
-                make_thumbnail(dst)
-            except Exception:
-                current_app.logger.exception('Failed to create thumbnail for %s', dst)
+                flash(image_too_large_message(), 'warning')
 
         db.session.commit()
         flash('Recipe updated.', 'success')
@@ -1019,7 +1084,11 @@ def delete_recipe(recipe_id):
 @login_required
 def recipe_detail(recipe_id):
     r = Recipe.query.get_or_404(recipe_id)
-    return render_template('recipe_detail.html', recipe=r)
+    etag = page_etag(r.id, r.updated_at)
+    cached = not_modified(etag, r.updated_at)
+    if cached:
+        return cached
+    return with_validators(make_response(render_template('recipe_detail.html', recipe=r)), etag, r.updated_at)
 
 
 @main.route('/users')
@@ -1044,23 +1113,14 @@ def change_start_time(proposal_id):
     if p.proposer_id != current_user.id and not getattr(current_user, 'is_admin', False):
         flash('Not allowed', 'warning')
         return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
-    start_time_str = request.form.get('start_time')
-    st = None
-    if start_time_str:
-        try:
-            hh, mm = start_time_str.split(':')
-            st = time(int(hh), int(mm))
-        except Exception:
-            st = None
-    p.start_time = st
+    p.start_time = parse_start_time(request.form.get('start_time'))
     db.session.commit()
     flash('Start time updated', 'success')
     # notify other participants (exclude actor)
-    recipients = [pa.user.email for pa in p.participants if pa.user.email and pa.user_id != current_user.id]
+    recipients = participant_recipients(p.id, opt_in=None, exclude_user_id=current_user.id)
     if recipients:
         extra = f'New start time: {p.start_time.strftime("%H:%M") if p.start_time else "12:00"}'
-        subj, text_body, html_body = make_proposal_mail(p, 'changed the start time', current_user.username, extra_text=extra)
-        send_mail(subj, text_body, recipients, html_body)
+        notify_users(recipients, p, 'changed the start time', current_user.username, extra_text=extra)
     return redirect(url_for('main.proposal_discuss', proposal_id=proposal_id))
 
 
@@ -0,0 +1,26 @@
+document.addEventListener('DOMContentLoaded', function(){
+  var tipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
+  tipTriggerList.forEach(function (el) { new bootstrap.Tooltip(el); });
+  // forms marked data-idempotent send the same key when submitted twice
+  document.querySelectorAll('form[data-idempotent]').forEach(function (form) {
+    form.addEventListener('submit', function () {
+      var input = form.querySelector('input[name="idempotency_key"]');
+      if (input && !input.value) { input.value = newIdempotencyKey(); }
+    });
+  });
+});
+function newIdempotencyKey(){
+  if (window.crypto && crypto.randomUUID) { return crypto.randomUUID(); }
+  return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+// Register minimal service worker to enable PWA install and use theme_color for system UI on Android.
+// The script tag carries the URL of sw.js (it must not move with the hashed bundle, or its scope would change).
+var serviceWorkerUrl = document.currentScript && document.currentScript.dataset.sw;
+if ('serviceWorker' in navigator && serviceWorkerUrl) {
+  window.addEventListener('load', function() {
+    navigator.serviceWorker.register(serviceWorkerUrl)
+      .then(function(reg) { console.log('Service worker registered:', reg.scope); })
+      .catch(function(err) { console.log('Service worker registration failed:', err); });
+  });
+}
@@ -0,0 +1,21 @@
+function openProposeModal(date){
+  document.getElementById('modalDate').innerText = date;
+  document.getElementById('modalDateInput').value = date;
+  // a new key per opened dialog; a double submit of this dialog reuses it
+  document.getElementById('modalIdempotencyKey').value = '';
+  var myModal = new bootstrap.Modal(document.getElementById('proposeModal'));
+  myModal.show();
+}
+
+// reorder the recipe options in place from their data attributes (no request needed)
+function sortModalRecipes(order){
+  var select = document.getElementById('modalRecipeSelect');
+  var options = Array.prototype.slice.call(select.options, 1);
+  var compare = {
+    'new': function(a, b){ return a.dataset.new - b.dataset.new; },
+    'popular': function(a, b){ return (b.dataset.cooked - a.dataset.cooked) || (b.dataset.participants - a.dataset.participants) || a.text.localeCompare(b.text); },
+    // never cooked first, then the longest ago
+    'stale': function(a, b){ return a.dataset.last.localeCompare(b.dataset.last) || a.text.localeCompare(b.text); }
+  }[order] || function(){ return 0; };
+  options.sort(compare).forEach(function(o){ select.appendChild(o); });
+}
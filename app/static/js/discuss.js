@@ -0,0 +1,24 @@
+document.addEventListener('DOMContentLoaded', function(){
+  var btn = document.getElementById('toggleTimeEdit');
+  var form = document.getElementById('timeEditForm');
+  var cancel = document.getElementById('cancelTimeEdit');
+  if(btn){
+    btn.addEventListener('click', function(){ form.style.display = (form.style.display==='none') ? 'block' : 'none'; });
+  }
+  if(cancel){
+    cancel.addEventListener('click', function(){ form.style.display='none'; });
+  }
+
+  // small-screen toggle: show/hide the small time edit form below description
+  var btnSmall = document.getElementById('toggleTimeEditSmall');
+  var formSmall = document.getElementById('timeEditFormSmall');
+  var cancelSmall = document.getElementById('cancelTimeEditSmall');
+  if(btnSmall){
+    btnSmall.addEventListener('click', function(){
+      if(formSmall) formSmall.style.display = (formSmall.style.display==='none') ? 'block' : 'none';
+    });
+  }
+  if(cancelSmall){
+    cancelSmall.addEventListener('click', function(){ if(formSmall) formSmall.style.display='none'; });
+  }
+});
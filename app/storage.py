@@ -0,0 +1,341 @@
+"""Storage of uploaded files: recipe images, avatars and their derived images.
+
+``STORAGE_BACKEND`` selects where uploads live:
+
+* ``'local'`` (default): the directory ``UPLOAD_FOLDER`` (app/static/uploads).
+  Several app nodes only see each other's uploads if they share it.
+* ``'s3'``: a bucket of S3 or of an S3-compatible store (MinIO, Ceph, or a
+  local stand-in for tests via ``STORAGE_S3_ENDPOINT_URL``); needs boto3.
+
+Files are written through ``writer(name)``, which hands out a local path and
+publishes the file only once it is complete (a rename, or one streamed
+upload), and read through ``local_copy(name)``. Templates link to uploads with
+the ``upload_url(name)`` global: the static URL for the default local folder,
+otherwise (and with ``UPLOADS_PRIVATE``) ``/media/<name>``, which the app
+serves itself, see also app/delivery.py. For S3,
+``STORAGE_S3_URL_MODE`` chooses between that proxy (default; the URLs are
+stable, so pages answered with 304 keep working), presigned URLs that expire
+after ``STORAGE_S3_URL_EXPIRES`` seconds and ``STORAGE_S3_PUBLIC_URL`` + key
+for a public bucket or CDN. Names that ``exists`` found missing on S3 are
+remembered for ``STORAGE_S3_MISSING_TTL`` seconds, so that pages showing
+avatars without renditions do not send a HEAD request per image.
+
+``flask storage migrate SOURCE DEST`` copies all files between backends.
+"""
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import Response, abort, current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from .fragment_cache import LRUCache
+
+BACKENDS = ('local', 's3')
+DEFAULT_UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
+CHUNK_SIZE = 64 * 1024
+MISSING_CACHE_SIZE = 4096
+
+
+class StorageError(RuntimeError):
+    pass
+
+
+def init_app(app):
+    app.config.setdefault('STORAGE_BACKEND', 'local')
+    app.config.setdefault('UPLOAD_FOLDER', DEFAULT_UPLOAD_FOLDER)
+    app.config.setdefault('STORAGE_S3_BUCKET', None)
+    app.config.setdefault('STORAGE_S3_PREFIX', 'uploads/')
+    app.config.setdefault('STORAGE_S3_ENDPOINT_URL', None)
+    app.config.setdefault('STORAGE_S3_REGION', None)
+    app.config.setdefault('STORAGE_S3_URL_MODE', 'proxy')
+    app.config.setdefault('STORAGE_S3_URL_EXPIRES', 3600)
+    app.config.setdefault('STORAGE_S3_PUBLIC_URL', None)
+    app.config.setdefault('STORAGE_S3_MISSING_TTL', 60)
+    app.config.setdefault('STORAGE_MEDIA_MAX_AGE', 86400)
+    # only logged-in users may see uploads; they are then always linked as /media/<name>
+    app.config.setdefault('UPLOADS_PRIVATE', False)
+    app.add_template_global(upload_url)
+
+
+def get_storage():
+    """The storage of the current app (created on first use)."""
+    store = current_app.extensions.get('ccm_storage')
+    if store is None:
+        store = current_app.extensions['ccm_storage'] = make_storage(current_app.config['STORAGE_BACKEND'])
+    return store
+
+
+def make_storage(backend):
+    cfg = current_app.config
+    if backend == 'local':
+        return LocalStorage(cfg['UPLOAD_FOLDER'], cfg['STORAGE_MEDIA_MAX_AGE'], cfg['UPLOADS_PRIVATE'])
+    if backend == 's3':
+        if not cfg['STORAGE_S3_BUCKET']:
+            raise StorageError('STORAGE_S3_BUCKET is not set')
+        return S3Storage(cfg['STORAGE_S3_BUCKET'], cfg['STORAGE_S3_PREFIX'], cfg['STORAGE_S3_ENDPOINT_URL'],
+                         cfg['STORAGE_S3_REGION'], cfg['STORAGE_S3_URL_MODE'], cfg['STORAGE_S3_URL_EXPIRES'],
+                         cfg['STORAGE_S3_PUBLIC_URL'], cfg['STORAGE_MEDIA_MAX_AGE'], cfg['STORAGE_S3_MISSING_TTL'])
+    raise StorageError(f'unknown storage backend {backend!r} (one of {", ".join(BACKENDS)})')
+
+
+def upload_url(name):
+    return get_storage().url(name)
+
+
+def check_name(name):
+    # upload names are flat, generated file names; refuse anything that could leave the root
+    if not name or safe_join('root', name) is None or '/' in name or '\\' in name:
+        raise StorageError(f'invalid upload name {name!r}')
+    return name
+
+
+class Storage:
+    """Interface of the backends; ``exists`` remembers files it has seen (names are never reused).
+
+    With ``missing_ttl`` it also remembers names it did not find, for that many
+    seconds (another worker may create them).
+    """
+
+    def __init__(self, missing_ttl=0):
+        self._known = set()
+        self._lock = threading.Lock()
+        self.missing_ttl = missing_ttl
+        self._not_found = LRUCache(MISSING_CACHE_SIZE)
+
+    def exists(self, name, fresh=False):
+        # fresh: ask the backend even for a name seen before (for repairs after files were removed by hand)
+        if not fresh:
+            if name in self._known:
+                return True
+            if self.missing_ttl and self._not_found.get(name):
+                return False
+        if self._exists(check_name(name)):
+            with self._lock:
+                self._known.add(name)
+            return True
+        if self.missing_ttl:
+            self._not_found.set(name, True, ttl=self.missing_ttl)
+        return False
+
+    def delete(self, name):
+        with self._lock:
+            self._known.discard(name)
+        self._delete(check_name(name))
+
+    def save_file(self, name, src_path):
+        with self.writer(name) as dst:
+            shutil.copyfile(src_path, dst)
+
+    def _published(self, name):
+        with self._lock:
+            self._known.add(name)
+
+
+class LocalStorage(Storage):
+
+    def __init__(self, root, max_age=None, private=False):
+        super().__init__()
+        self.root = root
+        self.max_age = max_age
+        self.private = private
+
+    def path(self, name):
+        return os.path.join(self.root, check_name(name))
+
+    def _exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def _delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def writer(self, name):
+        os.makedirs(self.root, exist_ok=True)
+        dst = self.path(name)
+        tmp = dst + '.part'
+        try:
+            yield tmp
+            os.replace(tmp, dst)
+            self._published(name)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @contextmanager
+    def local_copy(self, name):
+        path = self.path(name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        yield path
+
+    def names(self):
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.part') and not entry.name.startswith('.'):
+                yield entry.name
+
+    def url(self, name):
+        if not self.private and os.path.abspath(self.root) == os.path.abspath(DEFAULT_UPLOAD_FOLDER):
+            return url_for('static', filename='uploads/' + name)
+        return url_for('main.media', name=name)
+
+    def send(self, name):
+        return send_from_directory(self.root, check_name(name), max_age=self.max_age)
+
+
+class S3Storage(Storage):
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, url_mode='proxy', url_expires=3600,
+                 public_url=None, max_age=None, missing_ttl=60, client=None):
+        super().__init__(missing_ttl)
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise StorageError("the 's3' storage backend needs boto3 (pip install boto3)")
+            # boto3 clients are thread-safe; credentials come from the usual AWS_* variables or files
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        if url_mode not in ('proxy', 'presigned', 'public'):
+            raise StorageError(f'unknown STORAGE_S3_URL_MODE {url_mode!r}')
+        if url_mode == 'public' and not public_url:
+            raise StorageError("STORAGE_S3_URL_MODE 'public' needs STORAGE_S3_PUBLIC_URL")
+        self.client = client
+        self.ClientError = client.exceptions.ClientError
+        self.bucket = bucket
+        self.prefix = prefix or ''
+        self.url_mode = url_mode
+        self.url_expires = url_expires
+        self.public_url = public_url
+        self.max_age = max_age
+
+    def key(self, name):
+        return self.prefix + check_name(name)
+
+    def _missing(self, e):
+        return e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+            return True
+        except self.ClientError as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def _delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    @contextmanager
+    def writer(self, name):
+        key = self.key(name)
+        fd, tmp = tempfile.mkstemp(prefix='ccm-upload-', suffix=os.path.splitext(name)[1])
+        os.close(fd)
+        try:
+            yield tmp
+            self._upload(tmp, key, name)
+            self._published(name)
+        finally:
+            os.remove(tmp)
+
+    def save_file(self, name, src_path):
+        self._upload(src_path, self.key(name), name)
+        self._published(name)
+
+    def _upload(self, path, key, name):
+        # upload_file streams from disk and switches to multipart uploads for large files
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.client.upload_file(path, self.bucket, key, ExtraArgs={'ContentType': content_type})
+
+    @contextmanager
+    def local_copy(self, name):
+        key = self.key(name)
+        fd, tmp = tempfile.mkstemp(prefix='ccm-download-', suffix=os.path.splitext(name)[1])
+        os.close(fd)
+        try:
+            try:
+                self.client.download_file(self.bucket, key, tmp)
+            except self.ClientError as e:
+                if self._missing(e):
+                    raise FileNotFoundError(key)
+                raise
+            yield tmp
+        finally:
+            os.remove(tmp)
+
+    def names(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', ()):
+                name = obj['Key'][len(self.prefix):]
+                if name and '/' not in name:
+                    yield name
+
+    def url(self, name):
+        if self.url_mode == 'presigned':
+            return self.client.generate_presigned_url(
+                'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=self.url_expires)
+        if self.url_mode == 'public':
+            return f'{self.public_url.rstrip("/")}/{self.key(name)}'
+        return url_for('main.media', name=name)
+
+    def send(self, name):
+        params = {'Bucket': self.bucket, 'Key': self.key(name)}
+        if request.if_none_match:
+            params['IfNoneMatch'] = request.headers['If-None-Match']
+        try:
+            obj = self.client.get_object(**params)
+        except self.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('304', 'NotModified'):
+                # a 304 repeats the validator and caching headers of the 200 it stands for
+                headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+                return self._cache_headers(Response(status=304), headers.get('etag') or request.headers['If-None-Match'])
+            if self._missing(e):
+                abort(404)
+            raise
+        body = obj['Body']
+        response = Response(body.iter_chunks(CHUNK_SIZE), mimetype=obj.get('ContentType'), direct_passthrough=True)
+        response.content_length = obj.get('ContentLength')
+        response.call_on_close(body.close)
+        return self._cache_headers(response, obj.get('ETag'))
+
+    def _cache_headers(self, response, etag):
+        if etag:
+            response.headers['ETag'] = etag
+        if self.max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+        return response
+
+
+def migrate(source, dest, workers=8, overwrite=False):
+    """Copy every file of ``source`` to ``dest`` with ``workers`` threads; return (copied, skipped, failed) names."""
+    app = current_app._get_current_object()
+    results = {'copied': [], 'skipped': [], 'failed': []}
+
+    def copy(name):
+        with app.app_context():
+            try:
+                if not overwrite and dest.exists(name, fresh=True):
+                    return 'skipped', name
+                with source.local_copy(name) as path:
+                    dest.save_file(name, path)
+                return 'copied', name
+            except Exception:
+                app.logger.exception('copying upload %s failed', name)
+                return 'failed', name
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for outcome, name in pool.map(copy, source.names()):
+            results[outcome].append(name)
+    return results['copied'], results['skipped'], results['failed']
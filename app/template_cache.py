@@ -0,0 +1,62 @@
+"""Jinja bytecode cache and template warm-up.
+
+Compiling a template (parsing it and generating and compiling the Python
+module) costs a few milliseconds per template, which every new worker used
+to pay on the first request that rendered it, several times for pages that
+extend and include others. Two things avoid that:
+
+- Compiled templates are written to ``TEMPLATE_CACHE_DIR`` (default
+  ``instance/jinja-cache``) with Jinja's ``FileSystemBytecodeCache``. All
+  workers on a host share the directory, so a template is compiled once per
+  deployment instead of once per worker; entries carry a checksum of the
+  source and the Python version, so edited templates are recompiled.
+- ``warm_up()`` loads every template when the app is created
+  (``TEMPLATE_WARMUP``), so the first requests of a worker only render. With
+  a pre-forking server that loads the app before forking (``gunicorn
+  --preload``) the compiled templates are shared by all workers.
+"""
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def init_app(app):
+    app.config.setdefault('TEMPLATE_BYTECODE_CACHE', True)
+    app.config.setdefault('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja-cache'))
+    app.config.setdefault('TEMPLATE_WARMUP', True)
+    if not app.config['TEMPLATE_BYTECODE_CACHE']:
+        return
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        # a read-only deployment still works, it just compiles in every worker
+        app.logger.warning('Template bytecode cache disabled: %s', e)
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def warm_up(app):
+    """Load (and so compile) every template; return (templates loaded, seconds)."""
+    env = app.jinja_env
+    t0 = time.perf_counter()
+    loaded = 0
+    for name in env.list_templates():
+        try:
+            env.get_template(name)
+        except Exception:
+            # the page using it fails as before; the others still get warmed up
+            app.logger.exception('Template warm-up failed for %s', name)
+            continue
+        loaded += 1
+    return loaded, time.perf_counter() - t0
+
+
+def clear(app, bytecode=True):
+    """Forget the compiled templates of this process and, with ``bytecode``, the bytecode cache."""
+    env = app.jinja_env
+    if bytecode and env.bytecode_cache is not None:
+        env.bytecode_cache.clear()
+    if env.cache is not None:
+        env.cache.clear()
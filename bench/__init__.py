@@ -0,0 +1,11 @@
+"""Load-test and benchmark harness for the main CCM user journeys.
+
+Seeds a synthetic dataset into a scratch SQLite database, drives the app
+through the Flask test client (or a local HTTP server) and reports latency
+percentiles, SQL statements per request and process RSS. Results are written
+as JSON so runs from different commits can be diffed::
+
+    python -m bench run --users 50 --years 2 --output before.json
+    python -m bench run --users 50 --years 2 --output after.json --baseline before.json
+    python -m bench compare before.json after.json
+"""
@@ -0,0 +1,112 @@
+"""Command line entry point: ``python -m bench run|compare``."""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from . import report
+
+
+def make_app(workdir, extra_config=None):
+    """Create an app whose DB, uploads, metrics and other instance files live in ``workdir``."""
+    from app import create_app
+    config = {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'METRICS_DIR': os.path.join(workdir, 'metrics'),
+        # everything else that defaults to a path below instance/
+        'TEMPLATE_CACHE_DIR': os.path.join(workdir, 'jinja-cache'),
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+        'PROFILER_DIR': os.path.join(workdir, 'profiles'),
+        'RATELIMIT_SQLITE_PATH': os.path.join(workdir, 'ratelimit.db'),
+        'TESTING': True,
+        # the journeys post from one address far faster than any person
+        'RATELIMIT_ENABLED': False,
+    }
+    config.update(extra_config or {})
+    return create_app(config)
+
+
+def cmd_run(args):
+    from app import db
+    from .journeys import Recorder, ServerDriver, TestClientDriver, run_journeys
+    from .seed import seed
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-')
+    try:
+        rss_start = report.rss_bytes()
+        app = make_app(workdir)
+        with app.app_context():
+            summary = seed(users=args.users, recipes=args.recipes, years=args.years,
+                           proposals_per_day=args.proposals_per_day, participants=args.participants,
+                           messages=args.messages)
+            db.session.remove()
+        driver = ServerDriver(app) if args.server else TestClientDriver(app)
+        recorder = Recorder()
+        try:
+            run_journeys(driver, summary, recorder, iterations=args.iterations, clients=args.clients,
+                         weeks_back=args.weeks_back, upload_every=args.upload_every)
+        finally:
+            driver.close()
+        rss = {'start': rss_start, 'end': report.rss_bytes(), 'peak': report.peak_rss_bytes()}
+        params = {k: v for k, v in vars(args).items() if k not in ('func', 'output', 'baseline')}
+        result = report.build_result(recorder, params, summary['counts'], rss)
+    finally:
+        if args.keep:
+            print(f'kept work directory {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(report.format_result(result))
+    if args.output:
+        report.write_json(result, args.output)
+        print(f'wrote {args.output}')
+    if args.baseline:
+        lines, regressed = report.compare(report.load_json(args.baseline), result, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+def cmd_compare(args):
+    lines, regressed = report.compare(report.load_json(args.baseline), report.load_json(args.current),
+                                      args.threshold)
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='CCM load test and benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='seed a scratch database and run the user journeys')
+    run.add_argument('--users', type=int, default=50)
+    run.add_argument('--recipes', type=int, default=200)
+    run.add_argument('--years', type=int, default=2, help='years of proposal history')
+    run.add_argument('--proposals-per-day', type=float, default=1.5)
+    run.add_argument('--participants', type=int, default=6, help='max participants per proposal')
+    run.add_argument('--messages', type=int, default=8, help='messages per discussion thread')
+    run.add_argument('--iterations', type=int, default=20)
+    run.add_argument('--clients', type=int, default=5, help='number of logged-in sessions')
+    run.add_argument('--weeks-back', type=int, default=4, help='past weeks visited per round')
+    run.add_argument('--upload-every', type=int, default=5, help='upload an image every N rounds (0 = never)')
+    run.add_argument('--server', action='store_true', help='drive a local HTTP server instead of the test client')
+    run.add_argument('--output', help='write the result JSON here')
+    run.add_argument('--baseline', help='compare against this result JSON (exit 1 on regression)')
+    run.add_argument('--threshold', type=float, default=0.10, help='allowed relative p95 growth')
+    run.add_argument('--keep', action='store_true', help='keep the scratch database and uploads')
+    run.set_defaults(func=cmd_run)
+
+    cmp_ = sub.add_parser('compare', help='diff two result JSON files')
+    cmp_.add_argument('baseline')
+    cmp_.add_argument('current')
+    cmp_.add_argument('--threshold', type=float, default=0.10)
+    cmp_.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
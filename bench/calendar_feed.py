@@ -0,0 +1,96 @@
+"""Cost of calendar apps polling the .ics feeds.
+
+``python -m bench.calendar_feed`` seeds a dataset, creates a feed token for
+``--subscribers`` users and lets every one of them poll its feed the way a
+calendar app does: a first download, then polls with ``If-None-Match``.
+Then one user joins a meal and everybody polls again. It prints the time
+and SQL statements per poll for each round, and how many polls got a full
+feed (200) and how many a 304. Exits non-zero if an unchanged feed is not
+answered with 304, or if the join changed any feed other than the joining
+user's.
+"""
+import argparse
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from .__main__ import make_app
+
+
+def _poll_round(client, feeds, etags):
+    from app.instrumentation import count_queries
+    times, queries, statuses = [], [], {}
+    for user_id, url in feeds.items():
+        headers = {'If-None-Match': etags[user_id]} if user_id in etags else {}
+        t0 = time.perf_counter()
+        with count_queries() as stats:
+            response = client.get(url, headers=headers)
+        times.append((time.perf_counter() - t0) * 1000)
+        queries.append(stats['count'])
+        statuses[user_id] = response.status_code
+        if response.status_code == 200:
+            etags[user_id] = response.headers['ETag']
+    return times, queries, statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.calendar_feed')
+    parser.add_argument('--subscribers', type=int, default=300)
+    parser.add_argument('--recipes', type=int, default=120)
+    parser.add_argument('--years', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    from app import db, ics_feed
+    from app.models import Commitment, Proposal, User
+    from .seed import seed
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-feed-')
+    failed = False
+    try:
+        app = make_app(workdir)
+        with app.app_context():
+            summary = seed(users=args.subscribers, recipes=args.recipes, years=args.years, participants=8, messages=5)
+            feeds = {}
+            for user in User.query.filter(User.username.in_(summary['usernames'])):
+                feeds[user.id] = f'/calendar/feed/{ics_feed.new_token(user)}.ics'
+            db.session.commit()
+            # somebody joins a meal they were not part of yet
+            joiner = next(iter(feeds))
+            joined = Proposal.query.filter(
+                Proposal.date >= date.today(),
+                ~Proposal.id.in_(db.session.query(Commitment.proposal_id).filter_by(user_id=joiner))).first().id
+            joiner_name = db.session.get(User, joiner).username
+            events = db.session.query(Commitment.proposal_id).distinct().count()
+            db.session.remove()
+
+        poller = app.test_client()
+        etags = {}
+        rounds = [('first download', _poll_round(poller, feeds, etags)),
+                  ('unchanged', _poll_round(poller, feeds, etags))]
+        actor = app.test_client()
+        actor.post('/auth/login', data={'username': joiner_name, 'password': 'bench'})
+        actor.post(f'/proposal/join/{joined}')
+        rounds.append(('after a join', _poll_round(poller, feeds, etags)))
+        rounds.append(('unchanged again', _poll_round(poller, feeds, etags)))
+
+        print(f'{len(feeds)} subscribers, {events} proposals with commitments')
+        print(f"{'round':<18}{'median ms':>10}{'p95 ms':>8}{'queries':>9}{'200':>6}{'304':>6}")
+        for name, (times, queries, statuses) in rounds:
+            codes = list(statuses.values())
+            p95 = statistics.quantiles(times, n=20)[-1] if len(times) > 1 else times[0]
+            print(f'{name:<18}{statistics.median(times):>10.2f}{p95:>8.2f}{max(queries):>9}'
+                  f'{codes.count(200):>6}{codes.count(304):>6}')
+        for name in ('unchanged', 'unchanged again'):
+            failed |= any(code != 304 for code in dict(rounds)[name][2].values())
+        changed = {uid for uid, code in dict(rounds)['after a join'][2].items() if code != 304}
+        failed |= changed != {joiner}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Concurrent claims and joins: prove exactly one winner.
+
+``python -m bench.claims_stress`` creates ``--proposals`` proposals and lets
+``--threads`` users race on each of them through the proposal service (one
+app context and DB session per thread, released together by a barrier):
+
+* everybody claims the cook duty: exactly one ``'claimed'`` per proposal and
+  ``cook_user_id`` is the winner;
+* everybody joins twice: exactly one participant row per user;
+* the commitment index and the popularity counters match a rebuild.
+
+``--legacy`` runs the former read-decide-write claim next to it to show the
+lost updates it allowed. Exits non-zero on any violation.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import date, timedelta
+
+from .__main__ import make_app
+
+
+def _legacy_claim(p, user_id):
+    # the handler before conditional UPDATEs: read, decide in Python, write
+    if p.cook_user_id is None:
+        p.cook_user_id = user_id
+        return 'claimed'
+    return 'taken'
+
+
+def _race(app, proposal_id, user_ids, action, errors):
+    from app import db
+    from app.models import Proposal
+    barrier = threading.Barrier(len(user_ids))
+    results = {}
+
+    def worker(uid):
+        with app.app_context():
+            try:
+                p = db.session.get(Proposal, proposal_id)
+                barrier.wait(timeout=60)
+                results[uid] = action(p, uid)
+                db.session.commit()
+            except Exception as e:  # a failed worker is a finding, not a crash of the run
+                barrier.abort()
+                db.session.rollback()
+                errors.append(f'user {uid}: {e!r}')
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(uid,)) for uid in user_ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def run(app, proposals, threads, legacy=False):
+    from app import commitments, db, popularity
+    from app.models import Commitment, Participant, Proposal, Recipe, User
+    from app.proposals import add_participant, toggle_claim
+
+    with app.app_context():
+        users = [User(username=f'racer{i}', email=f'racer{i}@example.com', password_hash='x') for i in range(threads)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [u.id for u in users]
+        recipe_id = Recipe.query.first().id
+        ps = [Proposal(date=date.today() + timedelta(days=1 + i), recipe_id=recipe_id, proposer_id=user_ids[0])
+              for i in range(proposals)]
+        db.session.add_all(ps)
+        db.session.commit()
+        proposal_ids = [p.id for p in ps]
+        db.session.remove()
+
+    failures, errors = [], []
+    claim = _legacy_claim if legacy else (lambda p, uid: toggle_claim(p, 'cook', uid))
+    for pid in proposal_ids:
+        results = _race(app, pid, user_ids, claim, errors)
+        winners = [uid for uid, r in results.items() if r == 'claimed']
+        with app.app_context():
+            cook = db.session.get(Proposal, pid).cook_user_id
+        if len(winners) != 1 or cook != winners[0]:
+            failures.append(f'proposal {pid}: {len(winners)} winner(s), cook_user_id={cook}')
+        if not legacy:
+            _race(app, pid, user_ids, lambda p, uid: (add_participant(p, uid), add_participant(p, uid)), errors)
+
+    with app.app_context():
+        if not legacy:
+            dupes = db.session.query(Participant.proposal_id, Participant.user_id).group_by(
+                Participant.proposal_id, Participant.user_id).having(db.func.count() > 1).count()
+            joined = Participant.query.filter(Participant.proposal_id.in_(proposal_ids)).count()
+            if dupes or joined != len(proposal_ids) * threads:
+                failures.append(f'{joined} participant rows ({dupes} duplicated), expected {len(proposal_ids) * threads}')
+            before = sorted(db.session.query(Commitment.user_id, Commitment.proposal_id, Commitment.role).all())
+            commitments.rebuild()
+            if before != sorted(db.session.query(Commitment.user_id, Commitment.proposal_id, Commitment.role).all()):
+                failures.append('commitment index differs from a rebuild')
+            fixed = popularity.reconcile()
+            if fixed != (0, 0):
+                failures.append(f'popularity counters drifted: {fixed}')
+    return failures, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.claims_stress')
+    parser.add_argument('--proposals', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--legacy', action='store_true', help='race the former read-decide-write claim instead')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-claims-')
+    try:
+        # a connection per thread, and a generous busy timeout so the threads queue on
+        # SQLite's write lock instead of failing
+        app = make_app(workdir, {'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': args.threads, 'connect_args': {'timeout': 30}}})
+        failures, errors = run(app, args.proposals, args.threads, args.legacy)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    mode = 'legacy read-decide-write' if args.legacy else 'conditional statements'
+    print(f'{mode}: {args.proposals} proposals x {args.threads} threads')
+    for line in errors[:10]:
+        print(f'  error: {line}')
+    for line in failures[:10]:
+        print(f'  FAILED: {line}')
+    if len(failures) > 10:
+        print(f'  ... {len(failures) - 10} more')
+    print('ok' if not (failures or errors) else f'{len(failures)} failure(s), {len(errors)} error(s)')
+    return 1 if failures or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Compare the old and the indexed "Your commitments" query.
+
+``python -m bench.commitments`` seeds about 100k proposals (``--years`` x
+``--per-day`` on weekdays), then for ``--users`` users runs the former
+OR/DISTINCT query over Proposal and Participant and the range scan over the
+commitment index, checks that both return the same proposals and prints the
+median/p95 time of each plus SQLite's query plans.
+"""
+import argparse
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from sqlalchemy import event, or_
+
+from .__main__ import make_app
+
+
+def old_query(user_id, today):
+    from app.models import Participant, Proposal
+    return Proposal.query.outerjoin(Participant).filter(
+        or_(Participant.user_id == user_id,
+            Proposal.cook_user_id == user_id,
+            Proposal.grocery_user_id == user_id),
+        Proposal.date >= today
+    ).distinct().order_by(Proposal.date.asc(), Proposal.start_time.asc()).all()
+
+
+def new_query(user_id, today):
+    from app.commitments import upcoming_proposals
+    return upcoming_proposals(user_id, today)
+
+
+def _plan(query_fn, user_id, today):
+    from app import db
+    # record the statement of the ORM query, then ask SQLite how it runs it
+    captured = []
+    engine = db.engine
+
+    def grab(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', grab)
+    try:
+        query_fn(user_id, today)
+    finally:
+        event.remove(engine, 'before_cursor_execute', grab)
+    statement, parameters = captured[0]
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+def _time(query_fn, user_ids, today, repeat):
+    from app import db
+    samples = []
+    for _ in range(repeat):
+        for uid in user_ids:
+            t0 = time.perf_counter()
+            query_fn(uid, today)
+            samples.append((time.perf_counter() - t0) * 1000)
+            db.session.expunge_all()
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.commitments')
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--per-day', type=float, default=40, help='proposals per weekday')
+    parser.add_argument('--seed-users', type=int, default=200)
+    parser.add_argument('--users', type=int, default=20, help='users to query for')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    from app import db
+    from app.models import User
+    from .seed import seed
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-commitments-')
+    try:
+        app = make_app(workdir)
+        with app.app_context():
+            t0 = time.perf_counter()
+            summary = seed(users=args.seed_users, recipes=300, years=args.years, proposals_per_day=args.per_day,
+                           participants=6, messages=0, future_weeks=8)
+            print(f"seeded {summary['counts']} in {time.perf_counter() - t0:.1f}s")
+            db.session.remove()
+
+            today = date.today()
+            user_ids = [u.id for u in User.query.filter(User.username.in_(summary['usernames'])).limit(args.users)]
+            for uid in user_ids:
+                # proposals at the same date and time may come in either order
+                old_ids = sorted(p.id for p in old_query(uid, today))
+                new_ids = sorted(p.id for p in new_query(uid, today))
+                if old_ids != new_ids:
+                    print(f'user {uid}: results differ ({len(old_ids)} vs {len(new_ids)})')
+                    return 1
+            db.session.expunge_all()
+
+            print(f"{'query':<12}{'p50 ms':>10}{'p95 ms':>10}")
+            for name, fn in (('old', old_query), ('indexed', new_query)):
+                p50, p95 = _time(fn, user_ids, today, args.repeat)
+                print(f'{name:<12}{p50:>10.2f}{p95:>10.2f}')
+            for name, fn in (('old', old_query), ('indexed', new_query)):
+                print(f'\n{name} plan:')
+                for line in _plan(fn, user_ids[0], today):
+                    print(f'  {line}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Bytes per page with and without response compression.
+
+``python -m bench.compression`` seeds a dataset, logs in and fetches the
+calendar, a discussion, the recipe list, the JSON API and the static files
+once per encoding (identity, gzip and, with the brotli package installed,
+br), then prints the transferred body size of each and the saving. Static
+files are precompressed first, as ``flask assets compress`` does at deploy
+time. Exits non-zero if a compressed body does not decompress to the
+identity body.
+"""
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date, timedelta
+
+from .__main__ import make_app
+
+
+def _decode(body, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(body)
+    return body
+
+
+def _pages(summary):
+    today = date.today()
+    year, week, _ = (today + timedelta(days=7)).isocalendar()
+    pid = summary['upcoming_proposal_ids'][0]
+    return [
+        ('calendar', f'/calendar?year={year}&week={week}'),
+        ('discussion', f'/proposal/{pid}/discuss'),
+        ('recipes', '/recipes'),
+        ('api proposals', f'/api/proposals?start={today}&end={today + timedelta(days=60)}'),
+        ('style.css', '/static/css/style.css'),
+        ('sw.js', '/static/sw.js'),
+        ('manifest.json', '/static/manifest.json'),
+        ('default-avatar.svg', '/static/img/default-avatar.svg'),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.compression')
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--recipes', type=int, default=120)
+    parser.add_argument('--participants', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    from app import compression, db
+    from .seed import seed
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-compression-')
+    static_copy = os.path.join(workdir, 'static')
+    failed = False
+    try:
+        app = make_app(workdir)
+        # precompress a copy of the static folder, the working tree stays untouched
+        shutil.copytree(app.static_folder, static_copy, ignore=shutil.ignore_patterns('uploads', '*.gz', '*.br'))
+        app.static_folder = static_copy
+        with app.app_context():
+            summary = seed(users=args.users, recipes=args.recipes, years=1, participants=args.participants,
+                           messages=args.messages)
+            db.session.remove()
+            compression.precompress_static()
+        client = app.test_client()
+        client.post('/auth/login', data={'username': summary['usernames'][0], 'password': 'bench'})
+
+        encodings = ('identity',) + compression.encodings()
+        print(f"{'page':<20}" + ''.join(f'{e:>10}' for e in encodings) + f"{'saved':>8}")
+        totals = dict.fromkeys(encodings, 0)
+        for name, url in _pages(summary):
+            sizes = {}
+            identity = None
+            for encoding in encodings:
+                response = client.get(url, headers={'Accept-Encoding': encoding})
+                body = response.get_data()
+                sent = response.headers.get('Content-Encoding', 'identity')
+                if response.status_code != 200:
+                    print(f'{name}: status {response.status_code}')
+                    return 1
+                plain = _decode(body, sent)
+                if identity is None:
+                    identity = plain
+                elif plain != identity:
+                    print(f'{name}: {encoding} body differs from identity')
+                    failed = True
+                sizes[encoding] = len(body)
+                totals[encoding] += len(body)
+            best = min(sizes.values())
+            print(f'{name:<20}' + ''.join(f'{sizes[e]:>10}' for e in encodings)
+                  + f'{1 - best / sizes["identity"]:>8.0%}')
+        best = min(totals.values())
+        print(f"{'total':<20}" + ''.join(f'{totals[e]:>10}' for e in encodings)
+              + f'{1 - best / totals["identity"]:>8.0%}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
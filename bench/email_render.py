@@ -0,0 +1,131 @@
+"""Email rendering benchmark: ``python -m bench.email_render [--messages 10000]``.
+
+Builds one proposal event for N personalized recipients the way per-recipient
+mails were built before app.mailer (a Jinja render, plain-text body and
+EmailMessage per message; timed on ``--legacy`` messages and extrapolated) and
+through app.mailer (one render, then placeholder substitution and a
+pre-built MIME skeleton per recipient). It then builds a message for a
+recipe title and username with embedded CR/LF and exits non-zero if they
+add a header or body line to the message.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+
+from .__main__ import make_app
+
+Recipient = namedtuple('Recipient', 'id email username')
+
+
+def legacy_message(proposal, action, actor, recipient, host):
+    # what make_proposal_mail + send_mail did, repeated for every recipient
+    from flask import render_template
+    short_date = proposal.date.strftime('%d.%m')
+    subject = f"{actor} {action} | {proposal.recipe.title} | {short_date}"
+    discussion_url = f"{host}/proposal/{proposal.id}/discuss"
+    text_lines = [f"Hello {recipient.username},", "", f"{actor} {action} for the meal \"{proposal.recipe.title}\" on {short_date}.",
+                  "", f"View the discussion and details here: {discussion_url}", "", "Best regards,", "Cleverly Connected Meals (CCM)"]
+    html = render_template('email/proposal_email.html', subject=subject, actor=actor, action=action,
+                           proposal_title=proposal.recipe.title, short_date=short_date, extra_text=None,
+                           discussion_url=discussion_url, host=host, recipient_name=recipient.username,
+                           unsubscribe_url=f'{host}/unsubscribe/x')
+    footer = f'<hr><p style="font-size:small;color:gray">Manage email notifications in your profile settings: <a href="{host}/profile">Profile settings</a></p>'
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = 'ccm@example.com'
+    msg['To'] = recipient.email
+    msg.set_content("\n".join(text_lines))
+    msg.add_alternative(html + footer, subtype='html')
+    return msg.as_bytes()
+
+
+HOSTILE_TITLE = 'Pasta\r\nBcc: victim@example.com\r\n\r\nfake body'
+HOSTILE_USER = 'eve\nX-Injected: 1'
+
+
+def check_headers(proposal, host):
+    """Problems with a message for a hostile recipe title, actor and recipient name (empty if none)."""
+    from app.mailer import build_messages, proposal_mail
+    title = proposal.recipe.title
+    proposal.recipe.title = HOSTILE_TITLE
+    try:
+        body = proposal_mail(proposal, 'left a message', HOSTILE_USER, host=host)
+        _, raw = next(build_messages(body, [Recipient(1, 'user1@example.com', HOSTILE_USER)], 'ccm@example.com', host))
+    finally:
+        proposal.recipe.title = title
+    msg = message_from_bytes(raw, policy=policy.default)
+    problems = []
+    for name in ('Bcc', 'X-Injected'):
+        if name in msg:
+            problems.append(f'injected header {name}')
+    head = raw.split(b'\r\n\r\n', 1)[0]
+    if b'fake body' in raw.split(b'\r\n\r\n', 1)[1].split(b'--', 1)[0]:
+        problems.append('injected body')
+    if any(not line or line.startswith((b'Bcc', b'X-Injected')) for line in head.split(b'\r\n')):
+        problems.append('header block split')
+    if 'Pasta' not in str(msg['Subject']):
+        problems.append(f"subject lost the title: {msg['Subject']!r}")
+    return problems
+
+
+def run(messages, legacy=1000):
+    from app import db
+    from app.mailer import build_messages, proposal_mail, site_host, unsubscribe_url
+    from app.models import Proposal, Recipe, User
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-mail-')
+    try:
+        app = make_app(workdir)
+        with app.app_context():
+            user = User.query.first()
+            p = Proposal(date=date.today() + timedelta(days=1), recipe_id=Recipe.query.first().id, proposer_id=user.id)
+            db.session.add(p)
+            db.session.commit()
+            host = site_host()
+            recipients = [Recipient(i, f'user{i}@example.com', f'user{i}') for i in range(messages)]
+            results = {}
+
+            started = time.perf_counter()
+            for r in recipients[:legacy]:
+                legacy_message(p, 'left a message', 'alice', r, host)
+            results['legacy (render + EmailMessage)'] = ((time.perf_counter() - started) / legacy, legacy)
+
+            started = time.perf_counter()
+            body = proposal_mail(p, 'left a message', 'alice', host=host)
+            for r in recipients:
+                body.personalize(r.username, unsubscribe_url(r.id, body.kind, host))
+            results['render once + personalize'] = ((time.perf_counter() - started) / messages, messages)
+
+            started = time.perf_counter()
+            body = proposal_mail(p, 'left a message', 'alice', host=host)
+            for _ in build_messages(body, recipients, 'ccm@example.com', host):
+                pass
+            results['mailer (complete messages)'] = ((time.perf_counter() - started) / messages, messages)
+            problems = check_headers(p, host)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f'{messages} personalized messages')
+    for name, (per_msg, n) in results.items():
+        print(f'{name:<32}{n:>7} msgs{per_msg * 1e6:>10.1f} us/msg{per_msg * messages:>10.2f} s per {messages}')
+    print('header injection: ' + ('; '.join(problems) if problems else 'hostile title and name stay in their headers'))
+    return results, problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.email_render')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--legacy', type=int, default=1000, help='messages built the old way (slow; extrapolated)')
+    args = parser.parse_args(argv)
+    _, problems = run(args.messages, min(args.legacy, args.messages))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
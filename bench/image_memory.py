@@ -0,0 +1,158 @@
+"""Peak memory of processing large uploads.
+
+``python -m bench.image_memory`` writes a few large test images (a 48 MP
+colour, a grayscale and a CMYK JPEG, a 24 MP PNG and a PNG decompression
+bomb) and compresses each one in a fresh subprocess, once with the former
+decode-everything code and once with ``compress_image``, so that the peak
+resident set size of every run can be compared. Exits non-zero if the new
+code path uses more memory than the old one or lets the bomb through.
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from . import report
+
+
+def _legacy_compress(path, ext, max_size=(1600, 1600), quality=85):
+    # compress_image before bounded decoding: convert first, then thumbnail, into memory
+    from PIL import Image
+    img = Image.open(path)
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background.convert('RGB')
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail(max_size, Image.LANCZOS)
+    out = io.BytesIO()
+    if ext in ('jpg', 'jpeg'):
+        img.save(out, format='JPEG', quality=quality, optimize=True)
+    else:
+        img.save(out, format='PNG', optimize=True)
+    return 'ok'
+
+
+def _new_compress(path, ext, max_pixels):
+    from flask import Flask
+    from app.images import ImageTooLarge
+    from app.routes import compress_image
+    app = Flask('bench')
+    app.config['IMAGE_MAX_PIXELS'] = max_pixels
+    with app.app_context():
+        try:
+            with open(path, 'rb') as f:
+                return 'ok' if compress_image(f, ext, path + '.out') else 'not an image'
+        except ImageTooLarge:
+            return 'rejected'
+
+
+def _peak_rss():
+    # VmHWM starts over with exec; ru_maxrss would include the peak of the parent that made the images
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return report.peak_rss_bytes()
+
+
+def child(mode, path, max_pixels):
+    # import everything first so only the image work shows up in the peak
+    import app.routes  # noqa: F401
+    ext = path.rsplit('.', 1)[1]
+    before = _peak_rss()
+    t0 = time.perf_counter()
+    try:
+        result = _legacy_compress(path, ext) if mode == 'legacy' else _new_compress(path, ext, max_pixels)
+    except Exception as e:
+        result = type(e).__name__
+    print(json.dumps({'result': result, 'seconds': time.perf_counter() - t0,
+                      'peak': _peak_rss(), 'growth': _peak_rss() - before}))
+
+
+def _bomb_png(path, width, height):
+    # a grayscale PNG of zeros: a few hundred KB on disk, width * height bytes decoded
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    comp = zlib.compressobj(9)
+    row = bytes(width + 1)
+    body = b''.join(comp.compress(row) for _ in range(height)) + comp.flush()
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+                + chunk(b'IDAT', body) + chunk(b'IEND', b''))
+
+
+def make_images(workdir, width, height):
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(img)
+    # stripes rather than a flat colour, so the JPEGs have realistic sizes
+    for x in range(0, width, 40):
+        draw.rectangle((x, 0, x + 19, height), fill=((x * 7) % 256, (x * 3) % 256, 128))
+    paths = {}
+    paths['rgb.jpg'] = os.path.join(workdir, 'rgb.jpg')
+    img.save(paths['rgb.jpg'], quality=90)
+    paths['gray.jpg'] = os.path.join(workdir, 'gray.jpg')
+    img.convert('L').save(paths['gray.jpg'], quality=90)
+    paths['cmyk.jpg'] = os.path.join(workdir, 'cmyk.jpg')
+    img.convert('CMYK').save(paths['cmyk.jpg'], quality=90)
+    paths['rgba.png'] = os.path.join(workdir, 'rgba.png')
+    img.resize((width * 2 // 3, height * 2 // 3)).convert('RGBA').save(paths['rgba.png'], compress_level=1)
+    del img, draw
+    paths['bomb.png'] = os.path.join(workdir, 'bomb.png')
+    _bomb_png(paths['bomb.png'], 12000, 12000)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.image_memory')
+    parser.add_argument('--width', type=int, default=8000)
+    parser.add_argument('--height', type=int, default=6000)
+    parser.add_argument('--max-pixels', type=int, default=64_000_000)
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        child(args.child[0], args.child[1], args.max_pixels)
+        return 0
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-images-')
+    failed = False
+    try:
+        paths = make_images(workdir, args.width, args.height)
+        print(f"{'image':<10}{'MB':>6}{'mode':>8}{'result':>16}{'peak MB':>10}{'growth MB':>11}{'s':>7}")
+        for name, path in paths.items():
+            runs = {}
+            for mode in ('legacy', 'new'):
+                out = subprocess.run([sys.executable, '-m', 'bench.image_memory', '--max-pixels', str(args.max_pixels),
+                                      '--child', mode, path], capture_output=True, text=True,
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+                if out.returncode:
+                    # e.g. killed by the OOM killer
+                    runs[mode] = {'result': f'exit {out.returncode}', 'seconds': 0, 'peak': 0, 'growth': 0}
+                else:
+                    runs[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+                r = runs[mode]
+                print(f"{name:<10}{os.path.getsize(path) / 2**20:>6.1f}{mode:>8}{r['result']:>16}"
+                      f"{r['peak'] / 2**20:>10.0f}{r['growth'] / 2**20:>11.0f}{r['seconds']:>7.2f}")
+            if name == 'bomb.png':
+                failed |= runs['new']['result'] != 'rejected'
+            else:
+                failed |= runs['new']['result'] != 'ok' or runs['new']['growth'] > runs['legacy']['growth'] * 1.1
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
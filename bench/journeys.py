@@ -0,0 +1,170 @@
+"""Drivers (test client / local HTTP server) and the user journeys they run."""
+import http.cookiejar
+import io
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import date, timedelta
+
+from PIL import Image
+
+from .seed import PASSWORD
+
+_DB_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+class TestClientDriver:
+    """Runs requests in-process through Flask's test client (one client per user)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        return _TestClientSession(self.app.test_client())
+
+    def close(self):
+        pass
+
+
+class _TestClientSession:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, path):
+        r = self.client.get(path)
+        return r.status_code, r.headers.getlist('Server-Timing')
+
+    def post(self, path, data=None, files=None):
+        data = dict(data or {})
+        for name, (filename, payload) in (files or {}).items():
+            data[name] = (io.BytesIO(payload), filename)
+        r = self.client.post(path, data=data, content_type='multipart/form-data' if files else None)
+        return r.status_code, r.headers.getlist('Server-Timing')
+
+
+class ServerDriver:
+    """Serves the app on a local port in a background thread and talks HTTP to it."""
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def session(self):
+        return _HttpSession(self.base_url)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def _open(self, req):
+        try:
+            with self.opener.open(req) as r:
+                r.read()
+                return r.status, r.headers.get_all('Server-Timing') or []
+        except urllib.error.HTTPError as e:
+            # redirects surface as HTTPError because _NoRedirect refuses to follow them
+            e.read()
+            return e.code, e.headers.get_all('Server-Timing') or []
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data=None, files=None):
+        if not files:
+            body = urllib.parse.urlencode(data or {}).encode()
+            req = urllib.request.Request(self.base_url + path, data=body)
+            return self._open(req)
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in (data or {}).items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        for name, (filename, payload) in files.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                         f'Content-Type: application/octet-stream\r\n\r\n'.encode() + payload + b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        req = urllib.request.Request(self.base_url + path, data=b''.join(parts),
+                                     headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        return self._open(req)
+
+
+class Recorder:
+    """Collects (latency, queries) samples per journey step."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def call(self, step, fn, *args, **kwargs):
+        start = time.perf_counter()
+        status, timings = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if status >= 400:
+            raise RuntimeError(f'{step} failed with HTTP {status}')
+        queries = None
+        for header in timings:
+            m = _DB_TIMING.search(header)
+            if m:
+                queries = int(m.group(2))
+        self.samples.setdefault(step, []).append((elapsed, queries))
+        return status
+
+
+def sample_image(size=(1600, 1200)):
+    """A JPEG with enough detail that compression does real work."""
+    img = Image.effect_noise(size, 64).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+def run_journeys(driver, summary, recorder, iterations=20, clients=5, weeks_back=4, upload_every=5):
+    """Run ``iterations`` rounds of the main user journeys.
+
+    Each round picks one of ``clients`` logged-in sessions and walks through
+    calendar week navigation, the recipe list, reading and posting in a
+    discussion, joining/leaving a proposal and (every ``upload_every`` rounds)
+    an image upload.
+    """
+    sessions = []
+    for username in summary['usernames'][:clients]:
+        s = driver.session()
+        recorder.call('login', s.post, '/auth/login', {'username': username, 'password': PASSWORD})
+        sessions.append(s)
+    proposal_ids = summary['upcoming_proposal_ids']
+    image = sample_image() if upload_every else None
+
+    for i in range(iterations):
+        s = sessions[i % len(sessions)]
+        recorder.call('calendar_week', s.get, '/calendar')
+        monday = date.today() - timedelta(days=date.today().weekday())
+        for back in range(1, weeks_back + 1):
+            year, week, _ = (monday - timedelta(weeks=back)).isocalendar()
+            recorder.call('calendar_week', s.get, f'/calendar?year={year}&week={week}')
+        recorder.call('recipes_list', s.get, '/recipes')
+
+        if proposal_ids:
+            pid = proposal_ids[i % len(proposal_ids)]
+            recorder.call('discuss_read', s.get, f'/proposal/{pid}/discuss')
+            recorder.call('join', s.post, f'/proposal/join/{pid}', {'next': 'discuss'})
+            recorder.call('discuss_post', s.post, f'/proposal/{pid}/discuss', {'content': f'bench round {i}'})
+            recorder.call('unjoin', s.post, f'/proposal/unjoin/{pid}', {'next': 'discuss'})
+
+        if upload_every and i % upload_every == 0:
+            recorder.call('upload_image', s.post, '/recipe/upload', {}, files={'image': ('bench.jpg', image)})
@@ -0,0 +1,121 @@
+"""Pin the SQL statement count of the notifying proposal handlers.
+
+``python -m bench.query_counts`` runs join, leave, claim/unclaim, discussion
+post, start-time change, propose and delete through the test client, once
+with a small and once with a large participant list, and counts statements
+with ``app.instrumentation.count_queries``. It exits non-zero when a handler
+issues more statements than pinned in ``PINNED`` or when its count grows with
+the number of participants (an N+1 in recipient resolution).
+
+Mail delivery stays disabled (no MailConfig), so the counts cover recipient
+resolution, digest queueing and rendering but no SMTP.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+from datetime import date, timedelta
+
+from .__main__ import make_app
+
+PASSWORD = 'bench'
+
+# statements per request; lower these when a change saves queries
+PINNED = {
+    'propose': 13,
+    'join': 16,
+    'claim_grocery': 14,
+    'unclaim_grocery': 14,
+    'claim_cook': 17,
+    'unclaim_cook': 17,
+    'discuss_post': 14,
+    'change_start_time': 13,
+    'unjoin': 16,
+    'delete': 18,
+}
+
+
+def _setup(app, participants):
+    from app import db
+    from app.models import Participant, Proposal, Recipe, User
+    with app.app_context():
+        actor = User(username='actor', email='actor@example.com')
+        actor.set_password(PASSWORD)
+        db.session.add(actor)
+        others = []
+        for i in range(participants):
+            # every other user gets digests so the queueing path is counted too
+            u = User(username=f'p{i}', email=f'p{i}@example.com', notify_discussion=True, notify_new_proposal=True,
+                     notify_digest='hourly' if i % 2 else 'immediate')
+            u.password_hash = actor.password_hash
+            others.append(u)
+        db.session.add_all(others)
+        db.session.commit()
+        recipe_id = Recipe.query.first().id
+        p = Proposal(date=date.today() + timedelta(days=3), recipe_id=recipe_id, proposer_id=actor.id)
+        db.session.add(p)
+        db.session.commit()
+        db.session.add_all([Participant(proposal_id=p.id, user_id=u.id) for u in others])
+        db.session.commit()
+        ids = (p.id, recipe_id)
+        db.session.remove()
+    return ids
+
+
+def measure(participants):
+    """Return {step: statement count} for a proposal with ``participants`` participants."""
+    from app.instrumentation import count_queries
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-queries-')
+    try:
+        app = make_app(workdir)
+        proposal_id, recipe_id = _setup(app, participants)
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'actor', 'password': PASSWORD})
+        day = (date.today() + timedelta(days=4)).isoformat()
+        steps = [
+            ('propose', '/proposal/propose', {'recipe_id': recipe_id, 'date': day}),
+            ('join', f'/proposal/join/{proposal_id}', {}),
+            ('claim_grocery', f'/proposal/{proposal_id}/claim_grocery', {}),
+            ('unclaim_grocery', f'/proposal/{proposal_id}/claim_grocery', {}),
+            ('claim_cook', f'/proposal/{proposal_id}/claim_cook', {}),
+            ('unclaim_cook', f'/proposal/{proposal_id}/claim_cook', {}),
+            ('discuss_post', f'/proposal/{proposal_id}/discuss', {'content': 'see you at noon'}),
+            ('change_start_time', f'/proposal/{proposal_id}/change_start_time', {'start_time': '12:30'}),
+            ('unjoin', f'/proposal/unjoin/{proposal_id}', {}),
+            ('delete', f'/proposal/delete/{proposal_id}', {}),
+        ]
+        counts = {}
+        for step, url, data in steps:
+            with count_queries() as stats:
+                resp = client.post(url, data=data)
+            if resp.status_code != 302:
+                raise SystemExit(f'{step}: unexpected status {resp.status_code}')
+            counts[step] = stats['count']
+        return counts
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.query_counts')
+    parser.add_argument('--small', type=int, default=2, help='participants in the small run')
+    parser.add_argument('--large', type=int, default=40, help='participants in the large run')
+    args = parser.parse_args(argv)
+
+    small, large = measure(args.small), measure(args.large)
+    failed = False
+    print(f"{'step':<20}{args.small:>6}{args.large:>6}{'pinned':>8}")
+    for step, pinned in PINNED.items():
+        flag = ''
+        if large[step] != small[step]:
+            flag += '  GROWS WITH PARTICIPANTS'
+        if max(small[step], large[step]) > pinned:
+            flag += '  OVER PIN'
+        failed = failed or bool(flag)
+        print(f'{step:<20}{small[step]:>6}{large[step]:>6}{pinned:>8}{flag}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
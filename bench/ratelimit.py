@@ -0,0 +1,109 @@
+"""Overhead and cross-process accuracy of the rate limiter.
+
+``python -m bench.ratelimit`` times ``acquire`` of the in-process and the
+SQLite buckets, then lets ``--workers`` processes race for the tokens of one
+SQLite bucket of ``--burst`` tokens (with no refill to speak of), as worker
+processes behind one endpoint would. Finally it guesses a user's password
+from one address until the login is limited and then logs the user in
+repeatedly from another. Exits non-zero unless exactly ``--burst`` requests
+got through in total, the guesses were stopped and every login of the owner
+succeeded.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from .__main__ import make_app
+
+
+def _time_acquire(buckets, n):
+    times = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        buckets.acquire([(f'bench|ip:{i % 500}', 10, 60)])
+        times.append((time.perf_counter() - t0) * 1e6)
+    return statistics.median(times), statistics.quantiles(times, n=100)[98]
+
+
+def _race(path, burst, attempts, start, results):
+    from app.ratelimit import SQLiteBuckets
+    buckets = SQLiteBuckets(path, 3600)
+    start.wait()
+    # a year per token: nothing refills during the run
+    rules = [('bench|race', burst, burst * 365 * 86400)]
+    results.put(sum(1 for _ in range(attempts) if not buckets.acquire(rules)))
+
+
+def _login_check(workdir):
+    """Return (guesses until the first 429, owner logins that got through of 8)."""
+    from app import db
+    from .seed import seed
+    app = make_app(os.path.join(workdir, 'app'), {'RATELIMIT_ENABLED': True})
+    with app.app_context():
+        owner = seed(users=2, recipes=2, years=1, participants=1, messages=0)['usernames'][0]
+        db.session.remove()
+    attacker = app.test_client()
+    attacker.environ_base['REMOTE_ADDR'] = '192.0.2.1'
+    guesses = 0
+    while guesses < 50:
+        guesses += 1
+        if attacker.post('/auth/login', data={'username': owner, 'password': 'guess'}).status_code == 429:
+            break
+    user = app.test_client()
+    user.environ_base['REMOTE_ADDR'] = '198.51.100.7'
+    logins = 0
+    for _ in range(8):
+        logins += user.post('/auth/login', data={'username': owner, 'password': 'bench'}).status_code == 302
+        user.get('/auth/logout')
+    return guesses, logins
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.ratelimit')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--burst', type=int, default=100)
+    parser.add_argument('--attempts', type=int, default=50, help='requests per worker in the race')
+    args = parser.parse_args(argv)
+
+    from app.ratelimit import MemoryBuckets, SQLiteBuckets
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-ratelimit-')
+    try:
+        print(f"{'store':<10}{'median us':>11}{'p99 us':>9}")
+        for name, buckets in (('memory', MemoryBuckets(3600)),
+                              ('sqlite', SQLiteBuckets(os.path.join(workdir, 'timing.db'), 3600))):
+            median, p99 = _time_acquire(buckets, args.requests)
+            print(f'{name:<10}{median:>11.1f}{p99:>9.1f}')
+
+        ctx = multiprocessing.get_context('fork')
+        path = os.path.join(workdir, 'race.db')
+        SQLiteBuckets(path, 3600)
+        start, results = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=_race, args=(path, args.burst, args.attempts, start, results))
+                 for _ in range(args.workers)]
+        for p in procs:
+            p.start()
+        start.set()
+        allowed = sum(results.get() for _ in procs)
+        for p in procs:
+            p.join()
+        print(f'{args.workers} workers x {args.attempts} requests against a bucket of {args.burst}: '
+              f'{allowed} allowed')
+
+        os.makedirs(os.path.join(workdir, 'app'))
+        guesses, logins = _login_check(workdir)
+        print(f'password guesses from one address: limited at guess {guesses}; '
+              f'owner logins from another address: {logins} of 8 succeeded')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if allowed == args.burst and guesses < 50 and logins == 8 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Result aggregation, JSON baselines and baseline comparison."""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from datetime import datetime
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list."""
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def rss_bytes():
+    """Current resident set size (falls back to peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def summarize(recorder):
+    steps = {}
+    for step, samples in sorted(recorder.samples.items()):
+        latencies = [s[0] * 1000.0 for s in samples]
+        queries = [s[1] for s in samples if s[1] is not None]
+        steps[step] = {
+            'n': len(samples),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+    return steps
+
+
+def build_result(recorder, params, dataset, rss):
+    return {
+        'commit': _git_commit(),
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': params,
+        'dataset': dataset,
+        'rss': rss,
+        'steps': summarize(recorder),
+    }
+
+
+def write_json(result, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_result(result):
+    lines = [f"commit {result.get('commit')}  dataset {result['dataset']}"]
+    lines.append(f"{'step':<16}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+    for step, s in result['steps'].items():
+        q = '-' if s['queries_mean'] is None else f"{s['queries_mean']:g}"
+        lines.append(f"{step:<16}{s['n']:>6}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}{q:>9}")
+    rss = result['rss']
+    lines.append(f"rss: start {rss['start'] / 2**20:.1f} MiB, end {rss['end'] / 2**20:.1f} MiB, "
+                 f"peak {rss['peak'] / 2**20:.1f} MiB")
+    return '\n'.join(lines)
+
+
+def compare(baseline, current, threshold=0.10):
+    """Return (lines, regressed) comparing p95 latency and query counts per step.
+
+    A step regresses when its p95 latency or its mean query count grows by more
+    than ``threshold`` (relative).
+    """
+    lines = [f"baseline {baseline.get('commit')} -> current {current.get('commit')}"]
+    regressed = False
+    for step, cur in current['steps'].items():
+        base = baseline['steps'].get(step)
+        if not base:
+            lines.append(f'{step:<16} new step')
+            continue
+        delta = (cur['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        flag = ''
+        if delta > threshold:
+            flag = '  REGRESSION (latency)'
+        if (cur['queries_mean'] or 0) > (base['queries_mean'] or 0) * (1 + threshold):
+            flag += '  REGRESSION (queries)'
+        regressed = regressed or bool(flag)
+        lines.append(f"{step:<16} p95 {base['p95_ms']:.2f} -> {cur['p95_ms']:.2f} ms ({delta:+.0%}), "
+                     f"queries {base['queries_mean']} -> {cur['queries_mean']}{flag}")
+    return lines, regressed
@@ -0,0 +1,207 @@
+"""End-to-end check of the S3 storage backend against an in-memory bucket.
+
+``python -m bench.s3_storage`` runs ``S3Storage`` with a stand-in for the
+boto3 client (``FakeS3``: the calls the backend makes, on a dict), so it
+needs neither boto3 nor a bucket. It uploads an avatar through the app (the
+upload, its renditions and ``exists``, which asks the bucket about a
+missing name once per ``missing_ttl``), serves it from ``/media/<name>``
+(200, then 304 for ``If-None-Match``, 404 for a missing name), and migrates
+a local upload folder to the bucket and back. It prints one line per check
+and exits non-zero if any of them fails.
+"""
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from PIL import Image
+
+from .__main__ import make_app
+
+MAX_AGE = 3600
+
+
+class FakeClientError(Exception):
+
+    def __init__(self, code, headers=None):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPHeaders': headers or {}}}
+
+
+class FakeBody:
+
+    def __init__(self, data):
+        self._data = data
+        self.closed = False
+
+    def iter_chunks(self, size):
+        for i in range(0, len(self._data), size):
+            yield self._data[i:i + size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakePaginator:
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(k for k in self.client.objects_of(Bucket) if k.startswith(Prefix))
+        # two keys per page, so that paging is exercised
+        for i in range(0, len(keys), 2):
+            yield {'Contents': [{'Key': k} for k in keys[i:i + 2]]}
+
+
+class FakeS3:
+    """The part of the boto3 S3 client that S3Storage uses, on a dict of {(bucket, key): (data, type, etag)}."""
+
+    class exceptions:
+        ClientError = FakeClientError
+
+    def __init__(self):
+        self.objects = {}
+        self.heads = 0
+        self._lock = threading.Lock()
+
+    def objects_of(self, bucket):
+        with self._lock:
+            return [key for b, key in self.objects if b == bucket]
+
+    def _get(self, bucket, key):
+        with self._lock:
+            obj = self.objects.get((bucket, key))
+        if obj is None:
+            raise FakeClientError('404')
+        return obj
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        data, content_type, etag = self._get(Bucket, Key)
+        return {'ContentLength': len(data), 'ContentType': content_type, 'ETag': etag}
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, 'rb') as f:
+            data = f.read()
+        content_type = (ExtraArgs or {}).get('ContentType', 'binary/octet-stream')
+        with self._lock:
+            self.objects[(Bucket, Key)] = (data, content_type, f'"{hashlib.md5(data).hexdigest()}"')
+
+    def download_file(self, Bucket, Key, Filename):
+        data, _, _ = self._get(Bucket, Key)
+        with open(Filename, 'wb') as f:
+            f.write(data)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        data, content_type, etag = self._get(Bucket, Key)
+        if IfNoneMatch is not None and etag in [t.strip() for t in IfNoneMatch.split(',')]:
+            raise FakeClientError('304', {'etag': etag})
+        return {'Body': FakeBody(data), 'ContentType': content_type, 'ContentLength': len(data), 'ETag': etag}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2', operation
+        return FakePaginator(self)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.example/{Params['Key']}?expires={ExpiresIn}"
+
+
+def _jpeg(size=(320, 240), color=(200, 120, 40)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def main(argv=None):
+    from app import db, storage
+    from app.avatars import AVATAR_SIZES, rendition_name
+    from app.models import User
+    from .seed import seed
+
+    checks = []
+
+    def check(name, ok, detail=''):
+        checks.append(ok)
+        print(f"{'ok ' if ok else 'FAIL'} {name}{': ' + detail if detail else ''}")
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-s3-')
+    try:
+        app = make_app(workdir, {'STORAGE_MEDIA_MAX_AGE': MAX_AGE})
+        client = FakeS3()
+        s3 = storage.S3Storage('bench', 'uploads/', client=client, max_age=MAX_AGE)
+        with app.app_context():
+            summary = seed(users=2, recipes=2, years=1, participants=1, messages=0)
+            db.session.remove()
+            local = storage.make_storage('local')
+            for i in range(5):
+                local.save_file(f'local{i}.jpg', _write(workdir, f'src{i}.jpg', _jpeg(color=(i * 40, 0, 0))))
+        app.extensions['ccm_storage'] = s3
+
+        web = app.test_client()
+        web.post('/auth/login', data={'username': summary['usernames'][0], 'password': 'bench'})
+        web.post('/user/avatar', data={'avatar': (io.BytesIO(_jpeg()), 'me.jpg')}, content_type='multipart/form-data')
+        with app.app_context():
+            avatar = User.query.filter_by(username=summary['usernames'][0]).one().avatar
+            check('upload through writer()', bool(avatar) and s3.exists(avatar, fresh=True), str(avatar))
+            renditions = [rendition_name(avatar, size) for size in AVATAR_SIZES] if avatar else []
+            check('renditions from local_copy()', bool(renditions) and all(s3.exists(n, fresh=True) for n in renditions))
+            check('exists() of a missing name', not s3.exists('missing.jpg'))
+            heads = client.heads
+            check('missing name remembered', not s3.exists('missing.jpg') and client.heads == heads,
+                  f'{client.heads - heads} HEAD requests')
+            check('fresh exists() asks again', not s3.exists('missing.jpg', fresh=True) and client.heads == heads + 1)
+
+        first = web.get(f'/media/{avatar}')
+        etag = first.headers.get('ETag')
+        check('GET /media 200', first.status_code == 200 and first.data[:2] == b'\xff\xd8'
+              and first.mimetype == 'image/jpeg', f'{first.status_code} {first.mimetype}')
+        check('200 has ETag and Cache-Control', bool(etag) and first.cache_control.max_age == MAX_AGE,
+              f"{etag} {first.headers.get('Cache-Control')}")
+        again = web.get(f'/media/{avatar}', headers={'If-None-Match': etag})
+        check('revalidation 304', again.status_code == 304 and not again.data, str(again.status_code))
+        check('304 has ETag and Cache-Control', again.headers.get('ETag') == etag
+              and again.cache_control.max_age == MAX_AGE,
+              f"{again.headers.get('ETag')} {again.headers.get('Cache-Control')}")
+        check('GET /media of a missing name 404', web.get('/media/missing.jpg').status_code == 404)
+
+        with app.app_context():
+            copied, skipped, failed = storage.migrate(local, s3, workers=4)
+            check('migrate local -> s3', len(copied) == 5 and not skipped and not failed,
+                  f'{len(copied)} copied, {len(skipped)} skipped, {len(failed)} failed')
+            copied, skipped, failed = storage.migrate(local, s3, workers=4)
+            check('migrate again skips', not copied and len(skipped) == 5 and not failed,
+                  f'{len(copied)} copied, {len(skipped)} skipped')
+            back = storage.LocalStorage(os.path.join(workdir, 'back'))
+            names = sorted(s3.names())
+            copied, skipped, failed = storage.migrate(s3, back, workers=4)
+            same = all(_read(local.path(n)) == _read(back.path(n)) for n in names if n.startswith('local'))
+            check('migrate s3 -> local', len(copied) == len(names) == 6 + len(AVATAR_SIZES) and same
+                  and not failed, f'{len(copied)} of {len(names)} copied, contents equal: {same}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f'{checks.count(True)} of {len(checks)} checks passed')
+    return 0 if all(checks) else 1
+
+
+def _write(workdir, name, data):
+    path = os.path.join(workdir, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
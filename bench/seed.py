@@ -0,0 +1,96 @@
+"""Synthetic dataset generation for the benchmark harness."""
+import random
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import func, insert
+from werkzeug.security import generate_password_hash
+
+from app import commitments, db, popularity
+from app.models import User, Recipe, Proposal, Participant, Message
+
+PASSWORD = 'bench'
+CHUNK = 5000
+
+
+def _bulk_insert(model, rows):
+    for i in range(0, len(rows), CHUNK):
+        db.session.execute(insert(model), rows[i:i + CHUNK])
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def seed(users=50, recipes=200, years=2, proposals_per_day=1.5, participants=6, messages=8,
+         future_weeks=4, rng_seed=1):
+    """Insert a synthetic dataset in bulk and return a summary dict.
+
+    Proposals are spread over the weekdays of the last ``years`` years plus
+    ``future_weeks`` upcoming weeks; each gets up to ``participants``
+    participants and ``messages`` discussion messages. Must run inside an app
+    context. All generated users share the password ``PASSWORD``.
+    """
+    rng = random.Random(rng_seed)
+    now = datetime.utcnow()
+    today = date.today()
+    # password hashing is deliberately slow; every synthetic user shares one hash
+    pw_hash = generate_password_hash(PASSWORD)
+
+    uid = _next_id(User)
+    user_rows = [dict(id=uid + i, username=f'bench{i:05d}', email=f'bench{i:05d}@example.com',
+                      password_hash=pw_hash, is_admin=False, notify_new_proposal=True,
+                      notify_discussion=True, notify_broadcast=True)
+                 for i in range(users)]
+    _bulk_insert(User, user_rows)
+    user_ids = [r['id'] for r in user_rows]
+
+    rid = _next_id(Recipe)
+    recipe_rows = [dict(id=rid + i, title=f'Bench recipe {i}', ingredients='Pasta, Tomatoes, Basil, Olive oil',
+                        instructions='Cook, stir and serve.', user_id=rng.choice(user_ids), times_cooked=0,
+                        created_at=now - timedelta(days=rng.randint(0, years * 365)),
+                        prep_time=15, active_time=20, total_time=35, level='simple')
+                   for i in range(recipes)]
+    _bulk_insert(Recipe, recipe_rows)
+    recipe_ids = [r['id'] for r in recipe_rows]
+
+    pid = _next_id(Proposal)
+    proposal_rows, participant_rows, message_rows = [], [], []
+    day = today - timedelta(days=years * 365)
+    last = today + timedelta(weeks=future_weeks)
+    while day <= last:
+        if day.weekday() < 5:
+            count = int(proposals_per_day) + (1 if rng.random() < proposals_per_day % 1 else 0)
+            for recipe_id in rng.sample(recipe_ids, min(count, len(recipe_ids))):
+                joined = rng.sample(user_ids, min(rng.randint(0, participants), len(user_ids)))
+                created = datetime.combine(day, time(9)) - timedelta(days=rng.randint(1, 14))
+                proposal_rows.append(dict(
+                    id=pid, date=day, recipe_id=recipe_id, proposer_id=rng.choice(user_ids),
+                    created_at=created, start_time=time(12, rng.choice((0, 15, 30))),
+                    cook_user_id=joined[0] if joined and rng.random() < 0.6 else None,
+                    grocery_user_id=joined[-1] if joined and rng.random() < 0.6 else None))
+                for user_id in joined:
+                    participant_rows.append(dict(user_id=user_id, proposal_id=pid, joined_at=created))
+                for n in range(messages if joined else 0):
+                    message_rows.append(dict(proposal_id=pid, user_id=rng.choice(joined),
+                                             content=f'Bench message {n} for proposal {pid}',
+                                             created_at=created + timedelta(minutes=n * 7)))
+                pid += 1
+        day += timedelta(days=1)
+    _bulk_insert(Proposal, proposal_rows)
+    _bulk_insert(Participant, participant_rows)
+    _bulk_insert(Message, message_rows)
+    db.session.commit()
+    # fill the popularity counters and the commitment index as the migrations do for an existing database
+    popularity.reconcile(today)
+    commitments.rebuild()
+
+    upcoming = [r['id'] for r in proposal_rows if today <= r['date'] < today + timedelta(weeks=2)]
+    if not upcoming and proposal_rows:
+        upcoming = [proposal_rows[-1]['id']]
+    return {
+        'usernames': [r['username'] for r in user_rows],
+        'recipe_ids': recipe_ids,
+        'upcoming_proposal_ids': upcoming,
+        'counts': {'users': len(user_rows), 'recipes': len(recipe_rows), 'proposals': len(proposal_rows),
+                   'participants': len(participant_rows), 'messages': len(message_rows)},
+    }
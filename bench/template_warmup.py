@@ -0,0 +1,126 @@
+"""First-request latency of a fresh worker, with and without compiled templates.
+
+``python -m bench.template_warmup`` seeds a dataset once and then starts a
+fresh process per run, as a newly (re)started worker would be. Each run
+creates the app and times its first calendar page, first discussion page and
+first proposal email, then the calendar page once more for comparison.
+The configurations are:
+
+- ``before``: no bytecode cache and no warm-up (every template is compiled on
+  first use, as before);
+- ``bytecode``: the bytecode cache filled by an earlier process, no warm-up;
+- ``warm-up``: the bytecode cache plus ``TEMPLATE_WARMUP``, so the loading
+  happens in create_app (its cost shows up in the startup column);
+- ``warm-up cold``: warm-up with an empty bytecode cache (the first worker
+  after a deployment that did not run ``flask templates compile``).
+
+Each configuration runs ``--repeat`` times and the median is printed. Exits
+non-zero if the warmed-up first calendar page is not faster than before.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from .__main__ import make_app
+
+MODES = {
+    'before': {'TEMPLATE_BYTECODE_CACHE': False, 'TEMPLATE_WARMUP': False},
+    'bytecode': {'TEMPLATE_BYTECODE_CACHE': True, 'TEMPLATE_WARMUP': False},
+    'warm-up': {'TEMPLATE_BYTECODE_CACHE': True, 'TEMPLATE_WARMUP': True},
+    'warm-up cold': {'TEMPLATE_BYTECODE_CACHE': True, 'TEMPLATE_WARMUP': True},
+}
+COLUMNS = ('startup', 'calendar', 'discussion', 'email', 'calendar again')
+
+
+def _ms(t0):
+    return (time.perf_counter() - t0) * 1000
+
+
+def child(workdir, mode):
+    # import everything first so that only app creation and the requests are timed
+    import app.routes  # noqa: F401
+    from app import mailer
+    from app.models import Proposal
+    with open(os.path.join(workdir, 'summary.json')) as f:
+        summary = json.load(f)
+    config = dict(MODES[mode], TEMPLATE_CACHE_DIR=os.path.join(workdir, 'jinja-cache'))
+    times = {}
+    t0 = time.perf_counter()
+    app = make_app(workdir, config)
+    times['startup'] = _ms(t0)
+
+    client = app.test_client()
+    client.post('/auth/login', data={'username': summary['usernames'][0], 'password': 'bench'})
+    year, week, _ = (date.today() + timedelta(days=7)).isocalendar()
+    calendar = f'/calendar?year={year}&week={week}'
+    pid = summary['upcoming_proposal_ids'][0]
+    for name, url in (('calendar', calendar), ('discussion', f'/proposal/{pid}/discuss')):
+        t0 = time.perf_counter()
+        response = client.get(url)
+        times[name] = _ms(t0)
+        assert response.status_code == 200, (url, response.status_code)
+    with app.test_request_context():
+        proposal = Proposal.query.get(pid)
+        t0 = time.perf_counter()
+        mailer.proposal_mail(proposal, 'joined', 'bench', host='http://localhost')
+        times['email'] = _ms(t0)
+    t0 = time.perf_counter()
+    client.get(calendar)
+    times['calendar again'] = _ms(t0)
+    print(json.dumps(times))
+
+
+def _run(workdir, mode):
+    if mode == 'warm-up cold':
+        shutil.rmtree(os.path.join(workdir, 'jinja-cache'), ignore_errors=True)
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-m', 'bench.template_warmup', '--child', workdir, mode],
+                         capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.template_warmup')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--recipes', type=int, default=120)
+    parser.add_argument('--child', nargs=2, metavar=('WORKDIR', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        child(*args.child)
+        return 0
+
+    from app import db
+    from .seed import seed
+
+    workdir = tempfile.mkdtemp(prefix='ccm-bench-templates-')
+    try:
+        app = make_app(workdir, {'TEMPLATE_CACHE_DIR': os.path.join(workdir, 'jinja-cache')})
+        with app.app_context():
+            summary = seed(users=args.users, recipes=args.recipes, years=1, participants=8, messages=20)
+            db.session.remove()
+        with open(os.path.join(workdir, 'summary.json'), 'w') as f:
+            json.dump({'usernames': summary['usernames'],
+                       'upcoming_proposal_ids': summary['upcoming_proposal_ids']}, f)
+
+        results = {}
+        for mode in MODES:
+            runs = [_run(workdir, mode) for _ in range(args.repeat)]
+            results[mode] = {c: statistics.median(r[c] for r in runs) for c in COLUMNS}
+        print(f"{'ms (median of ' + str(args.repeat) + ')':<16}" + ''.join(f'{c:>16}' for c in COLUMNS))
+        for mode, row in results.items():
+            print(f'{mode:<16}' + ''.join(f'{row[c]:>16.1f}' for c in COLUMNS))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if results['warm-up']['calendar'] < results['before']['calendar'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
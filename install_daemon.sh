@@ -7,6 +7,9 @@ REQUIREMENTS="$PROJECT_DIR/requirements.txt"
 SERVICE_NAME="ccm"
 SERVICE_FILE="/etc/systemd/system/$SERVICE_NAME.service"
 CURRENT_USER="$(whoami)"
+# app: the app sends files itself; x-accel: nginx sends them (see the sample below); x-sendfile: Apache/lighttpd
+FILE_DELIVERY="${FILE_DELIVERY:-app}"
+NGINX_SAMPLE="$PROJECT_DIR/nginx-ccm.conf.sample"
 
 echo "Project directory: $PROJECT_DIR"
 
@@ -35,6 +38,7 @@ Type=simple
 User=$CURRENT_USER
 WorkingDirectory=$PROJECT_DIR
 Environment=PATH=$PROJECT_DIR/venv/bin
+Environment=FLASK_FILE_DELIVERY=$FILE_DELIVERY
 ExecStart=$VENV_PY $PROJECT_DIR/run.py
 Restart=on-failure
 RestartSec=5
@@ -45,6 +49,49 @@ StandardError=journal
 WantedBy=multi-user.target
 EOF
 
+echo "Writing sample nginx config to $NGINX_SAMPLE..."
+cat > "$NGINX_SAMPLE" <<EOF
+# Sample nginx site for CCM. Copy to /etc/nginx/sites-available/ccm, adjust server_name,
+# link it into sites-enabled and reload nginx. Install with FILE_DELIVERY=x-accel so that
+# the app answers static files and uploads with X-Accel-Redirect and nginx sends the bytes.
+upstream ccm_app {
+    server 127.0.0.1:5000;
+}
+
+server {
+    listen 80;
+    server_name _;
+
+    # keep in line with MAX_CONTENT_LENGTH (default 16 MB)
+    client_max_body_size 16m;
+
+    location / {
+        proxy_pass http://ccm_app;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto \$scheme;
+    }
+
+    # only reachable through X-Accel-Redirect from the app, which checks access first
+    # (X_ACCEL_STATIC_LOCATION and X_ACCEL_UPLOADS_LOCATION)
+    location /_ccm/static/ {
+        internal;
+        alias $PROJECT_DIR/app/static/;
+        sendfile on;
+        tcp_nopush on;
+        # the .gz files written by 'flask assets compress'
+        gzip_static on;
+    }
+
+    location /_ccm/uploads/ {
+        internal;
+        alias $PROJECT_DIR/app/static/uploads/;
+        sendfile on;
+        tcp_nopush on;
+    }
+}
+EOF
+
 echo "Reloading systemd and starting service..."
 sudo systemctl daemon-reload
 sudo systemctl enable --now "$SERVICE_NAME"
@@ -0,0 +1,31 @@
+"""add updated_at to proposal and recipe
+
+Revision ID: 0004_add_updated_at
+Revises: 0003_add_mail_notifications_toggle
+Create Date: 2026-10-19 09:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0004_add_updated_at'
+down_revision = '0003_add_mail_notifications_toggle'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # version stamps for conditional GET (ETag / Last-Modified); existing rows start at created_at
+    op.add_column('proposal', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('recipe', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.execute('UPDATE proposal SET updated_at = created_at')
+    op.execute('UPDATE recipe SET updated_at = created_at')
+    op.create_index('ix_proposal_updated_at', 'proposal', ['updated_at'])
+    op.create_index('ix_recipe_updated_at', 'recipe', ['updated_at'])
+
+
+def downgrade():
+    op.drop_index('ix_recipe_updated_at', table_name='recipe')
+    op.drop_index('ix_proposal_updated_at', table_name='proposal')
+    op.drop_column('recipe', 'updated_at')
+    op.drop_column('proposal', 'updated_at')
@@ -0,0 +1,37 @@
+"""add per-user digest mode and pending notification queue
+
+Revision ID: 0005_add_notification_digests
+Revises: 0004_add_updated_at
+Create Date: 2026-10-19 10:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0005_add_notification_digests'
+down_revision = '0004_add_updated_at'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 'immediate' keeps the previous behaviour of one email per event
+    op.add_column('user', sa.Column('notify_digest', sa.String(length=10), nullable=True, server_default='immediate'))
+    op.create_table('pending_notification',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('proposal_id', sa.Integer(), nullable=True),
+        sa.Column('proposal_title', sa.String(length=150), nullable=False),
+        sa.Column('proposal_date', sa.Date(), nullable=False),
+        sa.Column('actor', sa.String(length=80), nullable=False),
+        sa.Column('action', sa.String(length=80), nullable=False),
+        sa.Column('extra_text', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_pending_notification_user_id', 'pending_notification', ['user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_pending_notification_user_id', table_name='pending_notification')
+    op.drop_table('pending_notification')
+    op.drop_column('user', 'notify_digest')
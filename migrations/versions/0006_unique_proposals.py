@@ -0,0 +1,44 @@
+"""unique proposal per (date, recipe, proposer) and idempotency keys
+
+Revision ID: 0006_unique_proposals
+Revises: 0005_add_notification_digests
+Create Date: 2026-10-19 12:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0006_unique_proposals'
+down_revision = '0005_add_notification_digests'
+branch_labels = None
+depends_on = None
+
+# the oldest proposal of each (date, recipe, proposer) group is kept
+KEEPER = ("(SELECT MIN(k.id) FROM proposal k WHERE k.date = proposal.date AND k.recipe_id = proposal.recipe_id "
+          "AND k.proposer_id = proposal.proposer_id)")
+
+
+def upgrade():
+    op.add_column('proposal', sa.Column('idempotency_key', sa.String(length=64), nullable=True))
+
+    # merge duplicates from double submits into the oldest proposal before adding the unique index
+    op.execute(f"CREATE TEMPORARY TABLE proposal_dupe AS SELECT id, {KEEPER} AS keep_id FROM proposal")
+    op.execute("DELETE FROM proposal_dupe WHERE id = keep_id")
+    op.execute("UPDATE message SET proposal_id = (SELECT keep_id FROM proposal_dupe d WHERE d.id = message.proposal_id) "
+               "WHERE proposal_id IN (SELECT id FROM proposal_dupe)")
+    op.execute("UPDATE participant SET proposal_id = (SELECT keep_id FROM proposal_dupe d WHERE d.id = participant.proposal_id) "
+               "WHERE proposal_id IN (SELECT id FROM proposal_dupe)")
+    # a user who had joined several of the copies keeps one participation
+    op.execute("DELETE FROM participant WHERE proposal_id IN (SELECT keep_id FROM proposal_dupe) AND id NOT IN ("
+               "SELECT MIN(id) FROM participant GROUP BY proposal_id, user_id)")
+    op.execute("DELETE FROM proposal WHERE id IN (SELECT id FROM proposal_dupe)")
+    op.execute("DROP TABLE proposal_dupe")
+
+    op.create_index('uq_proposal_date_recipe_proposer', 'proposal', ['date', 'recipe_id', 'proposer_id'], unique=True)
+    op.create_index('uq_proposal_proposer_idempotency_key', 'proposal', ['proposer_id', 'idempotency_key'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_proposal_proposer_idempotency_key', table_name='proposal')
+    op.drop_index('uq_proposal_date_recipe_proposer', table_name='proposal')
+    op.drop_column('proposal', 'idempotency_key')
@@ -0,0 +1,43 @@
+"""materialized recipe popularity (times cooked, last cooked, participants)
+
+Revision ID: 0007_recipe_popularity
+Revises: 0006_unique_proposals
+Create Date: 2026-10-19 14:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0007_recipe_popularity'
+down_revision = '0006_unique_proposals'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('recipe', sa.Column('last_cooked_on', sa.Date(), nullable=True))
+    op.add_column('recipe', sa.Column('participants_total', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('proposal', sa.Column('counted', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+    # backfill: same rule as app.popularity.reconcile (times_cooked was never maintained before)
+    op.execute("UPDATE proposal SET counted = CASE WHEN date < CURRENT_DATE OR cook_user_id IS NOT NULL THEN 1 ELSE 0 END")
+    op.execute("UPDATE recipe SET "
+               "times_cooked = (SELECT COUNT(*) FROM proposal p WHERE p.recipe_id = recipe.id AND p.counted), "
+               "last_cooked_on = (SELECT MAX(p.date) FROM proposal p WHERE p.recipe_id = recipe.id AND p.counted), "
+               "participants_total = (SELECT COUNT(*) FROM participant pa JOIN proposal p ON p.id = pa.proposal_id "
+               "WHERE p.recipe_id = recipe.id AND p.counted)")
+
+    op.create_index('ix_recipe_times_cooked', 'recipe', ['times_cooked'])
+    op.create_index('ix_recipe_last_cooked_on', 'recipe', ['last_cooked_on'])
+    op.create_index('ix_proposal_counted_date', 'proposal', ['counted', 'date'])
+    op.create_index('ix_proposal_recipe_counted', 'proposal', ['recipe_id', 'counted'])
+
+
+def downgrade():
+    op.drop_index('ix_proposal_recipe_counted', table_name='proposal')
+    op.drop_index('ix_proposal_counted_date', table_name='proposal')
+    op.drop_index('ix_recipe_last_cooked_on', table_name='recipe')
+    op.drop_index('ix_recipe_times_cooked', table_name='recipe')
+    op.drop_column('proposal', 'counted')
+    op.drop_column('recipe', 'participants_total')
+    op.drop_column('recipe', 'last_cooked_on')
@@ -0,0 +1,40 @@
+"""per-user commitment index (participant / cook / grocery rows with the proposal date)
+
+Revision ID: 0008_add_commitments
+Revises: 0007_recipe_popularity
+Create Date: 2026-10-19 16:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0008_add_commitments'
+down_revision = '0007_recipe_popularity'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('commitment',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('proposal_id', sa.Integer(), sa.ForeignKey('proposal.id'), nullable=False),
+        sa.Column('role', sa.String(length=12), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+    )
+    # backfill from the same sources as app.commitments.rebuild
+    op.execute("INSERT INTO commitment (user_id, proposal_id, role, date) "
+               "SELECT DISTINCT pa.user_id, pa.proposal_id, 'participant', p.date FROM participant pa "
+               "JOIN proposal p ON p.id = pa.proposal_id "
+               "UNION SELECT cook_user_id, id, 'cook', date FROM proposal WHERE cook_user_id IS NOT NULL "
+               "UNION SELECT grocery_user_id, id, 'grocery', date FROM proposal WHERE grocery_user_id IS NOT NULL")
+    op.create_index('ix_commitment_proposal_id', 'commitment', ['proposal_id'])
+    op.create_index('ix_commitment_user_date', 'commitment', ['user_id', 'date'])
+    op.create_index('uq_commitment_user_proposal_role', 'commitment', ['user_id', 'proposal_id', 'role'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_commitment_user_proposal_role', table_name='commitment')
+    op.drop_index('ix_commitment_user_date', table_name='commitment')
+    op.drop_index('ix_commitment_proposal_id', table_name='commitment')
+    op.drop_table('commitment')
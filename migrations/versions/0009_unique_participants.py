@@ -0,0 +1,23 @@
+"""one participant row per (proposal, user)
+
+Revision ID: 0009_unique_participants
+Revises: 0008_add_commitments
+Create Date: 2026-10-19 18:00:00.000000
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0009_unique_participants'
+down_revision = '0008_add_commitments'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # concurrent joins could insert a user twice; keep the first row
+    op.execute("DELETE FROM participant WHERE id NOT IN (SELECT MIN(id) FROM participant GROUP BY proposal_id, user_id)")
+    op.create_index('uq_participant_proposal_user', 'participant', ['proposal_id', 'user_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_participant_proposal_user', table_name='participant')
@@ -0,0 +1,24 @@
+"""per-user token of the .ics calendar feed
+
+Revision ID: 0010_calendar_token
+Revises: 0009_unique_participants
+Create Date: 2026-10-19 20:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0010_calendar_token'
+down_revision = '0009_unique_participants'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('calendar_token', sa.String(length=64), nullable=True))
+    op.create_index('ix_user_calendar_token', 'user', ['calendar_token'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_user_calendar_token', table_name='user')
+    op.drop_column('user', 'calendar_token')
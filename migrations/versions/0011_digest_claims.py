@@ -0,0 +1,22 @@
+"""claim of pending notifications while their digest is sent
+
+Revision ID: 0011_digest_claims
+Revises: 0010_calendar_token
+Create Date: 2026-10-19 22:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0011_digest_claims'
+down_revision = '0010_calendar_token'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('pending_notification', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('pending_notification', 'claimed_at')
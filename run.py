@@ -1,6 +1,12 @@
+import os
+
 from app import create_app
+from app.digests import start_scheduler
 
 app = create_app()
 
 if __name__ == "__main__":
+    # the reloader runs this file in two processes: send digests only from the serving one
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_scheduler(app)
     app.run(host="0.0.0.0", port=5000, debug=True)
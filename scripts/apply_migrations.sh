@@ -22,14 +22,27 @@ fi
 echo "Installing requirements..."
 pip install -r requirements.txt
 
-# Backup DB
+# Backup DB with SQLite's online backup API (a plain cp can tear while the app writes);
+# the app itself may not start before the migration, so this does not go through flask
+backup_db() {
+  echo "Backing up $1 -> $1.bak"
+  python3 - "$1" <<'PY'
+import sqlite3, sys
+src = sqlite3.connect(sys.argv[1])
+dst = sqlite3.connect(sys.argv[1] + '.bak')
+src.backup(dst, pages=256, sleep=0.005)
+ok = dst.execute('PRAGMA integrity_check').fetchone()[0]
+dst.close()
+src.close()
+if ok != 'ok':
+    sys.exit('integrity check of the backup failed: ' + ok)
+PY
+}
 if [ -f instance/ccm.db ]; then
-  echo "Backing up instance/ccm.db -> instance/ccm.db.bak"
-  cp instance/ccm.db instance/ccm.db.bak
+  backup_db instance/ccm.db
 fi
 if [ -f ccm.db ]; then
-  echo "Backing up ccm.db -> ccm.db.bak"
-  cp ccm.db ccm.db.bak
+  backup_db ccm.db
 fi
 
 export FLASK_APP=run.py
@@ -93,6 +106,80 @@ if [ -n "$DBFILE" ]; then
     add_user_col notify_discussion
     add_user_col notify_broadcast
 
+    # helper to add version-stamp columns (initialized from created_at) if missing
+    add_stamp_col() {
+      tbl="$1"
+      if [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM pragma_table_info('"$tbl"') WHERE name='updated_at';")" -eq 0 ]; then
+        echo "Adding $tbl.updated_at"
+        sqlite3 "$DBFILE" "BEGIN TRANSACTION; ALTER TABLE $tbl ADD COLUMN updated_at DATETIME; UPDATE $tbl SET updated_at = created_at; CREATE INDEX IF NOT EXISTS ix_${tbl}_updated_at ON $tbl (updated_at); COMMIT;"
+      else
+        echo "$tbl.updated_at already exists"
+      fi
+    }
+
+    add_stamp_col proposal
+    add_stamp_col recipe
+
+    # digest mode (the pending_notification table itself is created by the app on start)
+    if [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM pragma_table_info('user') WHERE name='notify_digest';")" -eq 0 ]; then
+      echo "Adding user.notify_digest"
+      sqlite3 "$DBFILE" "ALTER TABLE \"user\" ADD COLUMN notify_digest VARCHAR(10) DEFAULT 'immediate';"
+    else
+      echo "user.notify_digest already exists"
+    fi
+
+    # idempotency keys and the unique (date, recipe, proposer) index
+    if [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM pragma_table_info('proposal') WHERE name='idempotency_key';")" -eq 0 ]; then
+      echo "Adding proposal.idempotency_key"
+      sqlite3 "$DBFILE" "ALTER TABLE proposal ADD COLUMN idempotency_key VARCHAR(64); CREATE UNIQUE INDEX IF NOT EXISTS uq_proposal_proposer_idempotency_key ON proposal (proposer_id, idempotency_key);"
+    else
+      echo "proposal.idempotency_key already exists"
+    fi
+    # merge duplicates from double submits into the oldest proposal first, as migration 0006 does
+    sqlite3 -bail "$DBFILE" <<'SQL'
+BEGIN TRANSACTION;
+CREATE TEMPORARY TABLE proposal_dupe AS SELECT id, (SELECT MIN(k.id) FROM proposal k WHERE k.date = proposal.date AND k.recipe_id = proposal.recipe_id AND k.proposer_id = proposal.proposer_id) AS keep_id FROM proposal;
+DELETE FROM proposal_dupe WHERE id = keep_id;
+UPDATE message SET proposal_id = (SELECT keep_id FROM proposal_dupe d WHERE d.id = message.proposal_id) WHERE proposal_id IN (SELECT id FROM proposal_dupe);
+UPDATE participant SET proposal_id = (SELECT keep_id FROM proposal_dupe d WHERE d.id = participant.proposal_id) WHERE proposal_id IN (SELECT id FROM proposal_dupe);
+DELETE FROM participant WHERE proposal_id IN (SELECT keep_id FROM proposal_dupe) AND id NOT IN (SELECT MIN(id) FROM participant GROUP BY proposal_id, user_id);
+SELECT 'Merged ' || COUNT(*) || ' duplicate proposals' FROM proposal_dupe;
+DELETE FROM proposal WHERE id IN (SELECT id FROM proposal_dupe);
+DROP TABLE proposal_dupe;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_proposal_date_recipe_proposer ON proposal (date, recipe_id, proposer_id);
+COMMIT;
+SQL
+
+    # popularity counters; filled by 'flask popularity reconcile' after the restart
+    if [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM pragma_table_info('proposal') WHERE name='counted';")" -eq 0 ]; then
+      echo "Adding popularity columns"
+      sqlite3 "$DBFILE" "BEGIN TRANSACTION; ALTER TABLE proposal ADD COLUMN counted BOOLEAN NOT NULL DEFAULT 0; ALTER TABLE recipe ADD COLUMN last_cooked_on DATE; ALTER TABLE recipe ADD COLUMN participants_total INTEGER DEFAULT 0; CREATE INDEX IF NOT EXISTS ix_proposal_counted_date ON proposal (counted, date); CREATE INDEX IF NOT EXISTS ix_proposal_recipe_counted ON proposal (recipe_id, counted); CREATE INDEX IF NOT EXISTS ix_recipe_times_cooked ON recipe (times_cooked); CREATE INDEX IF NOT EXISTS ix_recipe_last_cooked_on ON recipe (last_cooked_on); COMMIT;"
+    else
+      echo "popularity columns already exist"
+    fi
+
+    # joins rely on one participant row per (proposal, user)
+    sqlite3 "$DBFILE" "BEGIN TRANSACTION; DELETE FROM participant WHERE id NOT IN (SELECT MIN(id) FROM participant GROUP BY proposal_id, user_id); CREATE UNIQUE INDEX IF NOT EXISTS uq_participant_proposal_user ON participant (proposal_id, user_id); COMMIT;"
+
+    # digest claims; the table may not exist yet (the app creates it on start)
+    if [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='pending_notification';")" -eq 1 ] \
+        && [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM pragma_table_info('pending_notification') WHERE name='claimed_at';")" -eq 0 ]; then
+      echo "Adding pending_notification.claimed_at"
+      sqlite3 "$DBFILE" "ALTER TABLE pending_notification ADD COLUMN claimed_at DATETIME;"
+    else
+      echo "pending_notification.claimed_at already exists or is created by the app"
+    fi
+
+    # secret token of the .ics calendar feed
+    if [ "$(sqlite3 "$DBFILE" "SELECT COUNT(*) FROM pragma_table_info('user') WHERE name='calendar_token';")" -eq 0 ]; then
+      echo "Adding user.calendar_token"
+      sqlite3 "$DBFILE" "BEGIN TRANSACTION; ALTER TABLE \"user\" ADD COLUMN calendar_token VARCHAR(64); CREATE UNIQUE INDEX IF NOT EXISTS ix_user_calendar_token ON \"user\" (calendar_token); COMMIT;"
+    else
+      echo "user.calendar_token already exists"
+    fi
+
+    # the commitment table is created by the app on start but starts empty
+    echo "If the commitment table is new, run 'flask commitments rebuild' after the restart."
     echo "Conditional ALTERs (sqlite3) complete. Please restart the app."
     exit 0
   else
@@ -125,6 +212,65 @@ try:
             print(f'Added user.{col}')
         else:
             print(f'user.{col} already exists')
+    for tbl in ('proposal', 'recipe'):
+        if not has(tbl, 'updated_at'):
+            cur.execute(f"ALTER TABLE {tbl} ADD COLUMN updated_at DATETIME;")
+            cur.execute(f"UPDATE {tbl} SET updated_at = created_at;")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS ix_{tbl}_updated_at ON {tbl} (updated_at);")
+            print(f'Added {tbl}.updated_at')
+        else:
+            print(f'{tbl}.updated_at already exists')
+    if not has('user', 'notify_digest'):
+        cur.execute("ALTER TABLE \"user\" ADD COLUMN notify_digest VARCHAR(10) DEFAULT 'immediate';")
+        print('Added user.notify_digest')
+    else:
+        print('user.notify_digest already exists')
+    if not has('proposal', 'idempotency_key'):
+        cur.execute("ALTER TABLE proposal ADD COLUMN idempotency_key VARCHAR(64);")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_proposal_proposer_idempotency_key ON proposal (proposer_id, idempotency_key);")
+        print('Added proposal.idempotency_key')
+    else:
+        print('proposal.idempotency_key already exists')
+    # merge duplicates from double submits into the oldest proposal first, as migration 0006 does
+    cur.execute("CREATE TEMPORARY TABLE proposal_dupe AS SELECT id, (SELECT MIN(k.id) FROM proposal k WHERE k.date = proposal.date "
+                "AND k.recipe_id = proposal.recipe_id AND k.proposer_id = proposal.proposer_id) AS keep_id FROM proposal;")
+    cur.execute("DELETE FROM proposal_dupe WHERE id = keep_id;")
+    cur.execute("UPDATE message SET proposal_id = (SELECT keep_id FROM proposal_dupe d WHERE d.id = message.proposal_id) "
+                "WHERE proposal_id IN (SELECT id FROM proposal_dupe);")
+    cur.execute("UPDATE participant SET proposal_id = (SELECT keep_id FROM proposal_dupe d WHERE d.id = participant.proposal_id) "
+                "WHERE proposal_id IN (SELECT id FROM proposal_dupe);")
+    cur.execute("DELETE FROM participant WHERE proposal_id IN (SELECT keep_id FROM proposal_dupe) AND id NOT IN ("
+                "SELECT MIN(id) FROM participant GROUP BY proposal_id, user_id);")
+    cur.execute("DELETE FROM proposal WHERE id IN (SELECT id FROM proposal_dupe);")
+    print(f'Merged {cur.rowcount} duplicate proposals')
+    cur.execute("DROP TABLE proposal_dupe;")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_proposal_date_recipe_proposer ON proposal (date, recipe_id, proposer_id);")
+    if not has('proposal', 'counted'):
+        cur.execute("ALTER TABLE proposal ADD COLUMN counted BOOLEAN NOT NULL DEFAULT 0;")
+        cur.execute("ALTER TABLE recipe ADD COLUMN last_cooked_on DATE;")
+        cur.execute("ALTER TABLE recipe ADD COLUMN participants_total INTEGER DEFAULT 0;")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_proposal_counted_date ON proposal (counted, date);")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_proposal_recipe_counted ON proposal (recipe_id, counted);")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_recipe_times_cooked ON recipe (times_cooked);")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_recipe_last_cooked_on ON recipe (last_cooked_on);")
+        print("Added popularity columns; run 'flask popularity reconcile' after the restart")
+    else:
+        print('popularity columns already exist')
+    cur.execute("DELETE FROM participant WHERE id NOT IN (SELECT MIN(id) FROM participant GROUP BY proposal_id, user_id);")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_participant_proposal_user ON participant (proposal_id, user_id);")
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='pending_notification'")
+    if cur.fetchone()[0] and not has('pending_notification', 'claimed_at'):
+        cur.execute("ALTER TABLE pending_notification ADD COLUMN claimed_at DATETIME;")
+        print('Added pending_notification.claimed_at')
+    else:
+        print('pending_notification.claimed_at already exists or is created by the app')
+    if not has('user', 'calendar_token'):
+        cur.execute("ALTER TABLE \"user\" ADD COLUMN calendar_token VARCHAR(64);")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_user_calendar_token ON \"user\" (calendar_token);")
+        print('Added user.calendar_token')
+    else:
+        print('user.calendar_token already exists')
+    print("If the commitment table is new, run 'flask commitments rebuild' after the restart.")
     cur.execute("COMMIT;")
 finally:
     cur.execute("PRAGMA foreign_keys=ON;")
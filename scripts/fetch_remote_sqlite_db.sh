@@ -0,0 +1,34 @@
+#!/bin/sh
+set -e
+
+# Usage: ./scripts/fetch_remote_sqlite_db.sh user@host [remote_project_dir] [local_file]
+# Takes a consistent snapshot on the server with `flask backup create`
+# (SQLite online backup API, the app keeps running) and copies it here.
+# Never copy the live remote ccm.db directly: with concurrent writers the copy can be torn.
+
+REMOTE="$1"
+REMOTE_DIR="${2:-ccm}"
+ROOT="$(cd "$(dirname "$(dirname "$0")")" && pwd)"
+LOCAL="${3:-$ROOT/instance/ccm.db}"
+
+if [ -z "$REMOTE" ]; then
+  echo "Usage: $0 user@host [remote_project_dir] [local_file]" >&2
+  exit 1
+fi
+
+SNAPSHOT="/tmp/ccm-fetch-$$.db"
+echo "Creating snapshot on $REMOTE..."
+ssh "$REMOTE" "cd '$REMOTE_DIR' && FLASK_APP=run.py venv/bin/flask backup create -o '$SNAPSHOT'"
+
+mkdir -p "$(dirname "$LOCAL")"
+if [ -f "$LOCAL" ]; then
+  echo "Keeping previous local copy as $LOCAL.bak"
+  mv "$LOCAL" "$LOCAL.bak"
+fi
+echo "Copying snapshot to $LOCAL..."
+set +e
+scp "$REMOTE:$SNAPSHOT" "$LOCAL"
+RC=$?
+set -e
+ssh "$REMOTE" "rm -f '$SNAPSHOT'"
+exit $RC